@@ -4,77 +4,61 @@ Security Analysis Script
 Analyzes the encryption algorithm's security properties:
 1. Correlation coefficient analysis (Rxy)
 2. NPCR and UACI for differential attack resistance
-3. Generates comprehensive security report
+3. Shannon entropy and histogram chi-square
+4. Generates comprehensive security report
 """
 
 import argparse
 import os
 from pathlib import Path
-from security_analysis import SecurityAnalyzer
+from security_analysis import SecurityAnalyzer, THEORETICAL_ENTROPY
 import numpy as np
 from PIL import Image
 from tabulate import tabulate
 
 
-def analyze_folder_correlation(folder_path: str) -> dict:
-    """Analyze correlation for all images in a folder"""
+def analyze_folder_correlation(folder_path: str, analyzer: SecurityAnalyzer = None) -> dict:
+    """Analyze correlation, entropy and chi-square for all images in a folder (or its ciphertext container)"""
     results = {}
+    analyzer = analyzer or SecurityAnalyzer()
     
     if not os.path.exists(folder_path):
         print(f"Error: Folder '{folder_path}' not found")
         return results
     
-    image_files = [f for f in os.listdir(folder_path) 
-                   if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
+    print(f"\n📊 Analyzing correlation for images in '{folder_path}'...")
     
-    if not image_files:
-        print(f"No images found in '{folder_path}'")
+    try:
+        results = analyzer.analyze_folder(folder_path)
+    except Exception as e:
+        print(f"  ✗ {folder_path}: {str(e)}")
         return results
     
-    print(f"\n📊 Analyzing correlation for images in '{folder_path}'...")
-    
-    for image_file in image_files:
-        image_path = os.path.join(folder_path, image_file)
-        try:
-            corr = SecurityAnalyzer.analyze_correlation(image_path)
-            results[image_file] = corr
-            print(f"  ✓ {image_file}")
-        except Exception as e:
-            print(f"  ✗ {image_file}: {str(e)}")
+    for image_file in results:
+        print(f"  ✓ {image_file}")
     
     return results
 
 
-def analyze_differential_attack(original_folder: str, encrypted_folder: str) -> dict:
+def analyze_differential_attack(original_folder: str, encrypted_folder: str,
+                                analyzer: SecurityAnalyzer = None) -> dict:
     """Analyze differential attack resistance"""
     results = {}
-
-    original_files = [f for f in os.listdir(original_folder)
-                     if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
-    encrypted_files = [f for f in os.listdir(encrypted_folder)
-                      if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
-
-    if not original_files or not encrypted_files:
-        print("No images found in one or both folders")
-        return results
+    analyzer = analyzer or SecurityAnalyzer()
 
     print(f"\n🔐 Analyzing differential attack resistance...")
 
-    # Match original files with encrypted files (encrypted files have _processed suffix)
-    for orig_file in original_files:
-        base_name = orig_file.rsplit('.', 1)[0]  # Remove extension
-        encrypted_file = f"{base_name}_processed.png"
-
-        if encrypted_file in encrypted_files:
-            original_path = os.path.join(original_folder, orig_file)
-            encrypted_path = os.path.join(encrypted_folder, encrypted_file)
+    # Read the container or _processed.png files and match them to the originals by name
+    try:
+        results = analyzer.analyze_ciphertext_pairs(original_folder, encrypted_folder)
+    except Exception as e:
+        print(f"  ✗ {str(e)}")
+        return results
 
-            try:
-                metrics = SecurityAnalyzer.analyze_differential_attack(original_path, encrypted_path)
-                results[orig_file] = metrics
-                print(f"  ✓ {orig_file} → {encrypted_file}")
-            except Exception as e:
-                print(f"  ✗ {orig_file}: {str(e)}")
+    if not results:
+        print("No matching images found in the two folders")
+    for image_file in results:
+        print(f"  ✓ {image_file}")
 
     return results
 
@@ -114,6 +98,29 @@ def print_correlation_report(results: dict):
         print(f"   Diagonal:   {avg_d:.6f}")
 
 
+def print_statistics_report(results: dict):
+    """Print entropy and histogram chi-square report"""
+    if not results:
+        return
+
+    print("\n" + "="*70)
+    print("INFORMATION ENTROPY AND HISTOGRAM ANALYSIS")
+    print("="*70)
+    print(f"Entropy: ideal value {THEORETICAL_ENTROPY:.1f} bits for a uniform 8-bit image")
+    print("Chi-square: below 293.25 passes the uniformity test (255 d.o.f., 5% level)\n")
+
+    table_data = []
+    for image_name, metrics in results.items():
+        table_data.append([
+            image_name,
+            f"{metrics['entropy']:.6f}",
+            f"{metrics['chi_square']:.2f}"
+        ])
+
+    headers = ["Image", "Entropy", "Chi-square"]
+    print(tabulate(table_data, headers=headers, tablefmt="grid"))
+
+
 def print_differential_attack_report(results: dict):
     """Print differential attack analysis report"""
     if not results:
@@ -160,8 +167,13 @@ def main():
                        help="Path to encrypted images folder")
     parser.add_argument('--all', '-a', action='store_true',
                        help="Run all analyses")
+    parser.add_argument('--workers', '-w', type=int, default=1,
+                       help="Worker processes for large folders (default: 1)")
+    parser.add_argument('--sample', '-s', type=int,
+                       help="Random adjacent pairs per direction for correlation (default: all pairs)")
 
     args = parser.parse_args()
+    analyzer = SecurityAnalyzer(sample=args.sample, workers=args.workers)
 
     print("\n" + "="*70)
     print("🔒 IMAGE ENCRYPTION SECURITY ANALYSIS")
@@ -171,7 +183,7 @@ def main():
     if args.original or args.all:
         original_folder = args.original or './test_images'
         print("\n📋 ORIGINAL IMAGES ANALYSIS")
-        corr_results = analyze_folder_correlation(original_folder)
+        corr_results = analyze_folder_correlation(original_folder, analyzer)
         print_correlation_report(corr_results)
 
     # Correlation analysis for encrypted images
@@ -179,16 +191,17 @@ def main():
         encrypted_folder = args.encrypted or './encrypted_images'
         if os.path.exists(encrypted_folder):
             print("\n📋 ENCRYPTED IMAGES ANALYSIS")
-            encrypted_corr = analyze_folder_correlation(encrypted_folder)
+            encrypted_corr = analyze_folder_correlation(encrypted_folder, analyzer)
             print_correlation_report(encrypted_corr)
+            print_statistics_report(encrypted_corr)
 
     # Differential attack analysis
     if args.encrypted and args.original:
-        diff_results = analyze_differential_attack(args.original, args.encrypted)
+        diff_results = analyze_differential_attack(args.original, args.encrypted, analyzer)
         print_differential_attack_report(diff_results)
     elif args.all:
         if os.path.exists('./test_images') and os.path.exists('./encrypted_images'):
-            diff_results = analyze_differential_attack('./test_images', './encrypted_images')
+            diff_results = analyze_differential_attack('./test_images', './encrypted_images', analyzer)
             print_differential_attack_report(diff_results)
 
     print("\n" + "="*70)
@@ -0,0 +1,260 @@
+"""
+Benchmark Script
+
+Times every stage of the pipeline on synthetic image batches:
+1. Chaotic keystream (tdlcic_map) and key material derivation
+2. DNA stages: cyclic shift encode/decode, scrambling, diffusion, fused kernels
+3. Image I/O: load_images, save_images and the ciphertext container
+4. End-to-end encrypt_images / decrypt_images and streaming encryption, with a
+   round-trip check
+
+Results (seconds, MB/s, peak memory per stage) are written to JSON and can be
+compared against a stored baseline to flag regressions; the execution planner
+(main.py plan) calibrates its cost model from them.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+from PIL import Image
+
+from chaotic_maps.tdlcic import resolve_backend, tdlcic_map
+from decrypt import decrypt_arrays, decrypt_images
+from dna_operations import core, diffusion
+from encrypt import encrypt_arrays, encrypt_images
+from pipeline import fused
+from pipeline.streaming import encrypt_images_streaming
+from utils import image_handler, key_material
+from utils.instrumentation import Instrumentation
+from utils.key_material import TRANSIENT_ITERATIONS, KeyMaterial, key_parameters
+from utils.memory import current_rss
+
+PRESETS = {
+    'quick': {'counts': [1, 4], 'sizes': [64, 256], 'mixes': ['gray', 'rgb', 'mixed']},
+    'standard': {'counts': [1, 4, 16], 'sizes': [64, 256, 1024], 'mixes': ['gray', 'rgb', 'mixed']},
+    'full': {'counts': [1, 4, 16, 64], 'sizes': [64, 256, 1024, 4096], 'mixes': ['gray', 'rgb', 'mixed']},
+}
+MIXES = ('gray', 'rgb', 'mixed')
+
+
+def make_batch(count, size, mix, seed=0):
+    """Synthetic images: smooth gradients plus noise, so PNG timings are realistic."""
+    rng = np.random.default_rng(seed)
+    ramp = np.add.outer(np.arange(size), np.arange(size)) * (255.0 / max(1, 2 * size - 2))
+    images = []
+    for i in range(count):
+        rgb = mix == 'rgb' or (mix == 'mixed' and i % 2 == 0)
+        shape = (size, size, 3) if rgb else (size, size)
+        base = ramp[..., None] if rgb else ramp
+        noise = rng.normal(0, 12, shape)
+        images.append(np.clip(base + noise + 40 * i, 0, 255).astype(np.uint8))
+    return images
+
+
+def channel_count(count, mix):
+    return sum(3 if mix == 'rgb' or (mix == 'mixed' and i % 2 == 0) else 1 for i in range(count))
+
+
+def measure(name, func, nbytes, repeat=1, trace_memory=False):
+    """Run `func` `repeat` times and keep the fastest stage record.
+
+    The record also holds the anonymous RSS at the start of the stage, so
+    the planner can tell the stage's own memory from what was resident.
+    """
+    best, result = None, None
+    for _ in range(repeat):
+        instrumentation = Instrumentation(trace_memory=trace_memory)
+        start_anon_rss = current_rss()[1]
+        with instrumentation.stage(name, nbytes=nbytes):
+            result = func()
+        record = {**instrumentation.records[0], 'start_anon_rss': start_anon_rss}
+        if best is None or record['seconds'] < best['seconds']:
+            best = record
+    best = {key: value for key, value in best.items() if key != 'stage'}
+    return best, result
+
+
+def run_case(count, size, mix, repeat=1, workers=1, backend=None, trace_memory=False):
+    images = make_batch(count, size, mix)
+    P, original_shapes, channel_map = image_handler.preprocess_images(images)
+    nbytes = P.nbytes
+    stages = {}
+
+    def timed(name, func, stage_bytes=nbytes):
+        stages[name], result = measure(name, func, stage_bytes, repeat, trace_memory)
+        return result
+
+    # Keystream and key material, independent of any cache.
+    K = timed('key', lambda: key_material.plaintext_key(P))
+    a, b, x0, y0 = key_parameters(K)
+    timed('tdlcic_map', lambda: tdlcic_map(x0, y0, a, b, P.size // 2 + TRANSIENT_ITERATIONS, backend))
+    material = timed('key_material', lambda: KeyMaterial.derive(K, P.shape, backend))
+
+    # Staged DNA primitives.
+    P_dna1 = timed('cyclic_shift_encode', lambda: core.cyclic_shift_encode(P, material.C_matrix))
+    P_dna2 = timed('scramble', lambda: material.plan.apply(P_dna1))
+    E_dna = core.encode_with_rule(material.E)
+    P_dna4 = timed('diffusion', lambda: diffusion.strand_diffusion(diffusion.lateral_diffusion(P_dna2, E_dna)))
+    P_end = timed('cyclic_shift_decode', lambda: core.cyclic_shift_decode(P_dna4, material.C_matrix))
+    P_dna3 = timed('inverse_diffusion', lambda: diffusion.inverse_lateral_diffusion(
+        diffusion.inverse_strand_diffusion(P_dna4), E_dna))
+    timed('inverse_scramble', lambda: material.plan.undo(P_dna3))
+
+    # Fused kernels.
+    fused_end = timed('fused_encrypt', lambda: fused.encrypt(P, material))
+    fused_plain = timed('fused_decrypt', lambda: fused.decrypt(fused_end, material))
+
+    checks = {
+        'fused_matches_staged': bool(np.array_equal(fused_end, P_end)),
+        'fused_roundtrip': bool(np.array_equal(fused_plain, P)),
+    }
+
+    # In-memory round trip through the public API.
+    ciphertext, K_arrays, layout = encrypt_arrays(images, workers=workers)
+    decrypted = decrypt_arrays(ciphertext, K_arrays, layout, workers=workers)
+    checks['arrays_roundtrip'] = K_arrays == K and all(np.array_equal(x, y) for x, y in zip(images, decrypted))
+
+    # File I/O and end-to-end runs on a temporary folder, with a cold key cache.
+    root = tempfile.mkdtemp(prefix='mie-bench-')
+    try:
+        plain_dir, cipher_dir, png_dir, out_dir, stream_dir = (os.path.join(root, d)
+                                                               for d in ('plain', 'cipher', 'png', 'out', 'stream'))
+        os.makedirs(plain_dir)
+        paths = [os.path.join(plain_dir, f"img{i:03d}.png") for i in range(count)]
+        for path, img in zip(paths, images):
+            Image.fromarray(img).save(path, compress_level=1)
+
+        timed('load_images', lambda: image_handler.load_images(plain_dir))
+        timed('save_images', lambda: image_handler.save_images(P_end, png_dir, paths, original_shapes, channel_map,
+                                                               preserve_padding=True))
+        timed('save_container', lambda: image_handler.save_container(P_end, cipher_dir, paths, original_shapes,
+                                                                     channel_map))
+
+        cache = key_material.default_cache
+        key_material.configure_cache(max_bytes=0)
+        try:
+            silent = Instrumentation()
+            K_e2e = timed('encrypt_images', lambda: encrypt_images(plain_dir, cipher_dir, workers=workers,
+                                                                   instrumentation=silent))
+            timed('decrypt_images', lambda: decrypt_images(cipher_dir, out_dir, K_e2e, workers=workers,
+                                                           instrumentation=silent))
+            K_streaming = timed('encrypt_streaming', lambda: encrypt_images_streaming(
+                plain_dir, stream_dir, backend=backend, instrumentation=silent))
+        finally:
+            key_material.default_cache = cache
+        checks['streaming_key'] = K_streaming == K
+        checks['images_roundtrip'] = K_e2e == K and all(
+            np.array_equal(img, np.array(Image.open(os.path.join(out_dir, f"img{i:03d}_processed.png"))))
+            for i, img in enumerate(images))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    return {
+        'case': f"{mix}-{count}x{size}",
+        'count': count, 'size': size, 'mix': mix, 'shape': list(P.shape), 'bytes': nbytes,
+        'stages': stages, 'checks': checks, 'roundtrip': all(checks.values()),
+    }
+
+
+def environment(workers, backend):
+    return {
+        'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+        'cpu_count': os.cpu_count(), 'workers': workers, 'keystream_backend': resolve_backend(backend),
+    }
+
+
+def compare(results, baseline, threshold, min_seconds=0.005):
+    """List (case, stage, baseline s, current s, ratio) for stages slower than 1 + threshold."""
+    baseline_cases = {case['case']: case for case in baseline['cases']}
+    regressions = []
+    for case in results['cases']:
+        old = baseline_cases.get(case['case'])
+        if old is None:
+            continue
+        for stage, record in case['stages'].items():
+            old_record = old['stages'].get(stage)
+            if old_record is None or max(old_record['seconds'], record['seconds']) < min_seconds:
+                continue
+            ratio = record['seconds'] / max(old_record['seconds'], 1e-9)
+            if ratio > 1 + threshold:
+                regressions.append((case['case'], stage, old_record['seconds'], record['seconds'], ratio))
+    return regressions
+
+
+def print_case(case):
+    print(f"\n{case['case']}  tensor {'x'.join(map(str, case['shape']))}  "
+          f"round trip: {'OK' if case['roundtrip'] else 'FAILED ' + str(case['checks'])}")
+    print(f"  {'Stage':<20} {'Time (s)':>9} {'MB/s':>9} {'Peak RSS (MB)':>14}")
+    for stage, record in case['stages'].items():
+        rate = f"{record['mb_per_s']:>9.1f}" if record['mb_per_s'] is not None else f"{'-':>9}"
+        print(f"  {stage:<20} {record['seconds']:>9.4f} {rate} {record['peak_rss'] / 2**20:>14.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark every stage of the image encryption pipeline")
+    parser.add_argument('--preset', choices=sorted(PRESETS), default='quick',
+                        help="Case matrix to run (default: quick)")
+    parser.add_argument('--counts', type=int, nargs='+', help="Images per batch (overrides the preset)")
+    parser.add_argument('--sizes', type=int, nargs='+', help="Square image sizes in pixels (overrides the preset)")
+    parser.add_argument('--mixes', nargs='+', choices=MIXES, help="Channel mixes (overrides the preset)")
+    parser.add_argument('--max-mb', type=float, default=1024,
+                        help="Skip cases whose pixel tensor exceeds this many MB (default: 1024)")
+    parser.add_argument('--repeat', '-r', type=int, default=1, help="Runs per stage; the fastest is kept (default: 1)")
+    parser.add_argument('--workers', '-w', type=int, default=1, help="Worker processes for the end-to-end runs")
+    parser.add_argument('--backend', help="Chaotic keystream backend (default: auto)")
+    parser.add_argument('--trace-memory', action='store_true', help="Also record the tracemalloc peak per stage")
+    parser.add_argument('--output', '-o', default='benchmark_results.json', help="Where to write the JSON results")
+    parser.add_argument('--baseline', '-b', help="Baseline JSON to compare against")
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help="Relative slowdown that counts as a regression (default: 0.10)")
+    args = parser.parse_args()
+
+    preset = PRESETS[args.preset]
+    counts, sizes, mixes = args.counts or preset['counts'], args.sizes or preset['sizes'], args.mixes or preset['mixes']
+
+    results = {'environment': environment(args.workers, args.backend), 'cases': []}
+    for size in sizes:
+        for count in counts:
+            for mix in mixes:
+                n = channel_count(count, mix)
+                if n < 2:
+                    # The keystream layout needs at least two channels in total.
+                    print(f"\nSkipping {mix}-{count}x{size}: a batch needs at least two channels")
+                    continue
+                if size * size * n > args.max_mb * 2**20:
+                    print(f"\nSkipping {mix}-{count}x{size}: tensor exceeds --max-mb")
+                    continue
+                case = run_case(count, size, mix, args.repeat, args.workers, args.backend, args.trace_memory)
+                results['cases'].append(case)
+                print_case(case)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults written to '{args.output}'")
+
+    failed = [case['case'] for case in results['cases'] if not case['roundtrip']]
+    if failed:
+        print(f"Round trip FAILED for: {', '.join(failed)}")
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            print(f"\nRegressions beyond {args.threshold:.0%} against '{args.baseline}':")
+            for case, stage, old, new, ratio in regressions:
+                print(f"  {case:<18} {stage:<20} {old:.4f}s -> {new:.4f}s ({ratio:.2f}x)")
+        else:
+            print(f"\nNo regressions beyond {args.threshold:.0%} against '{args.baseline}'")
+
+    sys.exit(1 if failed or regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
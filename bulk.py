@@ -0,0 +1,343 @@
+"""
+Resumable Bulk Runner
+
+Encrypts a whole tree of image folders, or decrypts one again:
+1. Every folder that directly holds images is one job; its output goes to
+   the same relative path under the output root
+2. Jobs run on a process pool, one folder per worker
+3. Every finished job is appended to <state>/journal.jsonl with its key
+   (or unit manifest), an input fingerprint and the checksums of its outputs
+4. A rerun skips jobs whose record still matches their inputs and options
+   and whose outputs still verify, and runs everything else again
+
+Aggregate throughput and an ETA are printed as jobs finish. The encryption
+journal holds every key, so keep its state folder (by default <output>.bulk,
+next to the output tree rather than inside it) on trusted storage; bulk
+decryption reads the keys from it.
+"""
+
+import argparse
+import hashlib
+import math
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+from decrypt import decrypt_images
+from encrypt import encrypt_images, encrypt_images_sequence
+from utils import image_handler, journal
+from utils.instrumentation import Instrumentation
+
+JOURNAL_FILE = 'journal.jsonl'
+MANIFEST_DIR = 'manifests'
+HASH_CHUNK_BYTES = 4 * 2**20
+
+
+def default_state_dir(root):
+    # Outside the tree: the encryption journal holds the keys.
+    return os.path.normpath(root) + '.bulk'
+
+
+def _is_within(path, root):
+    path, root = os.path.abspath(path), os.path.abspath(root)
+    return os.path.commonpath([path, root]) == root
+
+
+def find_jobs(input_root, exclude=()):
+    """Relative paths of every folder under `input_root` that directly holds images."""
+    jobs = []
+    for dirpath, dirnames, filenames in os.walk(input_root):
+        dirnames[:] = sorted(d for d in dirnames
+                             if not any(_is_within(os.path.join(dirpath, d), root) for root in exclude))
+        if any(image_handler.is_image_file(name) for name in filenames):
+            jobs.append(os.path.relpath(dirpath, input_root))
+    return jobs
+
+
+def _files(folder, images_only=False):
+    if not os.path.isdir(folder):
+        return []
+    return sorted(entry.path for entry in os.scandir(folder)
+                  if entry.is_file() and (not images_only or image_handler.is_image_file(entry.name)))
+
+
+def fingerprint(paths):
+    """Cheap identity of a set of files: names, sizes and modification times."""
+    digest = hashlib.sha256()
+    for path in paths:
+        stat = os.stat(path)
+        digest.update(f"{os.path.basename(path)}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(HASH_CHUNK_BYTES):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _identity(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+
+def snapshot(folder):
+    """Identity of every file directly in `folder`, to tell later which ones a job wrote."""
+    return {path: _identity(path) for path in _files(folder)}
+
+
+def checksum_outputs(folder, before=None):
+    # Files directly in the job's output folder (nested jobs write below
+    # it), leaving out those unchanged since the `before` snapshot.
+    before = before or {}
+    return {os.path.basename(path): {'size': os.path.getsize(path), 'sha256': file_sha256(path)}
+            for path in _files(folder) if before.get(path) != _identity(path)}
+
+
+def remove_outputs(folder, names):
+    # Outputs of an earlier run that this one may not write again, e.g. a
+    # single container left next to new unit containers.
+    for name in names:
+        path = os.path.join(folder, name)
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+def verify_outputs(folder, outputs, full=True):
+    for name, expected in outputs.items():
+        path = os.path.join(folder, name)
+        if not os.path.isfile(path) or os.path.getsize(path) != expected['size']:
+            return False
+        if full and file_sha256(path) != expected['sha256']:
+            return False
+    return True
+
+
+def run_job(action, input_folder, output_folder, options, secret=None, manifest_path=None, previous_outputs=()):
+    """Encrypt or decrypt one folder and return its key or manifest, output checksums and time.
+
+    `previous_outputs` names the files an earlier run of the job wrote; they
+    are removed first, and only the files this run writes are checksummed.
+    """
+    remove_outputs(output_folder, previous_outputs)
+    before = snapshot(output_folder)
+    instrumentation = Instrumentation()
+    start = time.perf_counter()
+    result = {}
+    if action == 'encrypt' and options.get('group_size'):
+        encrypt_images_sequence(input_folder, output_folder, options['group_size'], manifest_path,
+                                compress_level=options['compress_level'], output_format=options['format'],
+                                instrumentation=instrumentation)
+    elif action == 'encrypt':
+        result['key'] = encrypt_images(input_folder, output_folder, compress_level=options['compress_level'],
+                                       output_format=options['format'], instrumentation=instrumentation, cache=False)
+    else:
+        decrypt_images(input_folder, output_folder, secret.get('key'), compress_level=options['compress_level'],
+                       instrumentation=instrumentation, manifest=secret.get('manifest'), cache=False)
+    result['seconds'] = time.perf_counter() - start
+    result['outputs'] = checksum_outputs(output_folder, before)
+    return result
+
+
+def _run_job_task(task):
+    return run_job(*task)
+
+
+def format_duration(seconds):
+    if not math.isfinite(seconds):
+        return '--:--:--'
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+class Progress:
+    """Aggregate throughput and ETA over the jobs of this run, by input bytes."""
+
+    def __init__(self, jobs, images, nbytes):
+        self.total_jobs, self.total_images, self.total_bytes = jobs, images, nbytes
+        self.jobs = self.images = self.bytes = self.failed = 0
+        self.start = time.perf_counter()
+
+    def add(self, images, nbytes, failed=False):
+        self.jobs += 1
+        self.images += images
+        self.bytes += nbytes
+        self.failed += failed
+
+    def format_line(self):
+        elapsed = max(time.perf_counter() - self.start, 1e-9)
+        rate = self.bytes / elapsed
+        eta = (self.total_bytes - self.bytes) / rate if rate > 0 else math.inf
+        failed = f", {self.failed} failed" if self.failed else ""
+        return (f"[{self.jobs}/{self.total_jobs} jobs, {self.images}/{self.total_images} images{failed}] "
+                f"{rate / 2**20:.1f} MB/s, {self.images / elapsed:.1f} images/s, "
+                f"elapsed {format_duration(elapsed)}, ETA {format_duration(eta)}")
+
+
+def latest_records(journal_path):
+    """The last 'done' or 'failed' record of every job in a journal."""
+    latest = {}
+    for record in journal.read_records(journal_path):
+        if record.get('event') in ('done', 'failed'):
+            latest[record['job']] = record
+    return latest
+
+
+def previous_outputs(journal_path):
+    """Output names of the last finished run of every job; failed records list none."""
+    outputs = {}
+    for record in journal.read_records(journal_path):
+        if record.get('event') == 'done':
+            outputs[record['job']] = list(record['outputs'])
+    return outputs
+
+
+def plan_jobs(action, input_root, output_root, state_dir, keys_dir=None):
+    """[(job, input folder, output folder, secret, image count)] for a run.
+
+    Encryption counts the images when it lists them, so the count is None.
+    """
+    if action == 'encrypt':
+        return [(job, os.path.join(input_root, job), os.path.join(output_root, job), None, None)
+                for job in find_jobs(input_root, exclude=(output_root, state_dir))]
+    jobs = []
+    for job, record in sorted(latest_records(os.path.join(keys_dir, JOURNAL_FILE)).items()):
+        if record['event'] != 'done':
+            continue
+        if 'manifest' in record:
+            secret = {'manifest': os.path.join(keys_dir, record['manifest'])}
+        else:
+            secret = {'key': record['key']}
+        jobs.append((job, os.path.join(input_root, job), os.path.join(output_root, job), secret, record['images']))
+    return jobs
+
+
+def run_bulk(action, input_root, output_root, state_dir=None, keys_dir=None, workers=1,
+             compress_level=image_handler.DEFAULT_COMPRESS_LEVEL, output_format='container', group_size=None,
+             verify='sha256'):
+    """Run or resume a bulk job; returns the number of jobs that failed."""
+    state_dir = state_dir or default_state_dir(output_root)
+    keys_dir = keys_dir or default_state_dir(input_root)
+    journal_path = os.path.join(state_dir, JOURNAL_FILE)
+    options = {'compress_level': compress_level}
+    if action == 'encrypt':
+        options.update(format=output_format, group_size=group_size)
+    if action == 'decrypt' and not os.path.exists(os.path.join(keys_dir, JOURNAL_FILE)):
+        raise ValueError(f"No encryption journal in '{keys_dir}'; pass the encryption state folder with --keys.")
+
+    jobs = plan_jobs(action, input_root, output_root, state_dir, keys_dir)
+    latest = latest_records(journal_path)
+    previous = previous_outputs(journal_path)
+
+    def check(job):
+        name, input_folder, output_folder = job[:3]
+        paths = _files(input_folder, images_only=action == 'encrypt')
+        record = latest.get(name)
+        done = (record is not None and record['event'] == 'done' and record['options'] == options
+                and record['fingerprint'] == fingerprint(paths)
+                and verify_outputs(output_folder, record['outputs'], full=verify == 'sha256')
+                and ('manifest' not in record or os.path.isfile(os.path.join(state_dir, record['manifest']))))
+        return done, paths
+
+    # Checksumming is I/O and hashlib releases the GIL, so threads overlap it.
+    with ThreadPoolExecutor(max(1, workers)) as pool:
+        checked = list(pool.map(check, jobs))
+    todo = [(job, paths) for job, (done, paths) in zip(jobs, checked) if not done]
+    redo = sum(1 for job, _ in todo if job[0] in latest)
+    nbytes = {job[0]: sum(os.path.getsize(path) for path in paths) for job, paths in todo}
+    images = {job[0]: len(paths) if job[4] is None else job[4] for job, paths in todo}
+    print(f"{len(jobs)} job(s): {len(jobs) - len(todo)} already done and verified, {len(todo)} to run "
+          f"({redo} of them again), {sum(nbytes.values()) / 2**20:.1f} MB on {workers} worker(s)")
+
+    progress = Progress(len(todo), sum(images.values()), sum(nbytes.values()))
+    with journal.Journal(journal_path) as log:
+        log.append({'event': 'run', 'action': action, 'input': os.path.abspath(input_root),
+                    'output': os.path.abspath(output_root), 'options': options, 'workers': workers,
+                    'time': time.time()})
+
+        tasks = {}
+        for (name, input_folder, output_folder, secret, _), paths in todo:
+            manifest = os.path.join(MANIFEST_DIR, name, 'manifest.json') if options.get('group_size') else None
+            tasks[name] = ((action, input_folder, output_folder, options, secret,
+                            os.path.join(state_dir, manifest) if manifest else None, previous.get(name, ())),
+                           {'job': name, 'fingerprint': fingerprint(paths), 'options': options,
+                            'images': images[name], 'bytes': nbytes[name],
+                            **({'manifest': manifest} if manifest else {})})
+
+        def record_job(name, result=None, error=None):
+            record = tasks[name][1]
+            if error is None:
+                log.append({'event': 'done', **record, **result, 'time': time.time()})
+            else:
+                log.append({'event': 'failed', 'job': name, 'error': f"{type(error).__name__}: {error}",
+                            'time': time.time()})
+                print(f"FAILED {name}: {type(error).__name__}: {error}")
+            progress.add(record['images'], record['bytes'], failed=error is not None)
+            print(f"{progress.format_line()}  {name}")
+
+        if workers <= 1:
+            for name, (task, _) in tasks.items():
+                try:
+                    result = run_job(*task)
+                except Exception as error:
+                    record_job(name, error=error)
+                else:
+                    record_job(name, result)
+        else:
+            with ProcessPoolExecutor(workers) as pool:
+                futures = {pool.submit(_run_job_task, task): name for name, (task, _) in tasks.items()}
+                try:
+                    for future in as_completed(futures):
+                        try:
+                            result = future.result()
+                        except Exception as error:
+                            record_job(futures[future], error=error)
+                        else:
+                            record_job(futures[future], result)
+                except KeyboardInterrupt:
+                    for future in futures:
+                        future.cancel()
+                    raise
+
+    print(f"\n{action.capitalize()}ed {progress.jobs - progress.failed} job(s), {progress.failed} failed; "
+          f"journal: '{journal_path}'")
+    return progress.failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Resumable bulk encryption and decryption over a tree of folders")
+    parser.add_argument('action', choices=['encrypt', 'decrypt'], help="Action to perform on every folder")
+    parser.add_argument('--input', '-i', required=True, help="Root of the input tree")
+    parser.add_argument('--output', '-o', required=True, help="Root of the output tree")
+    parser.add_argument('--state', help="Folder for the journal (default: <output>.bulk)")
+    parser.add_argument('--keys', help="Encryption state folder to read the keys from when decrypting "
+                                       "(default: <input>.bulk)")
+    parser.add_argument('--workers', '-w', type=int, default=os.cpu_count(),
+                        help="Folders processed at once (default: all CPUs)")
+    parser.add_argument('--format', choices=image_handler.OUTPUT_FORMATS, default='container',
+                        help="Ciphertext output per folder (default: container)")
+    parser.add_argument('--png-compression', type=int, default=image_handler.DEFAULT_COMPRESS_LEVEL,
+                        choices=range(10), metavar='0-9', help="PNG zlib level for output images (default: 6)")
+    parser.add_argument('--group-size', type=int, metavar='N',
+                        help="Encrypt each folder in groups of N images (sequence mode); the unit manifests go "
+                             "to the state folder")
+    parser.add_argument('--verify', choices=['sha256', 'size'], default='sha256',
+                        help="How outputs of finished jobs are checked before they are skipped (default: sha256)")
+    args = parser.parse_args()
+    if args.group_size is not None and args.group_size < 1:
+        parser.error("--group-size must be at least 1")
+
+    try:
+        failed = run_bulk(args.action, args.input, args.output, args.state, args.keys, args.workers,
+                          args.png_compression, args.format, args.group_size, args.verify)
+    except ValueError as error:
+        print(f"Error: {error}")
+        sys.exit(1)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
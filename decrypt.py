@@ -1,77 +1,154 @@
 import numpy as np
-from utils import image_handler
-from dna_operations import core
-
-from chaotic_maps.tdlcic import tdlcic_map
-
-
-
-def decrypt_images(input_folder, output_folder, K):
-    print("Step 1: Loading encrypted images and regenerating keys...")
-    images, paths = image_handler.load_images(input_folder)
-    P_end, original_shapes, channel_map = image_handler.preprocess_images(images)
-    M, N, n = P_end.shape
-    sum_pixels = M * N
-
-    k = np.array([int(K[i:i+8], 16) for i in range(0, 128, 8)]) / 256.0
-    a, b, x0, y0 = 2 + np.sum(k[0:4]), 2 + np.sum(k[4:8]), np.sum(k[8:12]) % 1, np.sum(k[12:16]) % 1
-
-    print("Step 2: Regenerating chaotic sequences...")
-    num_iterations = (sum_pixels * n // 2) + 1000
-    x, y = tdlcic_map(x0, y0, a, b, num_iterations)
-
-    x, y = x[1000:], y[1000:]
-    xy = np.concatenate((x, y))[:sum_pixels * n]
-    C_matrix = (np.floor(np.abs(xy) * 1e14).astype(np.uint64) % 8).reshape(M, N, n)
-    S = np.argsort(x[:sum_pixels])
-    G = np.argsort(xy.reshape(sum_pixels, n), axis=1)
-    E = (np.floor(np.abs(xy) * 1e14) % 256).astype(np.uint8).reshape(M, N, n)
-
-    print("Step 3: Preparing for inverse diffusion...")
-    P_dna4 = core.initial_encode_for_decryption(P_end, C_matrix)
-
-    print("Step 4: Performing Inverse Multi-Directional DNA Diffusion...")
-    E_dna = np.empty((M, N, 4 * n), dtype='<U1')
-    for i in range(M):
-        for j in range(N):
-            for k in range(n):
-                binary_E = format(E[i,j,k], '08b')
-                E_dna[i,j,4*k:4*k+4] = [core.DNA_RULES[0][binary_E[b:b+2]] for b in range(0,8,2)]
-
-    # Inverse Strand diffusion
-    P_dna3 = P_dna4.copy()
-    for i in range(M):
-        for j in range(N):
-            for z in range(4 * n - 1, 0, -1):
-                P_dna3[i, j, z] = core.DNA_XOR[P_dna4[i, j, z]][P_dna4[i, j, z - 1]]
-            P_dna3[i, j, 0] = core.DNA_XOR[P_dna4[i, j, 0]][P_dna3[i, j, -1]]
-
-    # Inverse Lateral diffusion
-    P_dna2 = P_dna3.copy()
-    for i in range(M - 1, -1, -1):
-        for j in range(N - 1, -1, -1):
-            for z in range(4 * n - 1, -1, -1):
-                if i == 0:
-                    P_dna2[i, j, z] = core.DNA_SUB[P_dna3[i, j, z]][E_dna[i, j, z]]
-                else:
-                    sub_val_1 = core.DNA_SUB[P_dna3[i, j, z]][E_dna[i, j, z]]
-                    P_dna2[i, j, z] = core.DNA_SUB[sub_val_1][P_dna2[i-1, j, z]]
-
-    print("Step 5: Performing Inverse Global Exchange Scrambling...")
-    P_dna1_flat = P_dna2.reshape(sum_pixels, 4 * n)
-    for i in range(sum_pixels - 1, -1, -1):
-        s_i = S[i]
-        if i == s_i: continue
-        for j in range(n):
-            g_ij = G[i, j]
-            temp_base = P_dna1_flat[i, j*4:j*4+4].copy()
-            P_dna1_flat[i, j*4:j*4+4] = P_dna1_flat[s_i, g_ij*4:g_ij*4+4]
-            P_dna1_flat[s_i, g_ij*4:g_ij*4+4] = temp_base
-    P_dna1 = P_dna1_flat.reshape(M, N, 4 * n)
-
-    print("Step 6: Performing Inverse DNA Cyclic Shift Encoding...")
-    P_decrypted = core.cyclic_shift_decode(P_dna1, C_matrix)
-
-    print(f"Step 7: Saving decrypted images to '{output_folder}'...")
-    image_handler.save_images(P_decrypted, output_folder, paths, original_shapes, channel_map)
-    print("Decryption complete.")
+import os
+from utils import batching, container, image_handler, key_material
+from utils.instrumentation import Instrumentation, PrintSink
+from dna_operations import core, diffusion
+from pipeline import fused, overlap
+from pipeline.parallel import ShardedExecutor
+
+
+def decrypt_tensor(P_end, K, workers=1, out=None, instrumentation=None, executor=None, staged=False, cache=True,
+                   work=None):
+    """Decrypt an (M, N, n) ciphertext tensor; see encrypt_tensor for the options."""
+    stage = (instrumentation or Instrumentation()).stage
+    nbytes = P_end.nbytes
+
+    with stage('keystream', "Step 2: Regenerating chaotic sequences...", nbytes):
+        material = key_material.get_key_material(K, P_end.shape, cache=cache)
+
+    if executor is not None or workers > 1:
+        with stage('dna', f"Steps 3-6: Running inverse DNA stages on "
+                          f"{executor.workers if executor else workers} workers...", nbytes):
+            if executor is not None:
+                return executor.decrypt(P_end, material, out)
+            with ShardedExecutor(workers) as executor:
+                return executor.decrypt(P_end, material, out)
+
+    if not staged:
+        with stage('dna', "Steps 3-6: Running fused inverse DNA stages...", nbytes):
+            return fused.decrypt(P_end, material, out, work)
+
+    with stage('encode', "Step 3: Preparing for inverse diffusion...", nbytes):
+        P_dna4 = core.initial_encode_for_decryption(P_end, material.C_matrix)
+
+    with stage('diffusion', "Step 4: Performing Inverse Multi-Directional DNA Diffusion...", nbytes):
+        E_dna = core.encode_with_rule(material.E)
+        P_dna3 = diffusion.inverse_strand_diffusion(P_dna4)
+        P_dna2 = diffusion.inverse_lateral_diffusion(P_dna3, E_dna)
+
+    with stage('scramble', "Step 5: Performing Inverse Global Exchange Scrambling...", nbytes):
+        P_dna1 = material.plan.undo(P_dna2)
+
+    with stage('decode', "Step 6: Performing Inverse DNA Cyclic Shift Encoding...", nbytes):
+        P_decrypted = core.cyclic_shift_decode(P_dna1, material.C_matrix, out)
+    return P_decrypted
+
+
+def decrypt_arrays(ciphertext, K, layout=None, workers=1, out=None, instrumentation=None, executor=None,
+                   staged=False, work=None):
+    """Decrypt in-memory ciphertext and return the list of plaintext images.
+
+    `ciphertext` is either the (M, N, n) tensor returned by encrypt_arrays,
+    together with its `layout`, or a list of ciphertext images (arrays or
+    encoded bytes). Images are cropped to the layout's original shapes; the
+    returned arrays are views into the decrypted tensor (`out` if given).
+    """
+    if isinstance(ciphertext, np.ndarray):
+        if layout is None:
+            raise ValueError("A ciphertext tensor needs the layout returned by encrypt_arrays.")
+        P_end = ciphertext
+    else:
+        images = [image_handler.decode_image(img) for img in ciphertext]
+        P_end, original_shapes, channel_map = image_handler.preprocess_images(images)
+        layout = layout or image_handler.make_layout(P_end.shape, original_shapes, channel_map)
+    P_decrypted = decrypt_tensor(P_end, K, workers, out, instrumentation, executor, staged, work=work)
+    return image_handler.split_images(P_decrypted, layout['original_shapes'], layout['channel_map'])
+
+
+def _load_unit(input_folder, unit, workers=None):
+    # A unit's container, or else its padded _processed.png files.
+    container_path = os.path.join(input_folder, unit['container'])
+    if os.path.exists(container_path):
+        return container.read_container(container_path)[0]
+    paths = [os.path.join(input_folder, f"{os.path.splitext(name)[0]}_processed.png") for name in unit['names']]
+    return image_handler.load_tensor(paths, workers)[0]
+
+
+def decrypt_images(input_folder, output_folder, K=None, workers=1, compress_level=image_handler.DEFAULT_COMPRESS_LEVEL,
+                   staged=False, instrumentation=None, manifest=None, executor=None, queue_depth=1, cache=True):
+    """Decrypt a folder with key `K`, or every unit listed in a batching `manifest` (a path or a loaded manifest).
+
+    `cache=False` skips the key-material cache, as in decrypt_tensor; units never use it.
+    """
+    instrumentation = instrumentation or Instrumentation([PrintSink()])
+    if manifest is not None:
+        if executor is None and workers > 1:
+            # One pool for every unit rather than one per unit.
+            with ShardedExecutor(workers) as executor:
+                _decrypt_units(input_folder, output_folder, manifest, workers, compress_level, staged,
+                               instrumentation, executor, queue_depth)
+            return
+        _decrypt_units(input_folder, output_folder, manifest, workers, compress_level, staged, instrumentation,
+                       executor, queue_depth)
+        return
+    if K is None:
+        raise ValueError("Decryption needs a key or a batching manifest.")
+
+    if executor is None and workers > 1:
+        with ShardedExecutor(workers) as executor:
+            return decrypt_images(input_folder, output_folder, K, workers, compress_level, staged, instrumentation,
+                                  executor=executor, cache=cache)
+
+    with instrumentation.stage('load', "Step 1: Loading encrypted images and regenerating keys...") as record:
+        P_end, original_shapes, channel_map, paths = image_handler.load_ciphertext(input_folder)
+        record['bytes'] = P_end.nbytes
+
+    # With an executor the plaintext is decoded straight into shared memory.
+    out = executor.empty(P_end.shape) if executor is not None else None
+    try:
+        P_decrypted = decrypt_tensor(P_end, K, workers, out, instrumentation=instrumentation, executor=executor,
+                                     staged=staged, cache=cache)
+        with instrumentation.stage('save', f"Step 7: Saving decrypted images to '{output_folder}'...",
+                                   P_decrypted.nbytes):
+            image_handler.save_images(P_decrypted, output_folder, paths, original_shapes, channel_map,
+                                      compress_level=compress_level)
+    finally:
+        if executor is not None:
+            executor.release(out)
+    instrumentation.note("Decryption complete.")
+    instrumentation.finish()
+
+
+def _decrypt_units(input_folder, output_folder, manifest, workers, compress_level, staged, instrumentation,
+                   executor=None, queue_depth=1):
+    # Units are independent, so they are loaded, decrypted and saved on an
+    # overlapped pipeline.
+    if isinstance(manifest, str):
+        manifest = batching.read_manifest(manifest)
+    units = manifest['units']
+
+    def load(index):
+        P_end = _load_unit(input_folder, units[index])
+        if list(P_end.shape) != units[index]['shape']:
+            raise ValueError(f"Unit {units[index]['container']} has shape {P_end.shape}, "
+                             f"the manifest says {units[index]['shape']}.")
+        return index, P_end
+
+    def decrypt(loaded):
+        index, P_end = loaded
+        return index, decrypt_tensor(P_end, units[index]['key'], workers, executor=executor, staged=staged,
+                                     cache=False)
+
+    def save(decrypted):
+        index, P_decrypted = decrypted
+        unit = units[index]
+        image_handler.save_images(P_decrypted, output_folder, unit['names'], unit['original_shapes'],
+                                  unit['channel_map'], compress_level=compress_level)
+        instrumentation.note(f"Unit {index + 1}/{len(units)}: {len(unit['names'])} images saved")
+
+    with instrumentation.stage('units', f"Decrypting {len(units)} unit(s) to '{output_folder}'...",
+                               sum(int(np.prod(unit['shape'])) for unit in units)) as record:
+        busy = overlap.run_stages(range(len(units)), load, decrypt, save, queue_depth)
+    instrumentation.note(overlap.format_busy(busy, record['seconds'], ('loading', 'decrypting', 'saving')))
+    instrumentation.note("Decryption complete.")
+    instrumentation.finish()
@@ -0,0 +1,252 @@
+"""
+Monte-Carlo Differential and Key-Sensitivity Analysis
+
+Runs many independent trials against one plaintext batch:
+1. plaintext     - flip the lowest bit of one random pixel of one image,
+                   re-encrypt (new plaintext-related key) and compare ciphertexts
+2. key_encrypt   - encrypt the batch with a one-bit-flipped key and compare
+                   against the real ciphertext
+3. key_decrypt   - decrypt the real ciphertext with a one-bit-flipped key and
+                   compare against the plaintext
+
+Each trial is fully determined by (seed, kind, trial index), so trials run on
+a process pool in any order. Finished trials are appended to
+<output>/trials.jsonl; rerunning the same study skips them, so a study can be
+interrupted and resumed. Running NPCR/UACI statistics with 95% confidence
+intervals are printed while trials complete and written to summary.json.
+"""
+
+import argparse
+import hashlib
+import json
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from decrypt import decrypt_tensor
+from encrypt import encrypt_tensor
+from pipeline import fused
+from security_analysis import THEORETICAL_NPCR, THEORETICAL_UACI, differential_metrics
+from utils import image_handler, journal, key_material
+
+KINDS = ('plaintext', 'key_encrypt', 'key_decrypt')
+METRICS = ('NPCR', 'UACI')
+Z_95 = 1.959964
+TRIALS_FILE = 'trials.jsonl'
+STUDY_FILE = 'study.json'
+SUMMARY_FILE = 'summary.json'
+
+
+class RunningStats:
+    """Welford mean/variance with a normal-approximation confidence interval."""
+
+    def __init__(self):
+        self.count, self.mean, self._m2 = 0, 0.0, 0.0
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+
+    @property
+    def std(self):
+        return math.sqrt(self._m2 / (self.count - 1)) if self.count > 1 else 0.0
+
+    @property
+    def ci95(self):
+        return Z_95 * self.std / math.sqrt(self.count) if self.count > 1 else float('nan')
+
+    def to_dict(self):
+        return {'count': self.count, 'mean': self.mean, 'std': self.std, 'ci95': self.ci95}
+
+
+def flip_key_bit(K, bit):
+    return format(int(K, 16) ^ (1 << bit), '0128x')
+
+
+def _planes(images):
+    return [np.moveaxis(np.atleast_3d(img), -1, 0) for img in images]
+
+
+# Per-process study state, set once by _init_worker.
+_state = {}
+
+def _init_worker(input_folder):
+    P, original_shapes, channel_map = image_handler.load_tensor(image_handler.list_images(input_folder))
+    C, K = encrypt_tensor(P, cache=False)
+    _state.update(P=P, C=C, K=K, original_shapes=original_shapes, channel_map=channel_map)
+
+
+def _compare(a, b, crop):
+    # Per-image NPCR/UACI of two (M, N, n) tensors.
+    shapes, channel_map = _state['original_shapes'], _state['channel_map']
+    pairs = zip(_planes(image_handler.split_images(a, shapes, channel_map, crop)),
+                _planes(image_handler.split_images(b, shapes, channel_map, crop)))
+    return [{metric: result[metric] for metric in METRICS} for result in differential_metrics(list(pairs))]
+
+
+def run_trial(seed, kind, trial):
+    P, C, K = _state['P'], _state['C'], _state['K']
+    rng = np.random.default_rng([seed, KINDS.index(kind), trial])
+    record = {'kind': kind, 'trial': trial}
+    if kind == 'plaintext':
+        # Trials cycle through the images, so each gets the same share.
+        image = trial % len(_state['channel_map'])
+        h, w = _state['original_shapes'][image]
+        channel = image_handler.channel_offsets(_state['channel_map'])[image] + rng.integers(_state['channel_map'][image])
+        row, col = int(rng.integers(h)), int(rng.integers(w))
+        P_changed = P.copy()
+        P_changed[row, col, channel] ^= 1
+        C_changed, _ = encrypt_tensor(P_changed, cache=False)
+        record.update(image=image, pixel=[row, col, int(channel)], images=_compare(C, C_changed, crop=False))
+    else:
+        bit = int(rng.integers(512))
+        K_changed = flip_key_bit(K, bit)
+        if kind == 'key_encrypt':
+            material = key_material.get_key_material(K_changed, P.shape, cache=False)
+            record.update(bit=bit, images=_compare(C, fused.encrypt(P, material), crop=False))
+        else:
+            record.update(bit=bit, images=_compare(P, decrypt_tensor(C, K_changed, cache=False), crop=True))
+    return record
+
+
+def _run_trial_task(task):
+    return run_trial(*task)
+
+
+def _study_config(input_folder, seed):
+    digest = hashlib.sha256()
+    for path in image_handler.list_images(input_folder):
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return {'input': os.path.abspath(input_folder), 'input_sha256': digest.hexdigest(), 'seed': seed}
+
+
+def load_trials(output_folder):
+    """Completed trial records; a line cut short by an interruption is ignored."""
+    return journal.read_records(os.path.join(output_folder, TRIALS_FILE))
+
+
+class Study:
+    """Running statistics per (kind, image) and over all images of a kind."""
+
+    def __init__(self, names):
+        self.names = names
+        self.stats = {}
+
+    def add(self, record):
+        for image, metrics in enumerate(record['images']):
+            for scope in (image, 'all'):
+                for metric in METRICS:
+                    key = (record['kind'], scope, metric)
+                    self.stats.setdefault(key, RunningStats()).add(metrics[metric])
+
+    def summary(self):
+        summary = {}
+        for (kind, scope, metric), stats in sorted(self.stats.items(), key=lambda item: str(item[0])):
+            name = 'all' if scope == 'all' else self.names[scope]
+            summary.setdefault(kind, {}).setdefault(name, {})[metric] = stats.to_dict()
+        return summary
+
+    def format_line(self, kind):
+        parts = []
+        for metric in METRICS:
+            stats = self.stats.get((kind, 'all', metric))
+            if stats:
+                parts.append(f"{metric} {stats.mean:.4f}% ± {stats.ci95:.4f}")
+        count = self.stats[(kind, 'all', 'NPCR')].count if (kind, 'all', 'NPCR') in self.stats else 0
+        return f"  {kind:<12} n={count:<6} " + "  ".join(parts)
+
+
+def run_study(input_folder, output_folder, trials, kinds=KINDS, workers=1, seed=0, report_every=10):
+    os.makedirs(output_folder, exist_ok=True)
+    names = [os.path.basename(path) for path in image_handler.list_images(input_folder)]
+    config = _study_config(input_folder, seed)
+    study_path = os.path.join(output_folder, STUDY_FILE)
+    if os.path.exists(study_path):
+        with open(study_path) as f:
+            previous = json.load(f)
+        if (previous['input_sha256'], previous['seed']) != (config['input_sha256'], config['seed']):
+            raise ValueError(f"'{output_folder}' holds a study of other images or another seed; "
+                             f"use a new output folder.")
+    with open(study_path, 'w') as f:
+        json.dump(config, f, indent=2)
+
+    study = Study(names)
+    done = set()
+    for record in load_trials(output_folder):
+        if record['kind'] in kinds:
+            study.add(record)
+            done.add((record['kind'], record['trial']))
+    # Plaintext trials are counted per image.
+    counts = {kind: trials * len(names) if kind == 'plaintext' else trials for kind in kinds}
+    tasks = [(seed, kind, trial) for kind in kinds for trial in range(counts[kind]) if (kind, trial) not in done]
+    print(f"{len(done)} trials already done, {len(tasks)} to run on {workers} worker(s)")
+
+    completed = 0
+    with journal.Journal(os.path.join(output_folder, TRIALS_FILE)) as log:
+        def record_trial(record):
+            nonlocal completed
+            log.append(record)
+            study.add(record)
+            completed += 1
+            if completed % report_every == 0 or completed == len(tasks):
+                print(f"[{completed}/{len(tasks)}]")
+                for kind in kinds:
+                    print(study.format_line(kind))
+
+        if workers <= 1:
+            _init_worker(input_folder)
+            for task in tasks:
+                record_trial(run_trial(*task))
+        else:
+            with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(input_folder,)) as pool:
+                futures = [pool.submit(_run_trial_task, task) for task in tasks]
+                try:
+                    for future in as_completed(futures):
+                        record_trial(future.result())
+                except KeyboardInterrupt:
+                    for future in futures:
+                        future.cancel()
+                    raise
+
+    summary = study.summary()
+    with open(os.path.join(output_folder, SUMMARY_FILE), 'w') as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+
+def print_summary(summary):
+    print("\n" + "="*70)
+    print("MONTE-CARLO DIFFERENTIAL AND KEY-SENSITIVITY ANALYSIS")
+    print("="*70)
+    print(f"Theoretical NPCR: {THEORETICAL_NPCR}%  UACI: {THEORETICAL_UACI}%  (mean ± 95% CI)")
+    for kind, images in summary.items():
+        print(f"\n{kind}")
+        for name, metrics in images.items():
+            parts = [f"{metric} {metrics[metric]['mean']:.4f}% ± {metrics[metric]['ci95']:.4f}" for metric in METRICS]
+            print(f"  {name:<20} n={metrics['NPCR']['count']:<6} " + "  ".join(parts))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Monte-Carlo differential and key-sensitivity analysis")
+    parser.add_argument('--input', '-i', default='./test_images', help="Plaintext image folder (default: ./test_images)")
+    parser.add_argument('--output', '-o', default='./differential_study',
+                        help="Study folder; rerun with the same folder to resume (default: ./differential_study)")
+    parser.add_argument('--trials', '-t', type=int, default=100,
+                        help="Trials per image for 'plaintext', and per kind for the key trials (default: 100)")
+    parser.add_argument('--kinds', nargs='+', choices=KINDS, default=list(KINDS), help="Trial kinds to run")
+    parser.add_argument('--workers', '-w', type=int, default=os.cpu_count(), help="Worker processes (default: all CPUs)")
+    parser.add_argument('--seed', type=int, default=0, help="Study seed (default: 0)")
+    parser.add_argument('--report-every', type=int, default=10, help="Print running statistics every N trials")
+    args = parser.parse_args()
+
+    summary = run_study(args.input, args.output, args.trials, args.kinds, args.workers, args.seed, args.report_every)
+    print_summary(summary)
+
+
+if __name__ == "__main__":
+    main()
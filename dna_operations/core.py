@@ -32,38 +32,120 @@ DNA_XOR = {
     'T': {'A': 'T', 'G': 'C', 'C': 'G', 'T': 'A'}
 }
 
+# Integer-coded bases: every nucleotide is stored as a 2-bit code in a uint8
+# array, using the bit pattern rule 0 assigns to it (A=00, C=01, G=10, T=11).
+BASES = np.array(['A', 'C', 'G', 'T'])
+BASE_CODES = {base: code for code, base in enumerate(BASES)}
+
+
+def _operation_table(operation):
+    table = np.empty((4, 4), dtype=np.uint8)
+    for a, row in operation.items():
+        for b, result in row.items():
+            table[BASE_CODES[a], BASE_CODES[b]] = BASE_CODES[result]
+    return table
+
+ADD_TABLE = _operation_table(DNA_ADD)
+SUB_TABLE = _operation_table(DNA_SUB)
+XOR_TABLE = _operation_table(DNA_XOR)
+
+# Flattened views for whole-array lookups: table[(a << 2) | b].
+_ADD_FLAT, _SUB_FLAT, _XOR_FLAT = ADD_TABLE.ravel(), SUB_TABLE.ravel(), XOR_TABLE.ravel()
+
+def dna_add(a, b):
+    return _ADD_FLAT.take((a << 2) | b)
+
+def dna_sub(a, b):
+    return _SUB_FLAT.take((a << 2) | b)
+
+def dna_xor(a, b):
+    return _XOR_FLAT.take((a << 2) | b)
+
+
+def _encoding_tables():
+    # ENCODE_TABLE[rule, shift, value] holds the four base codes of `value`
+    # rotated left by `shift` bits and encoded with `rule`. DECODE_TABLE is
+    # its inverse, indexed by the four codes packed into one byte.
+    encode = np.empty((8, 8, 256, 4), dtype=np.uint8)
+    decode = np.empty((8, 8, 256), dtype=np.uint8)
+    for rule_idx, rule in DNA_RULES.items():
+        for shift in range(8):
+            for value in range(256):
+                binary_val = format(value, '08b')
+                shifted_binary = binary_val[shift:] + binary_val[:shift]
+                codes = [BASE_CODES[rule[shifted_binary[b:b+2]]] for b in range(0, 8, 2)]
+                encode[rule_idx, shift, value] = codes
+                decode[rule_idx, shift, (codes[0] << 6) | (codes[1] << 4) | (codes[2] << 2) | codes[3]] = value
+    return encode, decode
+
+ENCODE_TABLE, DECODE_TABLE = _encoding_tables()
+
+
+def pack_bases(dna_matrix):
+    quads = dna_matrix.reshape(dna_matrix.shape[:-1] + (-1, 4))
+    return (quads[..., 0] << 6) | (quads[..., 1] << 4) | (quads[..., 2] << 2) | quads[..., 3]
+
+def encode_with_rule(pixel_matrix, rule_idx=0, shift=0):
+    M, N, n = pixel_matrix.shape
+    return ENCODE_TABLE[rule_idx, shift][pixel_matrix].reshape(M, N, 4 * n)
+
+def to_letters(dna_matrix):
+    return BASES[dna_matrix]
+
+def from_letters(letter_matrix):
+    return np.searchsorted(BASES, letter_matrix).astype(np.uint8)
+
 def cyclic_shift_encode(pixel_matrix, C_matrix):
     M, N, n = pixel_matrix.shape
-    dna_matrix = np.empty((M, N, 4 * n), dtype='<U1')
-    for i in range(M):
-        for j in range(N):
-            for k in range(n):
-                pixel_val = pixel_matrix[i, j, k]
-                binary_val = format(pixel_val, '08b')
-                shift = int(C_matrix[i, j, k]) % 8
-                rule_idx = int(C_matrix[i, j, k]) % 8
-                shifted_binary = binary_val[shift:] + binary_val[:shift]
-                encoded_dna = "".join([DNA_RULES[rule_idx][shifted_binary[b:b+2]] for b in range(0, 8, 2)])
-                dna_matrix[i, j, 4*k : 4*(k+1)] = list(encoded_dna)
-    return dna_matrix
-
-def cyclic_shift_decode(dna_matrix, C_matrix):
-    M, N, total = dna_matrix.shape
-    n = total // 4
-    pixel_matrix = np.empty((M, N, n), dtype=np.uint8)
-    for i in range(M):
-        for j in range(N):
-            for k in range(n):
-                rule_idx = int(C_matrix[i, j, k]) % 8
-                encoded_dna = "".join(dna_matrix[i, j, 4*k : 4*(k+1)])
-                binary_str = "".join([DNA_INVERSE_RULES[rule_idx][base] for base in encoded_dna])
-                shift = int(C_matrix[i, j, k]) % 8
-                binary_val = binary_str[-shift:] + binary_str[:-shift] if shift else binary_str
-                pixel_matrix[i, j, k] = int(binary_val, 2)
-    return pixel_matrix
-
-def final_decode_to_pixels(dna_matrix, C_matrix):
-    return cyclic_shift_decode(dna_matrix, C_matrix)
+    # The same key value selects both the cyclic shift and the encoding rule.
+    rule_idx = np.asarray(C_matrix % 8, dtype=np.intp)
+    return ENCODE_TABLE[rule_idx, rule_idx, pixel_matrix].reshape(M, N, 4 * n)
+
+def cyclic_shift_decode(dna_matrix, C_matrix, out=None):
+    if out is not None:
+        # The same lookup as below, written into `out`.
+        return packed_decode(pack_bases(dna_matrix), C_matrix, out=out)
+    rule_idx = np.asarray(C_matrix % 8, dtype=np.intp)
+    return DECODE_TABLE[rule_idx, rule_idx, pack_bases(dna_matrix)]
+
+def final_decode_to_pixels(dna_matrix, C_matrix, out=None):
+    return cyclic_shift_decode(dna_matrix, C_matrix, out)
 
 def initial_encode_for_decryption(pixel_matrix, C_matrix):
     return cyclic_shift_encode(pixel_matrix, C_matrix)
+
+
+# Packed bases: the four bases of one (pixel, channel) value held in a single
+# byte, most significant pair first, as pack_bases produces. Every DNA stage
+# treats such a block as a unit or works base-wise, so the whole pipeline can
+# run on M*N*n bytes instead of 4*M*N*n. Rule 0 without a shift maps each
+# value onto its own bits, so a key matrix is already its packed encoding.
+_RULES = np.arange(8)
+PACKED_ENCODE_TABLE = pack_bases(ENCODE_TABLE[_RULES, _RULES])[..., 0]
+PACKED_DECODE_TABLE = DECODE_TABLE[_RULES, _RULES]
+
+def _packed_operation_table(table):
+    a, b = np.arange(256)[:, None], np.arange(256)[None, :]
+    packed = np.zeros((256, 256), dtype=np.uint8)
+    for shift in (0, 2, 4, 6):
+        packed |= table[(a >> shift) & 3, (b >> shift) & 3] << shift
+    return packed
+
+PACKED_ADD_TABLE = _packed_operation_table(ADD_TABLE)
+PACKED_SUB_TABLE = _packed_operation_table(SUB_TABLE)
+
+def _pair_index(high, low):
+    return (np.asarray(high, dtype=np.uint16) << 8) | low
+
+def packed_add(a, b, out=None):
+    return PACKED_ADD_TABLE.ravel().take(_pair_index(a, b), out=out)
+
+def packed_sub(a, b, out=None):
+    return PACKED_SUB_TABLE.ravel().take(_pair_index(a, b), out=out)
+
+def packed_encode(pixel_matrix, C_matrix, out=None):
+    # cyclic_shift_encode followed by pack_bases, in one lookup.
+    return PACKED_ENCODE_TABLE.ravel().take(_pair_index(C_matrix % 8, pixel_matrix), out=out)
+
+def packed_decode(packed_matrix, C_matrix, out=None):
+    return PACKED_DECODE_TABLE.ravel().take(_pair_index(C_matrix % 8, packed_matrix), out=out)
@@ -0,0 +1,83 @@
+import numpy as np
+from dna_operations import core
+
+
+def lateral_diffusion(P_dna2, E_dna, previous_row=None):
+    # Row i only depends on the diffused row i-1, so each step handles a
+    # whole (N, 4n) row. `previous_row` carries the last diffused row of the
+    # preceding block when the tensor is processed in row-blocks.
+    P_dna3 = np.empty_like(P_dna2)
+    for i in range(P_dna2.shape[0]):
+        if previous_row is None:
+            P_dna3[i] = core.dna_add(P_dna2[i], E_dna[i])
+        else:
+            P_dna3[i] = core.dna_add(core.dna_add(P_dna2[i], previous_row), E_dna[i])
+        previous_row = P_dna3[i]
+    return P_dna3
+
+def inverse_lateral_diffusion(P_dna3, E_dna, previous_row=None):
+    # Every row is recovered from the diffused rows alone, so the whole
+    # tensor is undone at once.
+    P_dna2 = core.dna_sub(P_dna3, E_dna)
+    P_dna2[1:] = core.dna_sub(P_dna2[1:], P_dna3[:-1])
+    if previous_row is not None:
+        P_dna2[0] = core.dna_sub(P_dna2[0], previous_row)
+    return P_dna2
+
+def strand_diffusion(P_dna3):
+    # DNA XOR is bitwise XOR on the base codes, so the running chain along
+    # z is a prefix XOR seeded with the last base of each pixel.
+    P_dna4 = np.bitwise_xor.accumulate(P_dna3, axis=-1)
+    P_dna4 ^= P_dna3[..., -1:]
+    return P_dna4
+
+def inverse_strand_diffusion(P_dna4):
+    P_dna3 = np.empty_like(P_dna4)
+    np.bitwise_xor(P_dna4[..., 1:], P_dna4[..., :-1], out=P_dna3[..., 1:])
+    np.bitwise_xor(P_dna4[..., 0], P_dna3[..., -1], out=P_dna3[..., 0])
+    return P_dna3
+
+
+# Packed-base forms (see core.PACKED_ENCODE_TABLE): one byte per 4-base
+# block. `E` is passed as-is, since it is its own rule-0 packed encoding.
+
+def packed_lateral_diffusion(packed, E, previous_row=None):
+    # In place: row i becomes (row i + diffused row i-1) + E row i.
+    for i in range(packed.shape[0]):
+        if previous_row is not None:
+            core.packed_add(packed[i], previous_row, out=packed[i])
+        core.packed_add(packed[i], E[i], out=packed[i])
+        previous_row = packed[i]
+    return packed
+
+def packed_inverse_lateral_diffusion(packed, E, out, previous_row=None):
+    # Not in place: every row needs the diffused row above it.
+    core.packed_sub(packed, E, out=out)
+    core.packed_sub(out[1:], packed[:-1], out=out[1:])
+    if previous_row is not None:
+        core.packed_sub(out[0], previous_row, out=out[0])
+    return out
+
+def packed_strand_diffusion(packed):
+    # In place. Within a byte, b ^ b>>2 ^ (..)>>4 is the prefix XOR of its
+    # four bases; the chain carried in from earlier bytes and the seed (the
+    # pixel's last base) are then XORed into all four lanes at once.
+    seed = packed[..., -1:] & 3
+    packed ^= packed >> 2
+    packed ^= packed >> 4
+    carry = np.bitwise_xor.accumulate(packed & 3, axis=-1)
+    carry[..., 1:] = carry[..., :-1] ^ seed
+    carry[..., :1] = seed
+    carry *= 0x55
+    packed ^= carry
+    return packed
+
+def packed_inverse_strand_diffusion(packed):
+    # In place: every base XOR the base before it, the first one XOR the
+    # recovered last base.
+    previous = np.empty_like(packed)
+    previous[..., 1:] = (packed[..., :-1] & 3) << 6
+    previous[..., :1] = 0
+    packed ^= (packed >> 2) ^ previous
+    packed[..., :1] ^= (packed[..., -1:] & 3) << 6
+    return packed
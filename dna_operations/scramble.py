@@ -0,0 +1,83 @@
+import numpy as np
+
+
+class ScramblePlan:
+    """Global Exchange Scrambling composed into a single gather.
+
+    The swap sequence only depends on the key-derived `S` and `G` arrays, so
+    it is folded once into `index`, where block `b` of the scrambled tensor
+    is block `index[b]` of the input. A block is the 4 bases of one
+    (pixel, channel) value.
+    """
+
+    def __init__(self, index):
+        self.index = np.asarray(index, dtype=np.intp)
+
+    @classmethod
+    def from_sequences(cls, S, G, index=None):
+        # `index` optionally supplies the (sum_pixels * n,) output buffer,
+        # e.g. a memory-mapped scratch file.
+        sum_pixels, n = G.shape
+        if index is None:
+            index = np.arange(sum_pixels * n, dtype=np.intp)
+        else:
+            for start in range(0, sum_pixels * n, 1 << 20):
+                stop = min(start + (1 << 20), sum_pixels * n)
+                index[start:stop] = np.arange(start, stop, dtype=np.intp)
+        index = index.reshape(sum_pixels, n)
+        for i in range(sum_pixels):
+            s_i = S[i]
+            if i == s_i: continue
+            # The n swaps of step i touch disjoint blocks (G[i] is a
+            # permutation and s_i != i), so they can be done together.
+            g_i = G[i]
+            temp_blocks = index[i].copy()
+            index[i] = index[s_i, g_i]
+            index[s_i, g_i] = temp_blocks
+        return cls(index.ravel())
+
+    def inverse(self, out=None, block_size=None):
+        inverse_index = np.empty_like(self.index) if out is None else out
+        block_size = block_size or self.index.size
+        for start in range(0, self.index.size, block_size):
+            stop = min(start + block_size, self.index.size)
+            inverse_index[self.index[start:stop]] = np.arange(start, stop, dtype=np.intp)
+        return ScramblePlan(inverse_index)
+
+    def apply(self, dna_matrix, out=None):
+        blocks = dna_matrix.reshape(-1, 4)
+        if out is None:
+            return blocks[self.index].reshape(dna_matrix.shape)
+        np.take(blocks, self.index, axis=0, out=out.reshape(-1, 4))
+        return out
+
+    def apply_packed(self, packed_matrix, out=None):
+        # With packed bases a block is one byte, so the scramble is a byte gather.
+        if out is None:
+            return packed_matrix.reshape(-1)[self.index].reshape(packed_matrix.shape)
+        np.take(packed_matrix.reshape(-1), self.index, out=out.reshape(-1))
+        return out
+
+    # The inverse of apply is a scatter through the same index, which needs
+    # no inverse index; `out` must be C-contiguous.
+
+    def undo(self, dna_matrix, out=None):
+        out = np.empty_like(dna_matrix) if out is None else out
+        out.reshape(-1, 4)[self.index] = dna_matrix.reshape(-1, 4)
+        return out
+
+    def undo_packed(self, packed_matrix, out=None):
+        out = np.empty_like(packed_matrix) if out is None else out
+        out.reshape(-1)[self.index] = packed_matrix.reshape(-1)
+        return out
+
+    def gather(self, dna_matrix, start, stop):
+        # Blocks [start, stop) of the scrambled tensor, as a (stop - start, 4) array.
+        return dna_matrix.reshape(-1, 4)[self.index[start:stop]]
+
+    def save(self, path):
+        np.save(path, self.index)
+
+    @classmethod
+    def load(cls, path, mmap_mode=None):
+        return cls(np.load(path, mmap_mode=mmap_mode))
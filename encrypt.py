@@ -1,84 +1,205 @@
 import numpy as np
-import hashlib
-from utils import image_handler
-from dna_operations import core
+import os
+from utils import batching, image_handler, journal, key_material
+from utils.instrumentation import Instrumentation, PrintSink
+from dna_operations import core, diffusion
+from pipeline import fused, overlap
+from pipeline.parallel import ShardedExecutor
 
-from chaotic_maps.tdlcic import tdlcic_map
 
+def encrypt_tensor(P, workers=1, out=None, instrumentation=None, executor=None, staged=False, cache=True, work=None):
+    """Encrypt a preprocessed (M, N, n) uint8 tensor and return (P_end, K).
 
+    `out` is an optional (M, N, n) uint8 buffer that receives the ciphertext,
+    `work` another one the fused kernel uses as scratch (so a long-running
+    process can reuse both allocations), `instrumentation` an optional
+    Instrumentation that records every stage, and `executor` a warm ShardedExecutor to reuse instead of starting a pool
+    for `workers` > 1. On a single worker the fused kernel runs unless
+    `staged` asks for the step-by-step path, which keeps every intermediate
+    for debugging. `cache=False` skips the key-material cache (see
+    key_material.get_key_material).
+    """
+    stage = (instrumentation or Instrumentation()).stage
+    nbytes = P.nbytes
 
+    with stage('key', "Step 2: Generating plaintext-related key...", nbytes):
+        K = key_material.plaintext_key(P)
 
-def encrypt_images(input_folder, output_folder):
-    print("Step 1: Loading and preprocessing images...")
-    images, paths = image_handler.load_images(input_folder)
+    with stage('keystream', "Step 3: Generating chaotic sequences...", nbytes):
+        material = key_material.get_key_material(K, P.shape, cache=cache)
+
+    if executor is not None or workers > 1:
+        with stage('dna', f"Steps 4-7: Running DNA encoding, scrambling, diffusion and decoding on "
+                          f"{executor.workers if executor else workers} workers...", nbytes):
+            if executor is not None:
+                return executor.encrypt(P, material, out), K
+            with ShardedExecutor(workers) as executor:
+                return executor.encrypt(P, material, out), K
+
+    if not staged:
+        with stage('dna', "Steps 4-7: Running fused DNA encoding, scrambling, diffusion and decoding...", nbytes):
+            return fused.encrypt(P, material, out, work), K
+
+    with stage('encode', "Step 4: Performing DNA Cyclic Shift Encoding...", nbytes):
+        P_dna1 = core.cyclic_shift_encode(P, material.C_matrix)
+
+    with stage('scramble', "Step 5: Performing Global Exchange Scrambling...", nbytes):
+        P_dna2 = material.plan.apply(P_dna1)
+
+    with stage('diffusion', "Step 6: Performing Multi-Directional DNA Diffusion...", nbytes):
+        E_dna = core.encode_with_rule(material.E)
+        P_dna3 = diffusion.lateral_diffusion(P_dna2, E_dna)
+        P_dna4 = diffusion.strand_diffusion(P_dna3)
+
+    with stage('decode', "Step 7: Final decoding to pixels...", nbytes):
+        P_end = core.final_decode_to_pixels(P_dna4, material.C_matrix, out)
+    return P_end, K
+
+
+def encrypt_arrays(images, names=None, workers=1, out=None, instrumentation=None, executor=None, staged=False,
+                   work=None):
+    """Encrypt a batch of in-memory images.
+
+    `images` holds uint8 arrays ((H, W) grayscale or (H, W, 3) colour) and/or
+    encoded image bytes. Returns (ciphertext, K, layout): the padded
+    (M, N, n) ciphertext tensor, the 128-character hex key and the layout
+    decrypt_arrays needs to split and crop the result again.
+    """
+    images = [image_handler.decode_image(img) for img in images]
     P, original_shapes, channel_map = image_handler.preprocess_images(images)
-    M, N, n = P.shape
-    sum_pixels = M * N
-
-    print("Step 2: Generating plaintext-related key...")
-    stitched_img = image_handler.stitch_images_for_key(P)
-    K = hashlib.sha512(stitched_img.tobytes()).hexdigest()
-    k = np.array([int(K[i:i+8], 16) for i in range(0, 128, 8)]) / 256.0
-    a, b, x0, y0 = 2 + np.sum(k[0:4]), 2 + np.sum(k[4:8]), np.sum(k[8:12]) % 1, np.sum(k[12:16]) % 1
-
-    print("Step 3: Generating chaotic sequences...")
-    num_iterations = (sum_pixels * n // 2) + 1000
-   
-    x, y = tdlcic_map(x0, y0, a, b, num_iterations)
-
-    x, y = x[1000:], y[1000:]
-    xy = np.concatenate((x, y))[:sum_pixels * n]
-    C_matrix = (np.floor(np.abs(xy) * 1e14).astype(np.uint64) % 8).reshape(M, N, n)
-
-    print("Step 4: Performing DNA Cyclic Shift Encoding...")
-    P_dna1 = core.cyclic_shift_encode(P, C_matrix)
-
-    print("Step 5: Performing Global Exchange Scrambling...")
-    S = np.argsort(x[:sum_pixels])
-    G = np.argsort(xy.reshape(sum_pixels, n), axis=1)
-    P_dna2_flat = P_dna1.copy().reshape(sum_pixels, 4 * n)
-    for i in range(sum_pixels):
-        s_i = S[i]
-        if i == s_i: continue
-        for j in range(n):
-            g_ij = G[i, j]
-            temp_base = P_dna2_flat[i, j*4:j*4+4].copy()
-            P_dna2_flat[i, j*4:j*4+4] = P_dna2_flat[s_i, g_ij*4:g_ij*4+4]
-            P_dna2_flat[s_i, g_ij*4:g_ij*4+4] = temp_base
-    P_dna2 = P_dna2_flat.reshape(M, N, 4 * n)
-
-    print("Step 6: Performing Multi-Directional DNA Diffusion...")
-    E = (np.floor(np.abs(xy) * 1e14) % 256).astype(np.uint8).reshape(M, N, n)
-    E_dna = np.empty((M, N, 4 * n), dtype='<U1')
-    for i in range(M):
-        for j in range(N):
-            for k in range(n):
-                binary_E = format(E[i,j,k], '08b')
-                E_dna[i,j,4*k:4*k+4] = [core.DNA_RULES[0][binary_E[b:b+2]] for b in range(0,8,2)]
-
-    # Lateral diffusion
-    P_dna3 = P_dna2.copy()
-    for i in range(M):
-        for j in range(N):
-            for z in range(4 * n):
-                if i == 0:
-                    P_dna3[i, j, z] = core.DNA_ADD[P_dna2[i, j, z]][E_dna[i, j, z]]
-                else:
-                    add_val = core.DNA_ADD[P_dna2[i, j, z]][P_dna3[i-1, j, z]]
-                    P_dna3[i, j, z] = core.DNA_ADD[add_val][E_dna[i, j, z]]
-
-    # Strand diffusion
-    P_dna4 = P_dna3.copy()
-    for i in range(M):
-        for j in range(N):
-            P_dna4[i, j, 0] = core.DNA_XOR[P_dna3[i, j, 0]][P_dna3[i, j, -1]]
-            for z in range(1, 4 * n):
-                P_dna4[i, j, z] = core.DNA_XOR[P_dna3[i, j, z]][P_dna4[i, j, z-1]]
-
-    print("Step 7: Final decoding to pixels...")
-    P_end = core.final_decode_to_pixels(P_dna4, C_matrix)
-
-    print(f"Step 8: Saving encrypted images to '{output_folder}'...")
-    image_handler.save_images(P_end, output_folder, paths, original_shapes, channel_map, preserve_padding=True)
-    print("Encryption complete.")
+    P_end, K = encrypt_tensor(P, workers, out, instrumentation, executor, staged, work=work)
+    return P_end, K, image_handler.make_layout(P_end.shape, original_shapes, channel_map, names)
+
+
+def encrypt_images(input_folder, output_folder, workers=1, compress_level=image_handler.DEFAULT_COMPRESS_LEVEL,
+                   output_format='container', staged=False, instrumentation=None, executor=None, cache=True):
+    instrumentation = instrumentation or Instrumentation([PrintSink()])
+    if executor is None and workers > 1:
+        with ShardedExecutor(workers) as executor:
+            return encrypt_images(input_folder, output_folder, workers, compress_level, output_format, staged,
+                                  instrumentation, executor, cache)
+
+    with instrumentation.stage('load', "Step 1: Loading and preprocessing images...") as record:
+        paths = image_handler.list_images(input_folder)
+        if executor is None:
+            P, original_shapes, channel_map = image_handler.load_tensor(paths)
+        else:
+            # Decoded straight into shared memory, where the workers read it.
+            shape, original_shapes, channel_map = image_handler.read_layout(paths)
+            P = image_handler.load_into(paths, executor.empty(shape), channel_map)
+        record['bytes'] = P.nbytes
+
+    out = executor.empty(P.shape) if executor is not None else None
+    try:
+        P_end, K = encrypt_tensor(P, workers, out, instrumentation=instrumentation, executor=executor, staged=staged,
+                                  cache=cache)
+        with instrumentation.stage('save', f"Step 8: Saving encrypted images to '{output_folder}'...",
+                                   P_end.nbytes):
+            image_handler.save_ciphertext(P_end, output_folder, paths, original_shapes, channel_map, output_format,
+                                          compress_level)
+    finally:
+        if executor is not None:
+            executor.release(P, out)
+    instrumentation.note("Encryption complete.")
+    instrumentation.finish()
     return K
+
+
+def _encrypt_units(paths, groups, output_folder, manifest_path, workers, compress_level, output_format, staged,
+                   instrumentation, executor, queue_depth, **manifest_fields):
+    # Every group of paths becomes a unit with its own key. Units are loaded,
+    # encrypted and saved on an overlapped pipeline. Each saved unit is
+    # appended to a journal next to the manifest, which is written once at
+    # the end; until then the journal holds the keys.
+    units = []
+    journal_path = batching.manifest_journal_path(manifest_path)
+    if os.path.exists(journal_path):
+        os.remove(journal_path)
+
+    def load(index):
+        unit_paths = [paths[i] for i in groups[index]]
+        return (index, unit_paths) + image_handler.load_tensor(unit_paths)
+
+    def encrypt(loaded):
+        index, unit_paths, P, original_shapes, channel_map = loaded
+        P_end, K = encrypt_tensor(P, workers, executor=executor, staged=staged, cache=False)
+        return index, unit_paths, P_end, K, original_shapes, channel_map
+
+    def save(encrypted):
+        index, unit_paths, P_end, K, original_shapes, channel_map = encrypted
+        unit = batching.make_unit(index, K, P_end.shape, unit_paths, original_shapes, channel_map)
+        image_handler.save_ciphertext(P_end, output_folder, unit_paths, original_shapes, channel_map, output_format,
+                                      compress_level, container_name=unit['container'])
+        units.append(unit)
+        unit_journal.append(unit)
+        instrumentation.note(f"Unit {index + 1}/{len(groups)}: {len(unit_paths)} images as a "
+                             f"{'x'.join(map(str, P_end.shape))} tensor ({unit['padding_waste']:.0%} padding) saved")
+
+    with instrumentation.stage('units', f"Encrypting {len(paths)} images as {len(groups)} unit(s)...") as record:
+        with journal.Journal(journal_path) as unit_journal:
+            unit_journal.append(batching.manifest_header(**manifest_fields))
+            busy = overlap.run_stages(range(len(groups)), load, encrypt, save, queue_depth)
+        record['bytes'] = sum(int(np.prod(unit['shape'])) for unit in units)
+    batching.write_manifest(manifest_path, units, **manifest_fields)
+    os.remove(journal_path)
+    instrumentation.note(overlap.format_busy(busy, record['seconds'], ('loading', 'encrypting', 'saving')))
+    instrumentation.note(f"Manifest with the unit keys written to '{manifest_path}'.")
+    instrumentation.note("Encryption complete.")
+    instrumentation.finish()
+    return batching.read_manifest(manifest_path)
+
+
+def encrypt_images_bucketed(input_folder, output_folder, max_waste=batching.DEFAULT_MAX_WASTE, manifest_path=None,
+                            workers=1, compress_level=image_handler.DEFAULT_COMPRESS_LEVEL,
+                            output_format='container', staged=False, instrumentation=None, executor=None,
+                            queue_depth=1):
+    """Encrypt size buckets of the folder as separate units, each with its own key.
+
+    The unit keys and groupings go to a manifest at `manifest_path` (by
+    default next to, not inside, `output_folder`), which decrypt_images
+    consumes. Returns the manifest.
+    """
+    instrumentation = instrumentation or Instrumentation([PrintSink()])
+    if executor is None and workers > 1:
+        # One pool for every unit rather than one per unit.
+        with ShardedExecutor(workers) as executor:
+            return encrypt_images_bucketed(input_folder, output_folder, max_waste, manifest_path, workers,
+                                           compress_level, output_format, staged, instrumentation, executor,
+                                           queue_depth)
+    manifest_path = manifest_path or batching.default_manifest_path(output_folder)
+
+    paths = image_handler.list_images(input_folder)
+    _, shapes, channel_map = image_handler.read_layout(paths)
+    buckets = batching.plan_buckets([shapes[i] for i in range(len(paths))], channel_map, max_waste,
+                                    [os.path.basename(path) for path in paths])
+    instrumentation.note(f"Planned {len(buckets)} unit(s) for {len(paths)} images "
+                         f"(padding {batching.padding_waste(list(shapes.values()), channel_map):.0%} as one batch)")
+    return _encrypt_units(paths, buckets, output_folder, manifest_path, workers, compress_level, output_format, staged,
+                          instrumentation, executor, queue_depth, max_waste=max_waste)
+
+
+def encrypt_images_sequence(input_folder, output_folder, group_size=batching.DEFAULT_GROUP_SIZE, manifest_path=None,
+                            workers=1, compress_level=image_handler.DEFAULT_COMPRESS_LEVEL,
+                            output_format='container', staged=False, instrumentation=None, executor=None,
+                            queue_depth=1):
+    """Encrypt a folder of frames as consecutive groups of `group_size`, each its own unit.
+
+    Unlike encrypt_images, memory stays flat however many frames there are:
+    only the groups in flight through the overlapped load/encrypt/save
+    pipeline are held. The manifest is the same as encrypt_images_bucketed
+    writes. Returns the manifest.
+    """
+    instrumentation = instrumentation or Instrumentation([PrintSink()])
+    if executor is None and workers > 1:
+        with ShardedExecutor(workers) as executor:
+            return encrypt_images_sequence(input_folder, output_folder, group_size, manifest_path, workers,
+                                           compress_level, output_format, staged, instrumentation, executor,
+                                           queue_depth)
+    manifest_path = manifest_path or batching.default_manifest_path(output_folder)
+
+    paths = image_handler.list_images(input_folder)
+    _, shapes, channel_map = image_handler.read_layout(paths)
+    groups = batching.plan_groups([shapes[i] for i in range(len(paths))], channel_map, group_size,
+                                  [os.path.basename(path) for path in paths])
+    return _encrypt_units(paths, groups, output_folder, manifest_path, workers, compress_level, output_format, staged,
+                          instrumentation, executor, queue_depth, group_size=group_size)
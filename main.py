@@ -1,33 +1,203 @@
 import argparse
-from encrypt import encrypt_images
-from decrypt import decrypt_images
+import json
+import sys
+from pipeline.client import DEFAULT_QUEUE_SIZE, DaemonClient, default_socket_path, format_jobs
 
 def main():
     parser = argparse.ArgumentParser(description="Multi-image encryption based on the paper by Zhou et al.")
-    parser.add_argument('action', choices=['encrypt', 'decrypt'], help="Action to perform: 'encrypt' or 'decrypt'")
-    parser.add_argument('--input', '-i', required=True, help="Path to the input folder containing images.")
-    parser.add_argument('--output', '-o', required=True, help="Path to the output folder.")
+    parser.add_argument('action', choices=['encrypt', 'decrypt', 'plan', 'serve', 'submit', 'status'],
+                        help="Action to perform: 'encrypt' or 'decrypt' in this process, 'plan' one without running "
+                             "it, 'serve' a warm daemon, 'submit' a job to it or show its 'status'")
+    parser.add_argument('job', nargs='?', choices=['encrypt', 'decrypt'], help="Job to 'submit' or 'plan'.")
+    parser.add_argument('--input', '-i', help="Path to the input folder containing images (or a .miec ciphertext container when decrypting).")
+    parser.add_argument('--output', '-o', help="Path to the output folder.")
     parser.add_argument('--key', '-k', help="128-character (512-bit) hex key required for decryption.")
+    parser.add_argument('--workers', '-w', type=int, default=1, help="Number of worker processes for the DNA stages (default: 1).")
+    parser.add_argument('--format', choices=['container', 'png', 'both'], default='container',
+                        help="Ciphertext output: a single .miec container, PNG files, or both (default: container).")
+    parser.add_argument('--png-compression', type=int, default=6, choices=range(10), metavar='0-9',
+                        help="PNG zlib level for output images; 0 writes uncompressed PNGs (default: 6).")
+    parser.add_argument('--staged', action='store_true', help="Run the DNA stages one by one instead of the fused kernel (for debugging).")
+    parser.add_argument('--streaming', action='store_true', help="Process the batch in row-blocks backed by memory-mapped scratch files.")
+    parser.add_argument('--memory-limit', type=int, default=1024, help="Memory ceiling in MB for --streaming (default: 1024).")
+    parser.add_argument('--scratch-dir', help="Directory for --streaming scratch files (default: system temp directory).")
+    parser.add_argument('--profile', nargs='?', const='profile', metavar='DIR',
+                        help="Profile every stage with cProfile and tracemalloc, print a stage report and write "
+                             "<stage>.prof files to DIR (default: ./profile).")
+    parser.add_argument('--stage-log', metavar='PATH', help="Append one JSON record per stage to PATH.")
+    parser.add_argument('--max-padding', type=float, metavar='RATIO',
+                        help="Encrypt size buckets with at most this fraction of padding as separate units, each with "
+                             "its own key recorded in the manifest (e.g. 0.25).")
+    parser.add_argument('--group-size', type=int, metavar='N',
+                        help="Sequence mode for large frame folders: encrypt consecutive groups of N images as "
+                             "separate units on an overlapped load/encrypt/save pipeline, with the keys in the manifest.")
+    parser.add_argument('--manifest', metavar='PATH',
+                        help="Batching manifest written by --max-padding and read for decryption instead of --key "
+                             "(default when encrypting: <output>.manifest.json).")
+    parser.add_argument('--auto', action='store_true',
+                        help="Let the planner choose in-memory, multi-worker, streaming or size-bucketed execution "
+                             "from the batch shape and this host's cores and memory.")
+    parser.add_argument('--memory-budget', type=int, metavar='MB',
+                        help="Memory a planned run may use (default: 80%% of the available memory).")
+    parser.add_argument('--cores', type=int, help="Cores a planned run may use (default: those of this host).")
+    parser.add_argument('--calibration', metavar='PATH',
+                        help="benchmark.py results to calibrate the planner's cost model with "
+                             "(default: benchmark_results.json if present, else built-in costs).")
+    parser.add_argument('--json', action='store_true', help="Print the plan as JSON, for schedulers.")
+    parser.add_argument('--socket', metavar='PATH',
+                        help="Unix socket of the daemon for serve/submit/status (default: mie-<uid>.sock in "
+                             "$XDG_RUNTIME_DIR or the system temp directory).")
+    parser.add_argument('--jobs', type=int, default=1, help="Jobs the daemon runs at once (default: 1).")
+    parser.add_argument('--queue-size', type=int, default=DEFAULT_QUEUE_SIZE,
+                        help=f"Jobs that may wait in the daemon's queue; submits block beyond it "
+                             f"(default: {DEFAULT_QUEUE_SIZE}).")
+    parser.add_argument('--no-wait', action='store_true', help="Return from submit once the job is queued.")
+    parser.add_argument('--id', type=int, metavar='JOB', help="Show the status of one daemon job.")
 
     args = parser.parse_args()
+    if args.action in ('submit', 'plan') and args.job is None:
+        parser.error(f"{args.action} needs a job: '{args.action} encrypt' or '{args.action} decrypt'")
+    if args.action in ('encrypt', 'decrypt', 'submit') and not (args.input and args.output):
+        parser.error(f"{args.action} needs --input and --output")
+    if args.action == 'plan' and not args.input:
+        parser.error("plan needs --input")
+    if args.auto and (args.streaming or args.group_size is not None):
+        parser.error("--auto chooses the strategy itself; drop --streaming and --group-size")
+    if args.group_size is not None:
+        if args.group_size < 1:
+            parser.error("--group-size must be at least 1")
+        if args.max_padding is not None or args.streaming:
+            parser.error("--group-size cannot be combined with --max-padding or --streaming")
+    if args.streaming:
+        # The row-block pipeline runs its own kernel in one process and writes a single key.
+        if args.max_padding is not None or args.manifest:
+            parser.error("--streaming cannot be combined with --max-padding or --manifest")
+        if args.workers > 1 or args.staged:
+            parser.error("--streaming runs in a single process; drop --workers and --staged")
+
+    if args.action in ('submit', 'status'):
+        try:
+            client(args)
+        except (FileNotFoundError, ConnectionRefusedError):
+            print(f"Error: No daemon is serving '{args.socket or default_socket_path()}'. Start one with 'main.py serve'.")
+        except RuntimeError as error:
+            print(f"Error: {error}")
+        return
+
+    # The pipeline is only imported from here on, so the daemon client above starts fast.
+    from encrypt import encrypt_images, encrypt_images_bucketed, encrypt_images_sequence
+    from decrypt import decrypt_images
+    from pipeline.streaming import encrypt_images_streaming, decrypt_images_streaming
+    from pipeline.planner import format_plan
+    from utils.instrumentation import Instrumentation, JSONLogSink, PrintSink
+
+    if args.action == 'plan':
+        result = make_plan(args, args.job)
+        print(json.dumps(result, indent=2) if args.json else format_plan(result))
+        return
+
+    if args.action == 'serve':
+        from pipeline.daemon import Daemon
+        try:
+            Daemon(args.socket, args.workers, args.jobs, args.queue_size, stage_log=args.stage_log).serve()
+        except RuntimeError as error:
+            print(f"Error: {error}")
+        return
+
+    if args.auto:
+        result = make_plan(args, args.action)
+        print(format_plan(result) + "\n")
+        if result['chosen'] is None:
+            print(f"Error: no strategy fits; nothing was {args.action}ed.")
+            sys.exit(1)
+        args.streaming, args.max_padding = False, None
+        for name, value in result['options'].items():
+            setattr(args, name, value)
+
+    sinks = [PrintSink(report=args.streaming or args.profile is not None)]
+    if args.stage_log:
+        sinks.append(JSONLogSink(args.stage_log, action=args.action))
+    instrumentation = Instrumentation(sinks, profile_dir=args.profile, trace_memory=args.profile is not None)
+    streaming_options = {'memory_limit': args.memory_limit * 2**20, 'scratch_dir': args.scratch_dir,
+                         'compress_level': args.png_compression, 'instrumentation': instrumentation}
 
     if args.action == 'encrypt':
         print("--- Starting Encryption ---")
-        key = encrypt_images(args.input, args.output)
+        if args.max_padding is not None or args.group_size is not None:
+            unit_options = {'workers': args.workers, 'compress_level': args.png_compression, 'output_format': args.format,
+                            'staged': args.staged, 'instrumentation': instrumentation}
+            if args.group_size is not None:
+                manifest = encrypt_images_sequence(args.input, args.output, args.group_size, args.manifest,
+                                                   **unit_options)
+            else:
+                manifest = encrypt_images_bucketed(args.input, args.output, args.max_padding, args.manifest,
+                                                   **unit_options)
+            print(f"\nEncryption successful! {len(manifest['units'])} unit(s) written.")
+            print("\nIMPORTANT: The manifest holds the unit keys. Store it securely and apart from the ciphertext.")
+            return
+        if args.streaming:
+            key = encrypt_images_streaming(args.input, args.output, output_format=args.format, **streaming_options)
+        else:
+            key = encrypt_images(args.input, args.output, workers=args.workers, compress_level=args.png_compression,
+                                 output_format=args.format, staged=args.staged, instrumentation=instrumentation)
         if key:
             print(f"\nEncryption successful! Your secret key is:\n{key}")
             print("\nIMPORTANT: Save this key securely.")
 
     elif args.action == 'decrypt':
         print("--- Starting Decryption ---")
+        if args.manifest:
+            decrypt_images(args.input, args.output, workers=args.workers, compress_level=args.png_compression,
+                           staged=args.staged, instrumentation=instrumentation, manifest=args.manifest)
+            return
         if not args.key or len(args.key) != 128:
             print("Error: Decryption requires a valid 128-character (512-bit) hex key. Please provide it with --key.")
             return
-        decrypt_images(args.input, args.output, args.key)
-
-if __name__ == "__main__":
-    main()
+        if args.streaming:
+            decrypt_images_streaming(args.input, args.output, args.key, **streaming_options)
+        else:
+            decrypt_images(args.input, args.output, args.key, workers=args.workers, compress_level=args.png_compression,
+                           staged=args.staged, instrumentation=instrumentation)
 
+def make_plan(args, action):
+    # Reads the batch shape from the headers; no pixels are decoded.
+    from pipeline import planner
+    return planner.plan(action, args.input, args.manifest if action == 'decrypt' else None, args.format,
+                        args.max_padding, args.cores, args.memory_budget and args.memory_budget * 2**20,
+                        args.scratch_dir, planner.CostModel.load(args.calibration))
 
+def client(args):
+    daemon = DaemonClient(args.socket)
+    if args.action == 'status':
+        response = daemon.status(args.id)
+        if args.id is not None:
+            print(format_jobs([response['job']]))
+            for name, value in response['job'].get('result', {}).items():
+                print(f"{name}: {value}")
+            return
+        cache = response['cache']
+        print(f"{response['running']}/{response['job_slots']} running, {response['queued']}/{response['queue_size']} "
+              f"queued, {response['workers']} worker(s); key cache {cache['entries']} entries, "
+              f"{cache['hits']} hits, {cache['misses']} misses")
+        print(format_jobs(response['jobs']))
+        return
 
+    job = {'kind': args.job, 'input': args.input, 'output': args.output, 'key': args.key, 'manifest': args.manifest,
+           'max_padding': args.max_padding, 'group_size': args.group_size, 'format': args.format, 'compress_level': args.png_compression,
+           'staged': args.staged}
+    response = daemon.submit(job, wait=not args.no_wait)
+    status = response['job']
+    if args.no_wait:
+        print(f"Queued job {status['id']}. Check it with: main.py status --id {status['id']}")
+        return
+    print(f"Job {status['id']} finished in {status['seconds']:.2f}s.")
+    result = response.get('result', {})
+    if 'key' in result:
+        print(f"\nEncryption successful! Your secret key is:\n{result['key']}")
+        print("\nIMPORTANT: Save this key securely.")
+    elif 'manifest' in result:
+        print(f"\nEncryption successful! {result['units']} unit(s) written; the manifest with their keys is "
+              f"'{result['manifest']}'.")
 
+if __name__ == "__main__":
+    main()
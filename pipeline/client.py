@@ -0,0 +1,111 @@
+"""Client for the warm encryption daemon (pipeline/daemon.py) and the wire
+format both sides share.
+
+Importing this module stays cheap: no pipeline modules, and NumPy only once
+arrays are sent, so `main.py submit` starts in a fraction of the time a full
+`main.py encrypt` needs before its first pixel.
+"""
+import base64
+import json
+import os
+import socket
+import tempfile
+
+KINDS = ('encrypt', 'decrypt')
+DEFAULT_QUEUE_SIZE = 64
+# Longest request or response line; buffer jobs carry base64 pixels.
+MAX_MESSAGE_BYTES = 1 << 30
+
+
+def default_socket_path():
+    directory = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    return os.path.join(directory, f"mie-{os.getuid()}.sock")
+
+
+def encode_buffer(image):
+    # Arrays travel as raw uint8 with their shape, encoded files as they are.
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return {'data': base64.b64encode(image).decode('ascii')}
+    import numpy as np
+    image = np.ascontiguousarray(image, dtype=np.uint8)
+    return {'shape': list(image.shape), 'data': base64.b64encode(image).decode('ascii')}
+
+def decode_buffer(buffer):
+    data = base64.b64decode(buffer['data'])
+    if 'shape' not in buffer:
+        return data
+    import numpy as np
+    return np.frombuffer(data, dtype=np.uint8).reshape(buffer['shape'])
+
+def encode_layout(layout):
+    count = len(layout['channel_map'])
+    return {'shape': [int(v) for v in layout['shape']],
+            'original_shapes': [[int(v) for v in layout['original_shapes'][i]] for i in range(count)],
+            'channel_map': [int(c) for c in layout['channel_map']], 'names': layout['names']}
+
+def decode_layout(layout):
+    return {**layout, 'shape': tuple(layout['shape']),
+            'original_shapes': {i: tuple(hw) for i, hw in enumerate(layout['original_shapes'])}}
+
+
+class DaemonClient:
+    """Blocking client for a running Daemon; each call opens one connection.
+
+    encrypt_arrays and decrypt_arrays mirror the in-process functions of the
+    same name. Failed jobs and rejected requests raise RuntimeError.
+    """
+
+    def __init__(self, socket_path=None, timeout=None):
+        self.socket_path = socket_path or default_socket_path()
+        self.timeout = timeout
+
+    def request(self, request):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+            sock.sendall(json.dumps(request).encode() + b"\n")
+            with sock.makefile('rb') as stream:
+                line = stream.readline()
+        if not line:
+            raise ConnectionError("The daemon closed the connection without a response.")
+        response = json.loads(line)
+        if not response['ok']:
+            raise RuntimeError(response['error'])
+        return response
+
+    def submit(self, job, wait=True):
+        """Queue a job; with `wait`, block until it finishes. Returns the response."""
+        job = dict(job)
+        for field in ('input', 'output', 'manifest'):
+            if job.get(field) is not None:
+                job[field] = os.path.abspath(job[field])
+        return self.request({'op': 'submit', 'job': job, 'wait': wait})
+
+    def status(self, job_id=None):
+        return self.request({'op': 'status', 'id': job_id} if job_id is not None else {'op': 'status'})
+
+    def encrypt_arrays(self, images, names=None, staged=False):
+        response = self.submit({'kind': 'encrypt', 'images': [encode_buffer(img) for img in images],
+                                'names': names, 'staged': staged})
+        result = response['result']
+        return decode_buffer(result['ciphertext']), result['key'], decode_layout(result['layout'])
+
+    def decrypt_arrays(self, ciphertext, K, layout=None, staged=False):
+        if isinstance(ciphertext, (list, tuple)):
+            ciphertext = [encode_buffer(img) for img in ciphertext]
+        else:
+            ciphertext = encode_buffer(ciphertext)
+        job = {'kind': 'decrypt', 'ciphertext': ciphertext, 'key': K, 'staged': staged,
+               'layout': encode_layout(layout) if layout is not None else None}
+        return [decode_buffer(img) for img in self.submit(job)['result']['images']]
+
+
+def format_jobs(jobs):
+    lines = [f"{'Job':>6} {'Kind':<8} {'State':<10} {'Time (s)':>9}  Input"]
+    for status in jobs:
+        seconds = f"{status['seconds']:>9.2f}" if 'seconds' in status else f"{'-':>9}"
+        line = f"{status['id']:>6} {status['kind']:<8} {status['state']:<10} {seconds}  {status['input']}"
+        if status.get('error'):
+            line += f"  ({status['error']})"
+        lines.append(line)
+    return "\n".join(lines)
@@ -0,0 +1,309 @@
+"""Warm encryption daemon.
+
+A long-running process that keeps the interpreter, NumPy/PIL, the compiled
+keystream, the key-material cache and (with workers > 1) a ShardedExecutor
+pool warm, and runs encrypt/decrypt jobs sent over a Unix domain socket.
+
+Protocol: one JSON object per line in each direction. Requests are
+    {"op": "submit", "job": {...}, "wait": true}
+    {"op": "status"}  or  {"op": "status", "id": 3}
+and every response carries "ok", plus "error" when it is false.
+
+A job is either a folder job, {"kind": "encrypt" | "decrypt", "input",
+"output", ...} with the main.py options, or a buffer job whose images travel
+base64-encoded: {"kind": "encrypt", "images"} or {"kind": "decrypt",
+"ciphertext", "key", "layout"}. Jobs wait in a bounded queue, and a submit
+blocks while the queue is full, which pushes back on the clients. At most
+`jobs` jobs run at once, each in its own thread, all sharing the warm pool.
+DaemonClient in pipeline/client.py speaks this protocol.
+"""
+import asyncio
+import itertools
+import json
+import os
+import signal
+import socket
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from decrypt import decrypt_arrays, decrypt_images
+from encrypt import encrypt_arrays, encrypt_images, encrypt_images_bucketed, encrypt_images_sequence
+from pipeline import fused
+from pipeline.client import (DEFAULT_QUEUE_SIZE, KINDS, MAX_MESSAGE_BYTES, decode_buffer, decode_layout,
+                             default_socket_path, encode_buffer, encode_layout)
+from pipeline.parallel import ShardedExecutor
+from utils import batching, image_handler, key_material
+from utils.instrumentation import Instrumentation, JSONLogSink
+from utils.key_material import KeyMaterial
+
+DEFAULT_HISTORY = 1000
+# Seconds open connections get to receive their last response on shutdown.
+SHUTDOWN_GRACE = 1.0
+
+
+def _check_key(key):
+    if not isinstance(key, str) or len(key) != 128:
+        raise ValueError("Decryption requires a valid 128-character (512-bit) hex key.")
+
+def validate_job(job, wait=True):
+    if job.get('kind') not in KINDS:
+        raise ValueError(f"Job kind must be one of {', '.join(KINDS)}.")
+    if 'input' in job:
+        for field in ('input', 'output', 'manifest'):
+            if job.get(field) is not None and not os.path.isabs(job[field]):
+                raise ValueError(f"Folder jobs need absolute paths; '{field}' is '{job[field]}'.")
+        if job.get('output') is None:
+            raise ValueError("Folder jobs need an output folder.")
+        if job['kind'] == 'decrypt' and job.get('manifest') is None:
+            _check_key(job.get('key'))
+        return
+    if not wait:
+        raise ValueError("Buffer jobs return their images in the response, so they cannot be submitted without wait.")
+    if job['kind'] == 'encrypt' and not job.get('images'):
+        raise ValueError("Encrypt buffer jobs need 'images'.")
+    if job['kind'] == 'decrypt':
+        if 'ciphertext' not in job:
+            raise ValueError("Decrypt buffer jobs need 'ciphertext'.")
+        _check_key(job.get('key'))
+
+
+def run_job(job, executor=None, instrumentation=None):
+    """Run one validated job in this process and return its result."""
+    options = {'instrumentation': instrumentation or Instrumentation(), 'executor': executor,
+               'staged': job.get('staged', False)}
+    if 'input' in job:
+        options['compress_level'] = job.get('compress_level', image_handler.DEFAULT_COMPRESS_LEVEL)
+        if job['kind'] == 'decrypt':
+            decrypt_images(job['input'], job['output'], job.get('key'), manifest=job.get('manifest'), **options)
+            return {}
+        output_format = job.get('format', 'container')
+        if job.get('max_padding') is not None or job.get('group_size') is not None:
+            manifest_path = job.get('manifest') or batching.default_manifest_path(job['output'])
+            if job.get('group_size') is not None:
+                manifest = encrypt_images_sequence(job['input'], job['output'], job['group_size'], manifest_path,
+                                                   output_format=output_format, **options)
+            else:
+                manifest = encrypt_images_bucketed(job['input'], job['output'], job['max_padding'], manifest_path,
+                                                   output_format=output_format, **options)
+            return {'manifest': manifest_path, 'units': len(manifest['units'])}
+        return {'key': encrypt_images(job['input'], job['output'], output_format=output_format, **options)}
+
+    if job['kind'] == 'encrypt':
+        ciphertext, K, layout = encrypt_arrays([decode_buffer(b) for b in job['images']], job.get('names'), **options)
+        return {'key': K, 'ciphertext': encode_buffer(ciphertext), 'layout': encode_layout(layout)}
+    if isinstance(job['ciphertext'], list):
+        ciphertext = [decode_buffer(b) for b in job['ciphertext']]
+    else:
+        ciphertext = decode_buffer(job['ciphertext'])
+    layout = decode_layout(job['layout']) if job.get('layout') else None
+    images = decrypt_arrays(ciphertext, job['key'], layout, **options)
+    return {'images': [encode_buffer(img) for img in images]}
+
+
+def warm_up(executor=None):
+    # Compile the keystream and touch the DNA tables (and the pool) once, so
+    # the first job does not pay for it.
+    P = np.zeros((2, 2, 2), dtype=np.uint8)
+    material = KeyMaterial.derive('0' * 128, P.shape)
+    fused.decrypt(fused.encrypt(P, material), material)
+    if executor is not None:
+        executor.decrypt(executor.encrypt(P, material), material)
+
+
+class _Job:
+    def __init__(self, job_id, spec, done):
+        self.id, self.spec, self.done = job_id, spec, done
+        self.result = None
+        buffers = spec.get('images') or spec.get('ciphertext')
+        source = spec.get('input') or f"<{len(buffers) if isinstance(buffers, list) else 1} buffer(s)>"
+        self.status = {'id': job_id, 'kind': spec['kind'], 'state': 'queued', 'input': source,
+                       'submitted': time.time()}
+
+
+class Daemon:
+    """Serves jobs on `socket_path` until SIGINT or SIGTERM.
+
+    `workers` > 1 keeps a ShardedExecutor of that size warm for the DNA
+    stages, `jobs` is how many jobs run at once and `queue_size` how many may
+    wait behind them. Status stays available for the last `history` jobs.
+    With `stage_log`, every stage of every job is appended there as JSON.
+    """
+
+    def __init__(self, socket_path=None, workers=1, jobs=1, queue_size=DEFAULT_QUEUE_SIZE, history=DEFAULT_HISTORY,
+                 stage_log=None):
+        self.socket_path = socket_path or default_socket_path()
+        self.workers, self.jobs, self.queue_size, self.history = workers, jobs, queue_size, history
+        self.stage_log = stage_log
+        self._jobs = OrderedDict()
+        self._ids = itertools.count(1)
+        self._connections = set()
+        self._closing = False
+
+    def serve(self):
+        asyncio.run(self._serve())
+
+    def _claim_socket(self):
+        if not os.path.exists(self.socket_path):
+            return
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.socket_path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            # Left behind by a daemon that did not shut down cleanly.
+            os.unlink(self.socket_path)
+        else:
+            raise RuntimeError(f"A daemon is already serving '{self.socket_path}'.")
+        finally:
+            probe.close()
+
+    async def _serve(self):
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop.set)
+        self._claim_socket()
+        self._queue = asyncio.Queue(self.queue_size)
+        executor = ShardedExecutor(self.workers) if self.workers > 1 else None
+        threads = ThreadPoolExecutor(self.jobs, thread_name_prefix='mie-job')
+        try:
+            warm_up(executor)
+            # The socket carries keys and plaintext: owner access only.
+            umask = os.umask(0o177)
+            try:
+                server = await asyncio.start_unix_server(self._handle, self.socket_path, limit=MAX_MESSAGE_BYTES)
+            finally:
+                os.umask(umask)
+            runners = [asyncio.create_task(self._run_jobs(threads, executor)) for _ in range(self.jobs)]
+            print(f"Serving on '{self.socket_path}' with {self.jobs} job slot(s), a queue of {self.queue_size} "
+                  f"and {self.workers} worker(s).", flush=True)
+            await stop.wait()
+
+            print("Shutting down: finishing running jobs, cancelling queued ones...", flush=True)
+            self._closing = True
+            server.close()
+            for runner in runners:
+                runner.cancel()
+            await loop.run_in_executor(None, threads.shutdown)
+            while not self._queue.empty():
+                self._cancel(self._queue.get_nowait())
+            if self._connections:
+                await asyncio.wait(self._connections, timeout=SHUTDOWN_GRACE)
+            for connection in self._connections:
+                connection.cancel()
+        finally:
+            threads.shutdown(wait=False, cancel_futures=True)
+            if executor is not None:
+                executor.close()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+    async def _run_jobs(self, threads, executor):
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self._queue.get()
+            if job.status['state'] == 'queued':
+                await loop.run_in_executor(threads, self._execute, job, executor, loop)
+
+    def _execute(self, job, executor, loop):
+        # Runs on a job thread; the waiting client is woken on the loop.
+        status = job.status
+        status.update(state='running', started=time.time())
+        sinks = [JSONLogSink(self.stage_log, job=job.id, action=job.spec['kind'])] if self.stage_log else []
+        instrumentation = Instrumentation(sinks)
+        try:
+            job.result = run_job(job.spec, executor, instrumentation)
+            status['state'] = 'done'
+            status['result'] = {k: v for k, v in job.result.items() if k in ('key', 'manifest', 'units')}
+        except Exception as error:
+            # A failed job must not take the daemon down with it.
+            status.update(state='failed', error=f"{type(error).__name__}: {error}")
+        finally:
+            status['finished'] = time.time()
+            status['seconds'] = status['finished'] - status['started']
+            stages = {}
+            for record in instrumentation.records:
+                stages[record['stage']] = stages.get(record['stage'], 0.0) + record['seconds']
+            status['stages'] = stages
+            job.spec = None
+            loop.call_soon_threadsafe(self._finish, job)
+
+    def _finish(self, job):
+        if not job.done.done():
+            job.done.set_result(None)
+        finished = [job_id for job_id, other in self._jobs.items()
+                    if other.status['state'] in ('done', 'failed', 'cancelled')]
+        for job_id in finished[:max(0, len(finished) - self.history)]:
+            del self._jobs[job_id]
+
+    def _cancel(self, job):
+        if job.status['state'] == 'queued':
+            job.status.update(state='cancelled', finished=time.time())
+            job.spec = None
+            self._finish(job)
+
+    async def _handle(self, reader, writer):
+        self._connections.add(asyncio.current_task())
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    await self._respond(writer, {'ok': False, 'error': f"Request exceeds {MAX_MESSAGE_BYTES} bytes."})
+                    break
+                if not line:
+                    break
+                await self._respond(writer, await self._dispatch(line))
+        except ConnectionError:
+            pass
+        finally:
+            self._connections.discard(asyncio.current_task())
+            writer.close()
+
+    @staticmethod
+    async def _respond(writer, response):
+        writer.write(json.dumps(response).encode() + b"\n")
+        await writer.drain()
+
+    async def _dispatch(self, line):
+        try:
+            request = json.loads(line)
+            if request.get('op') == 'submit':
+                return await self._submit(request['job'], request.get('wait', True))
+            if request.get('op') == 'status':
+                return self._status(request.get('id'))
+            raise ValueError(f"Unknown op {request.get('op')!r}.")
+        except (ValueError, KeyError, TypeError, AttributeError) as error:
+            return {'ok': False, 'error': f"Bad request: {error}"}
+
+    async def _submit(self, spec, wait):
+        validate_job(spec, wait)
+        if self._closing:
+            return {'ok': False, 'error': "The daemon is shutting down."}
+        job = _Job(next(self._ids), spec, asyncio.get_running_loop().create_future())
+        self._jobs[job.id] = job
+        await self._queue.put(job)
+        if self._closing:
+            self._cancel(job)
+        if not wait:
+            return {'ok': True, 'job': job.status}
+        await job.done
+        response = {'ok': job.status['state'] == 'done', 'job': job.status}
+        if job.status['state'] != 'done':
+            response['error'] = job.status.get('error', f"Job {job.status['state']}.")
+        elif job.result:
+            response['result'] = job.result
+        job.result = None
+        return response
+
+    def _status(self, job_id=None):
+        if job_id is not None:
+            if job_id not in self._jobs:
+                return {'ok': False, 'error': f"Unknown job {job_id}."}
+            return {'ok': True, 'job': self._jobs[job_id].status}
+        states = [job.status['state'] for job in self._jobs.values()]
+        return {'ok': True, 'queued': self._queue.qsize(), 'running': states.count('running'),
+                'job_slots': self.jobs, 'queue_size': self.queue_size, 'workers': self.workers,
+                'cache': key_material.default_cache.stats(), 'jobs': [job.status for job in self._jobs.values()]}
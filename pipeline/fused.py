@@ -0,0 +1,65 @@
+"""Single-pass encryption and decryption over packed bases.
+
+The staged path in encrypt.py / decrypt.py materializes every step as a
+(M, N, 4n) tensor of base codes (P_dna1 .. P_dna4 plus E_dna). Here the four
+bases of a value stay packed in one byte, so the stages chain through two
+(M, N, n) uint8 buffers, `out` and `work`:
+
+    out  <- encode(P)            cyclic shift encode, packed
+    work <- scramble(out)        one byte gather
+    work <- diffuse(work)        lateral + strand diffusion, in place
+    out  <- decode(work)
+
+E is used directly as its packed E_dna. The elementwise stages run in
+row-blocks so their temporaries stay small. The result is bit-identical to
+the staged path.
+"""
+import numpy as np
+
+from dna_operations import core, diffusion
+from pipeline.streaming import row_blocks
+
+# Values per row-block of the elementwise stages.
+BLOCK_ELEMENTS = 1 << 20
+
+
+def _blocks(shape):
+    M, N, n = shape
+    return row_blocks(M, max(1, BLOCK_ELEMENTS // (N * n)))
+
+def _buffers(shape, out, work):
+    out = np.empty(shape, dtype=np.uint8) if out is None else out
+    work = np.empty(shape, dtype=np.uint8) if work is None else work
+    return out, work
+
+
+def encrypt(P, material, out=None, work=None):
+    """Encrypt the (M, N, n) tensor P; `out` and `work` are optional buffers."""
+    out, work = _buffers(P.shape, out, work)
+    C_matrix, E = material.C_matrix, material.E
+    for r0, r1 in _blocks(P.shape):
+        core.packed_encode(P[r0:r1], C_matrix[r0:r1], out=out[r0:r1])
+    material.plan.apply_packed(out, out=work)
+    previous_row = None
+    for r0, r1 in _blocks(P.shape):
+        diffusion.packed_lateral_diffusion(work[r0:r1], E[r0:r1], previous_row)
+        previous_row = work[r1 - 1].copy()
+        diffusion.packed_strand_diffusion(work[r0:r1])
+        core.packed_decode(work[r0:r1], C_matrix[r0:r1], out=out[r0:r1])
+    return out
+
+
+def decrypt(P_end, material, out=None, work=None):
+    """Decrypt the (M, N, n) tensor P_end; `out` and `work` are optional buffers."""
+    out, work = _buffers(P_end.shape, out, work)
+    C_matrix, E = material.C_matrix, material.E
+    previous_row = None
+    for r0, r1 in _blocks(P_end.shape):
+        core.packed_encode(P_end[r0:r1], C_matrix[r0:r1], out=out[r0:r1])
+        diffusion.packed_inverse_strand_diffusion(out[r0:r1])
+        diffusion.packed_inverse_lateral_diffusion(out[r0:r1], E[r0:r1], work[r0:r1], previous_row)
+        previous_row = out[r1 - 1]
+    material.plan.undo_packed(work, out=out)
+    for r0, r1 in _blocks(P_end.shape):
+        core.packed_decode(out[r0:r1], C_matrix[r0:r1], out=out[r0:r1])
+    return out
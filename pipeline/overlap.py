@@ -0,0 +1,95 @@
+"""Overlapped load -> process -> save over a sequence of independent units.
+
+Loading runs on one thread, processing on the calling thread and saving on
+another, joined by bounded queues. While unit i is processed, unit i+1 is
+being decoded and unit i-1 written, and at most `depth` units wait between
+two steps, so memory stays flat however many units there are. Pillow, zlib
+and most of the NumPy kernels release the GIL, so the three steps really
+run at the same time.
+"""
+import queue
+import threading
+import time
+
+# How often blocked steps check whether another step has failed.
+POLL_SECONDS = 0.1
+_DONE = object()
+
+
+def _put(channel, item, stop):
+    while not stop.is_set():
+        try:
+            channel.put(item, timeout=POLL_SECONDS)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def _get(channel, stop):
+    while not stop.is_set():
+        try:
+            return channel.get(timeout=POLL_SECONDS)
+        except queue.Empty:
+            pass
+    return _DONE
+
+
+def run_stages(items, load, process, save, depth=1):
+    """Run save(process(load(item))) for every item, overlapping the three steps.
+
+    Items are saved in order. The first exception of any step stops the
+    others and is re-raised here. Returns the seconds each step spent busy,
+    as (load, process, save); with full overlap the wall time approaches
+    the largest of them rather than their sum.
+    """
+    loaded, processed = queue.Queue(depth), queue.Queue(depth)
+    stop = threading.Event()
+    errors = []
+    busy = [0.0, 0.0, 0.0]
+
+    def timed(step, func, item):
+        start = time.perf_counter()
+        result = func(item)
+        busy[step] += time.perf_counter() - start
+        return result
+
+    def loader():
+        try:
+            for item in items:
+                if not _put(loaded, timed(0, load, item), stop):
+                    return
+            _put(loaded, _DONE, stop)
+        except BaseException as error:
+            errors.append(error)
+            stop.set()
+
+    def saver():
+        try:
+            while (item := _get(processed, stop)) is not _DONE:
+                timed(2, save, item)
+        except BaseException as error:
+            errors.append(error)
+            stop.set()
+
+    threads = [threading.Thread(target=loader, daemon=True), threading.Thread(target=saver, daemon=True)]
+    for thread in threads:
+        thread.start()
+    try:
+        while (item := _get(loaded, stop)) is not _DONE:
+            if not _put(processed, timed(1, process, item), stop):
+                break
+        _put(processed, _DONE, stop)
+    except BaseException as error:
+        errors.append(error)
+        stop.set()
+    finally:
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+    return tuple(busy)
+
+
+def format_busy(busy, seconds, names=('loading', 'processing', 'saving')):
+    parts = ", ".join(f"{name} {step:.2f}s" for name, step in zip(names, busy))
+    return f"Busy time: {parts} in {seconds:.2f}s wall time ({sum(busy) / max(seconds, 1e-9):.1f}x overlap)."
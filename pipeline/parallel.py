@@ -0,0 +1,242 @@
+"""Multi-core execution of the DNA stages over shared memory.
+
+The big arrays live in `multiprocessing.shared_memory` blocks. Workers only
+receive (name, shape, dtype) specs plus a shard range, so no array is
+pickled. Each stage is a barrier: all shards finish before the next stage
+starts.
+
+Shards follow what each stage depends on:
+- cyclic shift encode/decode split by rows, since they are per element;
+- diffusion splits by columns, since lateral diffusion is independent per
+  column (j, z) and strand diffusion per pixel (i, j);
+- the global scramble runs between them as its own synchronized phase. Once
+  its source is complete, every output row range can be gathered in parallel,
+  and undone by scattering each input row range back through the same index.
+
+A key's material and the working buffers stay in shared memory between
+calls, and arrays from `ShardedExecutor.empty` are used in place as input
+or output, so a warm executor copies nothing it has seen before.
+"""
+import multiprocessing
+import sys
+import threading
+from collections import OrderedDict
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from dna_operations import core, diffusion
+from dna_operations.scramble import ScramblePlan
+
+
+class SharedArray:
+    def __init__(self, shape, dtype, source=None):
+        self.shape, self.dtype = tuple(shape), np.dtype(dtype)
+        self.shm = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(self.shape)) * self.dtype.itemsize))
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+        if source is not None:
+            self.array[...] = source
+
+    @property
+    def spec(self):
+        return (self.shm.name, self.shape, self.dtype.str)
+
+    def release(self):
+        del self.array
+        self.shm.unlink()
+        try:
+            self.shm.close()
+        except BufferError:
+            # A caller still holds a view; the mapping goes with the view.
+            pass
+
+
+def _attach(spec):
+    # Workers share the parent's resource tracker (see ShardedExecutor), so
+    # attaching only repeats the parent's registration and the block stays
+    # owned by the parent, which unlinks it.
+    name, shape, dtype = spec
+    if sys.version_info >= (3, 13):
+        shm = shared_memory.SharedMemory(name=name, track=False)
+    else:
+        shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _encode_rows(P, C_matrix, out, r0, r1):
+    out[r0:r1] = core.cyclic_shift_encode(P[r0:r1], C_matrix[r0:r1])
+
+def _decode_rows(dna, C_matrix, out, r0, r1):
+    out[r0:r1] = core.cyclic_shift_decode(dna[r0:r1], C_matrix[r0:r1])
+
+def _gather_rows(index, dna, out, r0, r1):
+    M, N, total = out.shape
+    blocks_per_row = N * total // 4
+    out[r0:r1] = ScramblePlan(index).gather(dna, r0 * blocks_per_row, r1 * blocks_per_row).reshape(r1 - r0, N, total)
+
+def _scatter_rows(index, dna, out, r0, r1):
+    # The index is a permutation, so shards write disjoint blocks of `out`.
+    M, N, total = dna.shape
+    blocks_per_row = N * total // 4
+    out.reshape(-1, 4)[index[r0 * blocks_per_row:r1 * blocks_per_row]] = dna[r0:r1].reshape(-1, 4)
+
+def _diffuse_columns(dna, E, out, j0, j1):
+    P_dna3 = diffusion.lateral_diffusion(dna[:, j0:j1], core.encode_with_rule(E[:, j0:j1]))
+    out[:, j0:j1] = diffusion.strand_diffusion(P_dna3)
+
+def _inverse_diffuse_columns(dna, E, out, j0, j1):
+    P_dna3 = diffusion.inverse_strand_diffusion(dna[:, j0:j1])
+    out[:, j0:j1] = diffusion.inverse_lateral_diffusion(P_dna3, core.encode_with_rule(E[:, j0:j1]))
+
+_TASKS = {func.__name__: func for func in (_encode_rows, _decode_rows, _gather_rows, _scatter_rows, _diffuse_columns,
+                                           _inverse_diffuse_columns)}
+
+def _run_task(task):
+    name, specs, start, stop = task
+    handles, arrays = zip(*(_attach(spec) for spec in specs))
+    try:
+        _TASKS[name](*arrays, start, stop)
+    finally:
+        del arrays
+        for shm in handles:
+            shm.close()
+
+
+class ShardedExecutor:
+    """Process pool that runs encryption/decryption stages in shards.
+
+    Use as a context manager, or call close(); the pool stays warm between
+    calls so it can serve many batches. The shared copies of the last
+    `material_slots` key materials and the buffers of the last shape are
+    kept for the next call. Calls are serialized, since each uses every
+    worker and the same buffers.
+    """
+
+    def __init__(self, workers, context=None, material_slots=2):
+        self.workers = workers
+        self.material_slots = material_slots
+        # Start the tracker before the pool so every worker inherits it
+        # instead of starting its own, which would unlink the blocks on exit.
+        resource_tracker.ensure_running()
+        self.pool = multiprocessing.get_context(context).Pool(workers)
+        self._materials = OrderedDict()
+        self._buffers = None
+        self._owned = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        with self._lock:
+            for arrays in self._materials.values():
+                self._release(arrays)
+            self._materials.clear()
+            if self._buffers is not None:
+                self._release(self._buffers[1:])
+                self._buffers = None
+            self._release(self._owned)
+            self._owned = []
+
+    @staticmethod
+    def _release(arrays):
+        for array in arrays:
+            array.release()
+
+    def empty(self, shape):
+        """A zero-filled uint8 array in shared memory.
+
+        encrypt and decrypt read it as input and write it as `out` in place,
+        without copying. It lives until release() or close().
+        """
+        array = SharedArray(shape, np.uint8)
+        with self._lock:
+            self._owned.append(array)
+        return array.array
+
+    def release(self, *arrays):
+        """Free arrays returned by empty()."""
+        with self._lock:
+            for array in arrays:
+                owned = self._find_owned(array)
+                if owned is not None:
+                    self._owned.remove(owned)
+                    owned.release()
+
+    def _find_owned(self, array):
+        if array is None:
+            return None
+        return next((owned for owned in self._owned if owned.shape == array.shape and owned.dtype == array.dtype
+                     and owned.array.ctypes.data == array.ctypes.data), None)
+
+    def _shards(self, length):
+        bounds = np.linspace(0, length, min(length, self.workers * 2) + 1).astype(int)
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def _stage(self, name, arrays, length):
+        specs = [array.spec for array in arrays]
+        self.pool.map(_run_task, [(name, specs, start, stop) for start, stop in self._shards(length)])
+
+    def _material(self, material):
+        # (C_matrix, E, scramble_index) in shared memory, copied once per key and shape.
+        entry_key = (material.K, material.shape)
+        arrays = self._materials.get(entry_key)
+        if arrays is None:
+            arrays = tuple(SharedArray(a.shape, a.dtype, a)
+                           for a in (material.C_matrix, material.E, material.scramble_index))
+            self._materials[entry_key] = arrays
+            while len(self._materials) > self.material_slots:
+                self._release(self._materials.popitem(last=False)[1])
+        self._materials.move_to_end(entry_key)
+        return arrays
+
+    def _working_set(self, shape):
+        # (input, ping, pong, result) for one (M, N, n), kept for the next call.
+        if self._buffers is None or self._buffers[0] != shape:
+            if self._buffers is not None:
+                self._release(self._buffers[1:])
+            M, N, n = shape
+            self._buffers = (shape, SharedArray(shape, np.uint8), SharedArray((M, N, 4 * n), np.uint8),
+                             SharedArray((M, N, 4 * n), np.uint8), SharedArray(shape, np.uint8))
+        return self._buffers[1:]
+
+    def _run(self, P, material, out, stages):
+        with self._lock:
+            C_s, E_s, index_s = self._material(material)
+            source, ping, pong, result = self._working_set(P.shape)
+            P_s = self._find_owned(P)
+            if P_s is None:
+                source.array[...] = P
+                P_s = source
+            out_s = self._find_owned(out) or result
+            for name, arrays, length in stages(P_s, C_s, E_s, index_s, ping, pong, out_s):
+                self._stage(name, arrays, length)
+            if out_s is not result:
+                return out
+            if out is None:
+                return result.array.copy()
+            out[...] = result.array
+            return out
+
+    def encrypt(self, P, material, out=None):
+        M, N, _ = P.shape
+        return self._run(P, material, out, lambda P_s, C_s, E_s, index_s, ping, pong, out_s: (
+            ('_encode_rows', (P_s, C_s, ping), M),
+            ('_gather_rows', (index_s, ping, pong), M),
+            ('_diffuse_columns', (pong, E_s, ping), N),
+            ('_decode_rows', (ping, C_s, out_s), M),
+        ))
+
+    def decrypt(self, P_end, material, out=None):
+        M, N, _ = P_end.shape
+        return self._run(P_end, material, out, lambda P_s, C_s, E_s, index_s, ping, pong, out_s: (
+            ('_encode_rows', (P_s, C_s, ping), M),
+            ('_inverse_diffuse_columns', (ping, E_s, pong), N),
+            ('_scatter_rows', (index_s, pong, ping), M),
+            ('_decode_rows', (ping, C_s, out_s), M),
+        ))
@@ -0,0 +1,366 @@
+"""Cost model and execution planner.
+
+Whether a batch fits in memory depends on the (M, N, n) tensor it becomes,
+which is known from the image (or container) headers alone. The planner
+reads that shape, estimates seconds and peak memory per stage for every
+execution strategy, and picks the fastest one that fits the host:
+
+1. memory:    encrypt_images / decrypt_images on one process
+2. parallel:  the same with the DNA stages sharded over worker processes
+3. streaming: row-blocks over memory-mapped scratch files, bounded memory
+4. bucketed:  size buckets as separate units with their own keys (encrypt
+              only, when padding wastes much of the tensor), or the units of
+              a manifest when decrypting
+
+Stage costs are seconds per MB of tensor and bytes per tensor element. The
+defaults were measured with the 'python' keystream backend; benchmark.py
+results recalibrate them for a host.
+"""
+import json
+import os
+import shutil
+import tempfile
+
+from chaotic_maps.tdlcic import resolve_backend
+from pipeline.streaming import BYTES_PER_ELEMENT, DEFAULT_MEMORY_LIMIT
+from utils import batching, container, image_handler
+
+DEFAULT_CALIBRATION = 'benchmark_results.json'
+# Share of the available memory a run may plan to use.
+MEMORY_HEADROOM = 0.8
+# Interpreter, NumPy and Pillow before any tensor is allocated.
+BASE_BYTES = 40 * 2**20
+# Seconds per MB of the (M, N, n) tensor.
+DEFAULT_SECONDS_PER_MB = {
+    'load_png': 0.025, 'load_container': 0.001, 'key': 0.007, 'keystream': 2.0,
+    'dna_encrypt': 0.1, 'dna_decrypt': 0.1, 'save_container': 0.002, 'save_png': 0.17,
+}
+# Peak anonymous memory above BASE_BYTES per tensor element, by in-memory
+# stage; the chaotic sequences and their argsorts make 'keystream' the peak.
+DEFAULT_BYTES_PER_ELEMENT = {'load': 1, 'key': 1, 'keystream': 34, 'dna': 30, 'save': 18}
+# Streaming runs take this many times as long as in-memory ones.
+DEFAULT_STREAMING_FACTOR = 1.8
+# Scratch file bytes per tensor element of a streaming run.
+SCRATCH_BYTES_PER_ELEMENT = {'encrypt': 21, 'decrypt': 29}
+# Extra shared-memory bytes per element while the DNA stages run on workers.
+PARALLEL_SHARED_BYTES = 20
+PARALLEL_EFFICIENCY = 0.7
+POOL_START_SECONDS = 0.5
+# Bucketed units are only chosen over a single key when they save this share
+# of the time and at least this many seconds.
+UNIT_MIN_GAIN = 0.1
+UNIT_MIN_SECONDS = 1.0
+# Benchmark stage -> model stage.
+BENCHMARK_STAGES = {
+    'load_images': 'load_png', 'key': 'key', 'key_material': 'keystream', 'fused_encrypt': 'dna_encrypt',
+    'fused_decrypt': 'dna_decrypt', 'save_images': 'save_png', 'save_container': 'save_container',
+}
+
+
+class CostModel:
+    """Stage costs: seconds per MB of tensor and peak bytes per tensor element."""
+
+    def __init__(self, seconds_per_mb=None, bytes_per_element=None, streaming_factor=DEFAULT_STREAMING_FACTOR,
+                 backend='python', source='defaults'):
+        self.seconds_per_mb = {**DEFAULT_SECONDS_PER_MB, **(seconds_per_mb or {})}
+        self.bytes_per_element = {**DEFAULT_BYTES_PER_ELEMENT, **(bytes_per_element or {})}
+        self.streaming_factor = streaming_factor
+        self.backend = backend
+        self.source = source
+
+    @classmethod
+    def from_benchmark(cls, path):
+        """Calibrate from benchmark.py results.
+
+        Stage rates are total seconds over total MB, so the larger cases
+        dominate. The keystream's memory per element is the slope of its
+        peak over the tensor size, and the other stages scale with it.
+        """
+        with open(path) as f:
+            results = json.load(f)
+        cases = results['cases']
+        seconds_per_mb = {}
+        for bench_stage, stage in BENCHMARK_STAGES.items():
+            records = [case['stages'][bench_stage] for case in cases if bench_stage in case['stages']]
+            megabytes = sum(record['bytes'] for record in records) / 2**20
+            if megabytes > 0:
+                seconds_per_mb[stage] = sum(record['seconds'] for record in records) / megabytes
+
+        bytes_per_element = {}
+        growth = [(case['bytes'], case['stages']['key_material']['peak_anon_rss']
+                   - case['stages']['key_material']['start_anon_rss'])
+                  for case in cases if 'start_anon_rss' in case['stages'].get('key_material', {})]
+        sizes = [size for size, _ in growth]
+        if len(set(sizes)) >= 2:
+            mean_size, mean_growth = sum(sizes) / len(sizes), sum(g for _, g in growth) / len(growth)
+            slope = (sum((size - mean_size) * (g - mean_growth) for size, g in growth)
+                     / sum((size - mean_size) ** 2 for size in sizes))
+            if slope > 0:
+                # The tensor itself is already resident when the keystream starts.
+                scale = (slope + 1) / DEFAULT_BYTES_PER_ELEMENT['keystream']
+                bytes_per_element = {stage: value * scale for stage, value in DEFAULT_BYTES_PER_ELEMENT.items()}
+
+        streaming_factor = DEFAULT_STREAMING_FACTOR
+        pairs = [(case['stages']['encrypt_streaming']['seconds'], case['stages']['encrypt_images']['seconds'])
+                 for case in cases if {'encrypt_streaming', 'encrypt_images'} <= case['stages'].keys()]
+        if pairs and sum(memory for _, memory in pairs) > 0:
+            streaming_factor = sum(streamed for streamed, _ in pairs) / sum(memory for _, memory in pairs)
+
+        return cls(seconds_per_mb, bytes_per_element, streaming_factor,
+                   results['environment'].get('keystream_backend', 'python'), f"'{path}' ({len(cases)} cases)")
+
+    @classmethod
+    def load(cls, path=None):
+        """The model calibrated from `path`, else from DEFAULT_CALIBRATION if present, else the defaults."""
+        if path is None and os.path.exists(DEFAULT_CALIBRATION):
+            path = DEFAULT_CALIBRATION
+        return cls.from_benchmark(path) if path else cls()
+
+
+def available_memory():
+    """Bytes of memory available to a new run, or None if unknown."""
+    try:
+        with open('/proc/meminfo') as meminfo:
+            fields = dict(line.split(':', 1) for line in meminfo if ':' in line)
+        return int(fields['MemAvailable'].split()[0]) * 1024
+    except (OSError, KeyError, ValueError):
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+def host_resources(cores=None, memory_budget=None, scratch_dir=None):
+    """Cores, memory budget and free scratch space the plan may use; explicit values win.
+
+    Sizes that cannot be determined are None and do not limit the plan.
+    """
+    if cores is None:
+        cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+    available = available_memory()
+    if memory_budget is None and available is not None:
+        memory_budget = int(available * MEMORY_HEADROOM)
+    scratch_dir = scratch_dir or tempfile.gettempdir()
+    scratch_free = shutil.disk_usage(scratch_dir).free if os.path.isdir(scratch_dir) else None
+    return {'cores': cores, 'available_memory': available, 'memory_budget': memory_budget,
+            'scratch_free': scratch_free, 'keystream_backend': resolve_backend()}
+
+
+def read_batch(action, input_path, manifest=None):
+    """Shapes to plan for, from headers only: (units, input format, image count).
+
+    `units` lists (shapes, channel_map) per tensor: one for a plain batch,
+    one per unit of a decryption manifest.
+    """
+    if action == 'decrypt' and manifest is not None:
+        units = batching.read_manifest(manifest)['units']
+        return ([([unit['original_shapes'][i] for i in range(len(unit['channel_map']))], unit['channel_map'])
+                 for unit in units], 'container', sum(len(unit['channel_map']) for unit in units))
+    if action == 'decrypt':
+        container_path = container.find_container(input_path)
+        if container_path is not None:
+            header = container.read_header(container_path)
+            # Ciphertext keeps the padded size of the whole tensor.
+            M, N, _ = header['shape']
+            return [([(M, N)] * len(header['channel_map']), header['channel_map'])], 'container', \
+                len(header['channel_map'])
+    _, shapes, channel_map = image_handler.read_layout(image_handler.list_images(input_path))
+    return [([shapes[i] for i in range(len(channel_map))], channel_map)], 'png', len(channel_map)
+
+
+def _elements(shapes, channel_map):
+    M, N, n = batching.padded_shape(shapes, channel_map)
+    return M * N * n
+
+
+def _stage_seconds(model, action, elements, input_format, output_format):
+    megabytes = elements / 2**20
+    rate = model.seconds_per_mb
+    stages = {'load': rate[f"load_{input_format}"] * megabytes}
+    if action == 'encrypt':
+        stages['key'] = rate['key'] * megabytes
+    stages['keystream'] = rate['keystream'] * megabytes
+    stages['dna'] = rate[f"dna_{action}"] * megabytes
+    if action == 'decrypt' or output_format == 'png':
+        stages['save'] = rate['save_png'] * megabytes
+    elif output_format == 'both':
+        stages['save'] = (rate['save_png'] + rate['save_container']) * megabytes
+    else:
+        stages['save'] = rate['save_container'] * megabytes
+    return stages
+
+
+def _in_memory(model, action, shapes, channel_map, input_format, output_format, workers=1):
+    elements = _elements(shapes, channel_map)
+    seconds = _stage_seconds(model, action, elements, input_format, output_format)
+    peak = {stage: BASE_BYTES + model.bytes_per_element[stage] * elements for stage in seconds}
+    if workers > 1:
+        seconds['dna'] = seconds['dna'] / (1 + (workers - 1) * PARALLEL_EFFICIENCY) + POOL_START_SECONDS
+        peak['dna'] += PARALLEL_SHARED_BYTES * elements
+    return seconds, peak
+
+
+def _candidate(strategy, options, seconds, peak, scratch=0, units=1):
+    return {'strategy': strategy, 'options': options,
+            'stages': {stage: {'seconds': seconds[stage], 'peak_bytes': peak[stage]} for stage in seconds},
+            'seconds': sum(seconds.values()), 'peak_bytes': max(peak.values()), 'scratch_bytes': scratch,
+            'units': units}
+
+
+def streaming_memory_limit(budget, shapes, channel_map):
+    """Largest row-block ceiling (bytes) that keeps a streaming run within `budget`, capped at the default.
+
+    Also returns the bytes a streaming run needs besides its blocks: the
+    argsort over the M*N pixel positions and the per-image arrays.
+    """
+    M, N, n = batching.padded_shape(shapes, channel_map)
+    fixed = BASE_BYTES + 16 * M * N + 2 * max(h * w * c for (h, w), c in zip(shapes, channel_map))
+    limit = DEFAULT_MEMORY_LIMIT if budget is None else min(budget - fixed, DEFAULT_MEMORY_LIMIT)
+    # One row of the heaviest stage is the smallest block there is.
+    return int(max(limit, BYTES_PER_ELEMENT * N * n)), fixed
+
+
+def candidates(model, action, units, input_format, output_format, host, max_waste=batching.DEFAULT_MAX_WASTE,
+               from_manifest=False):
+    """Estimates for every strategy that applies to the batch."""
+    cores = host['cores']
+    options = []
+    if from_manifest:
+        # A decryption manifest: its units are decrypted one after another.
+        for workers in sorted({1, cores}):
+            per_unit = [_in_memory(model, action, shapes, channel_map, input_format, output_format, workers)
+                        for shapes, channel_map in units]
+            options.append(_units_candidate(per_unit, {'workers': workers}, units))
+        return options
+
+    shapes, channel_map = units[0]
+    for workers in sorted({1, cores}):
+        seconds, peak = _in_memory(model, action, shapes, channel_map, input_format, output_format, workers)
+        options.append(_candidate('memory' if workers == 1 else 'parallel', {'workers': workers}, seconds, peak))
+
+    elements = _elements(shapes, channel_map)
+    memory_limit, fixed = streaming_memory_limit(host['memory_budget'], shapes, channel_map)
+    seconds = {stage: value * model.streaming_factor
+               for stage, value in _stage_seconds(model, action, elements, input_format, output_format).items()}
+    peak = {stage: fixed + min(memory_limit, BYTES_PER_ELEMENT * elements) for stage in seconds}
+    options.append(_candidate('streaming', {'streaming': True, 'memory_limit': memory_limit // 2**20}, seconds, peak,
+                              SCRATCH_BYTES_PER_ELEMENT[action] * elements))
+
+    if action == 'encrypt' and batching.padding_waste(shapes, channel_map) > max_waste:
+        buckets = batching.plan_buckets(shapes, channel_map, max_waste)
+        if len(buckets) > 1:
+            bucket_units = [([shapes[i] for i in bucket], [channel_map[i] for i in bucket]) for bucket in buckets]
+            for workers in sorted({1, cores}):
+                per_unit = [_in_memory(model, action, unit_shapes, unit_map, input_format, output_format, workers)
+                            for unit_shapes, unit_map in bucket_units]
+                options.append(_units_candidate(per_unit, {'max_padding': max_waste, 'workers': workers},
+                                                bucket_units, 'bucketed'))
+    return options
+
+
+def _units_candidate(per_unit, options, units, strategy='units'):
+    # Units run on the overlapped load/process/save pipeline: the wall time
+    # is about the processing of every unit plus loading the first and
+    # saving the last, and up to four more unit tensors are in flight.
+    seconds = {stage: sum(unit[0][stage] for unit in per_unit) for stage in per_unit[0][0]}
+    for stage in ('load', 'save'):
+        seconds[stage] = max(unit[0][stage] for unit in per_unit)
+    largest = max(_elements(*unit) for unit in units)
+    peak = {stage: max(unit[1][stage] for unit in per_unit) + 4 * largest for stage in seconds}
+    return _candidate(strategy, options, seconds, peak, units=len(units))
+
+
+def choose(options, host):
+    """The fastest candidate that fits the memory budget and scratch space, or None.
+
+    Units change what a run produces (a manifest of keys instead of one
+    key), so bucketing is only chosen when it is clearly faster, by a share
+    of the time and by an absolute margin that small batches never reach.
+    """
+    for option in options:
+        option['fits'] = ((host['memory_budget'] is None or option['peak_bytes'] <= host['memory_budget'])
+                          and (host['scratch_free'] is None or option['scratch_bytes'] <= host['scratch_free']))
+    fitting = [option for option in options if option['fits']]
+    if not fitting:
+        return None
+    single = [option for option in fitting if option['strategy'] != 'bucketed']
+    best = min(fitting, key=lambda option: option['seconds'])
+    if best['strategy'] == 'bucketed' and single:
+        best_single = min(single, key=lambda option: option['seconds'])
+        saving = best_single['seconds'] - best['seconds']
+        if saving < max(UNIT_MIN_GAIN * best_single['seconds'], UNIT_MIN_SECONDS):
+            return best_single
+    return best
+
+
+def plan(action, input_path, manifest=None, output_format='container', max_waste=None, cores=None,
+         memory_budget=None, scratch_dir=None, model=None):
+    """Estimate every strategy for a batch without touching its pixels, and choose one."""
+    model = model or CostModel()
+    host = host_resources(cores, memory_budget, scratch_dir)
+    units, input_format, images = read_batch(action, input_path, manifest)
+    max_waste = batching.DEFAULT_MAX_WASTE if max_waste is None else max_waste
+    options = candidates(model, action, units, input_format, output_format, host, max_waste,
+                         from_manifest=action == 'decrypt' and manifest is not None)
+    chosen = choose(options, host)
+    return {
+        'action': action, 'input': input_path, 'images': images,
+        'shapes': [list(batching.padded_shape(*unit)) for unit in units],
+        'padding_waste': batching.padding_waste(*units[0]) if len(units) == 1 else None,
+        'host': host, 'model': {'source': model.source, 'keystream_backend': model.backend},
+        'candidates': options, 'chosen': chosen['strategy'] if chosen else None,
+        'options': chosen['options'] if chosen else None,
+    }
+
+
+def format_options(options):
+    """Command-line flags of main.py that run a chosen strategy."""
+    flags = []
+    if options.get('streaming'):
+        flags += ['--streaming', f"--memory-limit {options['memory_limit']}"]
+    if 'max_padding' in options:
+        flags.append(f"--max-padding {options['max_padding']}")
+    if options.get('workers', 1) > 1:
+        flags.append(f"--workers {options['workers']}")
+    return " ".join(flags)
+
+
+def _mb(value):
+    return 'unknown' if value is None else f"{value / 2**20:.0f} MB"
+
+
+def format_plan(result):
+    host = result['host']
+    shapes = ", ".join('x'.join(map(str, shape)) for shape in result['shapes'][:4])
+    if len(result['shapes']) > 4:
+        shapes += f", ... ({len(result['shapes'])} units)"
+    waste = f", {result['padding_waste']:.0%} padding" if result['padding_waste'] is not None else ""
+    model = result['model']
+    lines = [
+        f"Plan to {result['action']} {result['images']} image(s) from '{result['input']}': {shapes} tensor{waste}",
+        f"Host: {host['cores']} core(s), {_mb(host['available_memory'])} available, budget "
+        f"{_mb(host['memory_budget'])}, {_mb(host['scratch_free'])} free scratch space",
+        f"Cost model: {model['source']}, '{model['keystream_backend']}' keystream",
+    ]
+    if model['keystream_backend'] != host['keystream_backend']:
+        lines.append(f"Warning: this host runs the '{host['keystream_backend']}' keystream; run benchmark.py here "
+                     f"to calibrate the model.")
+    lines += [
+        "",
+        f"{'Strategy':<10} {'Workers':>7} {'Units':>5} {'Time (s)':>9} {'Peak (MB)':>10} {'Scratch (MB)':>12}  Fits",
+    ]
+    for option in result['candidates']:
+        lines.append(f"{option['strategy']:<10} {option['options'].get('workers', 1):>7} {option['units']:>5} "
+                     f"{option['seconds']:>9.1f} {option['peak_bytes'] / 2**20:>10.0f} "
+                     f"{option['scratch_bytes'] / 2**20:>12.0f}  {'yes' if option['fits'] else 'no'}")
+    chosen = next((option for option in result['candidates'] if option['strategy'] == result['chosen']
+                   and option['options'] == result['options']), None)
+    if chosen is None:
+        lines.append("\nNo strategy fits the memory budget and scratch space; use a larger host.")
+        return "\n".join(lines)
+    lines.append(f"\nChosen: {chosen['strategy']} {format_options(chosen['options'])}".rstrip())
+    lines.append(f"  {'Stage':<10} {'Time (s)':>9} {'Peak (MB)':>10}")
+    for stage, estimate in chosen['stages'].items():
+        lines.append(f"  {stage:<10} {estimate['seconds']:>9.2f} {estimate['peak_bytes'] / 2**20:>10.0f}")
+    return "\n".join(lines)
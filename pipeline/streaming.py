@@ -0,0 +1,215 @@
+"""Bounded-memory encryption and decryption.
+
+Every full-size intermediate lives in a memory-mapped scratch file and is
+produced and consumed in row-blocks sized from a memory ceiling, so the
+anonymous (heap) memory of a run stays roughly constant no matter how many
+images are in the batch. The output is identical to encrypt_images /
+decrypt_images.
+
+The only allocations that still grow with the batch are the argsort of the
+first M*N chaotic values (16 bytes per pixel position) and the per-image
+arrays used when reading and writing image files.
+"""
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from chaotic_maps.tdlcic import tdlcic_chunks
+from dna_operations import core, diffusion
+from dna_operations.scramble import ScramblePlan
+from utils import container, image_handler
+from utils.key_material import TRANSIENT_ITERATIONS, KeyMaterial, key_parameters, plaintext_key, smallest_index_dtype
+from utils.instrumentation import Instrumentation, PrintSink
+
+DEFAULT_MEMORY_LIMIT = 1024 * 2**20
+# Working-set bytes per (pixel, channel) value of a row-block in the heaviest
+# stage: float64 chaotic values, their temporaries and the argsort output.
+BYTES_PER_ELEMENT = 48
+
+
+def rows_per_block(memory_limit, N, n):
+    return max(1, int(memory_limit // (BYTES_PER_ELEMENT * N * n)))
+
+def row_blocks(M, block_rows):
+    for r0 in range(0, M, block_rows):
+        yield r0, min(r0 + block_rows, M)
+
+
+class ScratchSpace:
+    def __init__(self, root=None):
+        if root is not None:
+            os.makedirs(root, exist_ok=True)
+        self.directory = tempfile.mkdtemp(prefix='mie-scratch-', dir=root)
+
+    def path(self, name):
+        return os.path.join(self.directory, f"{name}.npy")
+
+    def create(self, name, shape, dtype):
+        return open_memmap(self.path(name), mode='w+', dtype=dtype, shape=shape)
+
+    def open(self, name, mode='r'):
+        return np.load(self.path(name), mmap_mode=mode)
+
+    def cleanup(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def derive_key_material(K, shape, scratch, block_rows, backend=None):
+    M, N, n = shape
+    sum_pixels, total = M * N, M * N * n
+    if total % 2:
+        raise ValueError("M * N * n must be even to lay out the chaotic sequences.")
+    half = total // 2
+    a, b, x0, y0 = key_parameters(K)
+
+    # xy = concatenate((x, y)) after the transient, filled chunk by chunk.
+    xy = scratch.create('xy', (total,), np.float64)
+    position = -TRANSIENT_ITERATIONS
+    for x, y in tdlcic_chunks(x0, y0, a, b, half + TRANSIENT_ITERATIONS, max(1, block_rows * N * n // 2), backend):
+        skip = max(0, -position)
+        if skip < len(x):
+            xy[position + skip:position + len(x)] = x[skip:]
+            xy[half + position + skip:half + position + len(x)] = y[skip:]
+        position += len(x)
+
+    S_store = scratch.create('S', (sum_pixels,), smallest_index_dtype(sum_pixels))
+    S_store[:] = np.argsort(xy[:sum_pixels])
+    C_store = scratch.create('C_matrix', shape, np.uint8)
+    E_store = scratch.create('E', shape, np.uint8)
+    G_store = scratch.create('G', (sum_pixels, n), smallest_index_dtype(n))
+    for r0, r1 in row_blocks(M, block_rows):
+        xy_block = xy[r0 * N * n:r1 * N * n]
+        E = (np.floor(np.abs(xy_block) * 1e14).astype(np.uint64) % 256).astype(np.uint8).reshape(r1 - r0, N, n)
+        E_store[r0:r1] = E
+        C_store[r0:r1] = E % 8
+        G_store[r0 * N:r1 * N] = np.argsort(xy_block.reshape(-1, n), axis=1)
+    ScramblePlan.from_sequences(S_store, G_store, index=scratch.create('scramble_index', (total,), np.intp))
+    for store in (S_store, C_store, E_store, G_store):
+        store.flush()
+    del xy, S_store, C_store, E_store, G_store
+    os.remove(scratch.path('xy'))
+    return KeyMaterial.load(scratch.directory, K, shape)
+
+
+def _load_to_scratch(input_folder, scratch, name):
+    paths = image_handler.list_images(input_folder)
+    shape, original_shapes, channel_map = image_handler.read_layout(paths)
+    image_handler.load_into(paths, scratch.create(name, shape, np.uint8), channel_map)
+    return paths, shape, original_shapes, channel_map
+
+
+def encrypt_images_streaming(input_folder, output_folder, memory_limit=DEFAULT_MEMORY_LIMIT, scratch_dir=None,
+                             backend=None, instrumentation=None,
+                             compress_level=image_handler.DEFAULT_COMPRESS_LEVEL, output_format='container'):
+    instrumentation = instrumentation or Instrumentation([PrintSink(report=True)])
+    stage = instrumentation.stage
+    scratch = ScratchSpace(scratch_dir)
+    try:
+        with stage('load', "Step 1: Loading images into scratch storage...") as record:
+            paths, shape, original_shapes, channel_map = _load_to_scratch(input_folder, scratch, 'P')
+            P = scratch.open('P')
+            record['bytes'] = nbytes = P.nbytes
+        M, N, n = shape
+        block_rows = rows_per_block(memory_limit, N, n)
+        blocks = list(row_blocks(M, block_rows))
+        instrumentation.note(f"  {M}x{N}x{n} tensor in blocks of {block_rows} rows")
+
+        with stage('key', "Step 2: Generating plaintext-related key...", nbytes):
+            K = plaintext_key(P)
+
+        with stage('keystream', "Step 3: Generating chaotic sequences...", nbytes):
+            material = derive_key_material(K, shape, scratch, block_rows, backend)
+
+        with stage('encode', "Step 4: Performing DNA Cyclic Shift Encoding...", nbytes):
+            P_dna1 = scratch.create('P_dna1', (M, N, 4 * n), np.uint8)
+            for r0, r1 in blocks:
+                P_dna1[r0:r1] = core.cyclic_shift_encode(P[r0:r1], material.C_matrix[r0:r1])
+
+        with stage('scramble', "Step 5: Performing Global Exchange Scrambling...", nbytes):
+            P_dna2 = scratch.create('P_dna2', (M, N, 4 * n), np.uint8)
+            plan = material.plan
+            for r0, r1 in blocks:
+                P_dna2[r0:r1] = plan.gather(P_dna1, r0 * N * n, r1 * N * n).reshape(r1 - r0, N, 4 * n)
+
+        with stage('diffusion', "Step 6: Performing Multi-Directional DNA Diffusion...", nbytes):
+            previous_row = None
+            for r0, r1 in blocks:
+                E_dna = core.encode_with_rule(material.E[r0:r1])
+                P_dna3 = diffusion.lateral_diffusion(P_dna2[r0:r1], E_dna, previous_row)
+                previous_row = P_dna3[-1].copy()
+                P_dna2[r0:r1] = diffusion.strand_diffusion(P_dna3)
+
+        with stage('decode', "Step 7: Final decoding to pixels...", nbytes):
+            P_end = scratch.create('P_end', shape, np.uint8)
+            for r0, r1 in blocks:
+                P_end[r0:r1] = core.final_decode_to_pixels(P_dna2[r0:r1], material.C_matrix[r0:r1])
+
+        with stage('save', f"Step 8: Saving encrypted images to '{output_folder}'...", nbytes):
+            image_handler.save_ciphertext(P_end, output_folder, paths, original_shapes, channel_map, output_format,
+                                          compress_level)
+    finally:
+        scratch.cleanup()
+    instrumentation.note("Encryption complete.")
+    instrumentation.finish()
+    return K
+
+
+def decrypt_images_streaming(input_folder, output_folder, K, memory_limit=DEFAULT_MEMORY_LIMIT, scratch_dir=None,
+                             backend=None, instrumentation=None,
+                             compress_level=image_handler.DEFAULT_COMPRESS_LEVEL):
+    instrumentation = instrumentation or Instrumentation([PrintSink(report=True)])
+    stage = instrumentation.stage
+    scratch = ScratchSpace(scratch_dir)
+    try:
+        with stage('load', "Step 1: Loading encrypted images into scratch storage...") as record:
+            container_path = container.find_container(input_folder)
+            if container_path is not None:
+                # The container payload is already a memory-mapped tensor.
+                P_end, original_shapes, channel_map, paths = container.read_container(container_path)
+            else:
+                paths, _, original_shapes, channel_map = _load_to_scratch(input_folder, scratch, 'P_end')
+                P_end = scratch.open('P_end')
+            record['bytes'] = nbytes = P_end.nbytes
+        M, N, n = shape = P_end.shape
+        block_rows = rows_per_block(memory_limit, N, n)
+        blocks = list(row_blocks(M, block_rows))
+        instrumentation.note(f"  {M}x{N}x{n} tensor in blocks of {block_rows} rows")
+
+        with stage('keystream', "Step 2: Regenerating chaotic sequences...", nbytes):
+            material = derive_key_material(K, shape, scratch, block_rows, backend)
+
+        with stage('encode', "Step 3: Preparing for inverse diffusion...", nbytes):
+            P_dna = scratch.create('P_dna', (M, N, 4 * n), np.uint8)
+            for r0, r1 in blocks:
+                P_dna[r0:r1] = core.initial_encode_for_decryption(P_end[r0:r1], material.C_matrix[r0:r1])
+
+        with stage('diffusion', "Step 4: Performing Inverse Multi-Directional DNA Diffusion...", nbytes):
+            previous_row = None
+            for r0, r1 in blocks:
+                E_dna = core.encode_with_rule(material.E[r0:r1])
+                P_dna3 = diffusion.inverse_strand_diffusion(P_dna[r0:r1])
+                P_dna[r0:r1] = diffusion.inverse_lateral_diffusion(P_dna3, E_dna, previous_row)
+                previous_row = P_dna3[-1].copy()
+
+        with stage('scramble', "Step 5: Performing Inverse Global Exchange Scrambling...", nbytes):
+            inverse_plan = material.plan.inverse(out=scratch.create('inverse_index', (M * N * n,), np.intp),
+                                                 block_size=block_rows * N * n)
+            P_dna1 = scratch.create('P_dna1', (M, N, 4 * n), np.uint8)
+            for r0, r1 in blocks:
+                P_dna1[r0:r1] = inverse_plan.gather(P_dna, r0 * N * n, r1 * N * n).reshape(r1 - r0, N, 4 * n)
+
+        with stage('decode', "Step 6: Performing Inverse DNA Cyclic Shift Encoding...", nbytes):
+            P_decrypted = scratch.create('P_decrypted', shape, np.uint8)
+            for r0, r1 in blocks:
+                P_decrypted[r0:r1] = core.cyclic_shift_decode(P_dna1[r0:r1], material.C_matrix[r0:r1])
+
+        with stage('save', f"Step 7: Saving decrypted images to '{output_folder}'...", nbytes):
+            image_handler.save_images(P_decrypted, output_folder, paths, original_shapes, channel_map,
+                                      compress_level=compress_level)
+    finally:
+        scratch.cleanup()
+    instrumentation.note("Decryption complete.")
+    instrumentation.finish()
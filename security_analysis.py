@@ -0,0 +1,250 @@
+"""
+Security Metrics Engine
+
+Batch NumPy implementation of the metrics analyze_security.py reports:
+1. Adjacent-pixel correlation (horizontal, vertical, diagonal), over all
+   pairs or a random sample of pairs
+2. NPCR and UACI between two images
+3. Shannon entropy and histogram chi-square
+
+Every channel of every image is a 2-D plane. Planes of the same size are
+stacked and measured in one vectorized pass, and large folders are split
+across a process pool.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from utils import container, image_handler
+
+THEORETICAL_NPCR = 99.6094
+THEORETICAL_UACI = 33.4635
+THEORETICAL_ENTROPY = 8.0
+DIRECTIONS = ('horizontal', 'vertical', 'diagonal')
+# Upper bound for the float64 temporaries of one vectorized pass.
+CHUNK_BYTES = 256 * 2**20
+# Folders smaller than this are not worth starting a process pool for.
+MIN_PARALLEL_IMAGES = 8
+
+
+def load_planes(path):
+    """Return an image as an (C, H, W) uint8 array of channel planes, without alpha."""
+    with Image.open(path) as img:
+        array = np.array(img, dtype=np.uint8)
+    if array.ndim == 2:
+        return array[None]
+    return np.moveaxis(array[:, :, :3], -1, 0)
+
+
+def _adjacent(stack, direction):
+    if direction == 'horizontal':
+        return stack[:, :, :-1], stack[:, :, 1:]
+    if direction == 'vertical':
+        return stack[:, :-1, :], stack[:, 1:, :]
+    return stack[:, :-1, :-1], stack[:, 1:, 1:]
+
+
+def _pearson(x, y):
+    # Row-wise Pearson coefficient of two (B, L) arrays.
+    x = x.reshape(len(x), -1).astype(np.float64)
+    y = y.reshape(len(y), -1).astype(np.float64)
+    x -= x.mean(axis=1, keepdims=True)
+    y -= y.mean(axis=1, keepdims=True)
+    numerator = (x * y).sum(axis=1)
+    denominator = np.sqrt((x * x).sum(axis=1) * (y * y).sum(axis=1))
+    return np.divide(numerator, denominator, out=np.zeros_like(numerator), where=denominator > 0)
+
+
+def _chunks(stack, bytes_per_plane):
+    step = max(1, CHUNK_BYTES // max(1, bytes_per_plane))
+    for start in range(0, len(stack), step):
+        yield stack[start:start + step]
+
+
+def correlation(stack, sample=None, seed=0):
+    """Adjacent-pixel correlation of each plane of a (B, H, W) stack.
+
+    Returns {direction: (B,) array}. With `sample`, that many random pairs
+    are drawn per direction; the positions depend only on the seed and the
+    plane size, so every plane of a size uses the same pairs.
+    """
+    B, H, W = stack.shape
+    results = {}
+    rng = np.random.default_rng([seed, H, W])
+    for direction in DIRECTIONS:
+        x, y = _adjacent(stack, direction)
+        if sample is not None and sample < x[0].size:
+            rows = rng.integers(0, x.shape[1], sample)
+            cols = rng.integers(0, x.shape[2], sample)
+            x, y = x[:, rows, cols], y[:, rows, cols]
+        values = [_pearson(cx, cy) for cx, cy in zip(_chunks(x, x[0].size * 24), _chunks(y, y[0].size * 24))]
+        results[direction] = np.concatenate(values) if values else np.zeros(0)
+    return results
+
+
+def histograms(stack):
+    """(B, 256) pixel value counts of each plane."""
+    B = len(stack)
+    offsets = (np.arange(B, dtype=np.intp) * 256)[:, None]
+    return np.bincount((stack.reshape(B, -1) + offsets).ravel(), minlength=B * 256).reshape(B, 256)
+
+
+def entropy(counts):
+    p = counts / counts.sum(axis=1, keepdims=True)
+    return -np.sum(p * np.log2(p, out=np.zeros_like(p), where=p > 0), axis=1)
+
+
+def chi_square(counts):
+    expected = counts.sum(axis=1, keepdims=True) / 256
+    return np.sum((counts - expected) ** 2 / expected, axis=1)
+
+
+def npcr_uaci(a, b):
+    """NPCR and UACI in percent between two (B, H, W) stacks, per plane."""
+    npcr, uaci = [], []
+    for ca, cb in zip(_chunks(a, a[0].size * 4), _chunks(b, b[0].size * 4)):
+        difference = np.abs(ca.astype(np.int16) - cb).reshape(len(ca), -1)
+        npcr.append(np.count_nonzero(difference, axis=1) / difference.shape[1] * 100)
+        uaci.append(difference.mean(axis=1) / 255 * 100)
+    return np.concatenate(npcr), np.concatenate(uaci)
+
+
+def _group_planes(images):
+    # {(H, W): (stack of planes, [(image index, channel), ...])}
+    groups = {}
+    for i, planes in enumerate(images):
+        for c, plane in enumerate(planes):
+            groups.setdefault(plane.shape, ([], []))
+            groups[plane.shape][0].append(plane)
+            groups[plane.shape][1].append((i, c))
+    return {shape: (np.stack(planes), owners) for shape, (planes, owners) in groups.items()}
+
+
+def _summarize(per_channel):
+    summary = {key: float(np.mean([channel[key] for channel in per_channel])) for key in per_channel[0]}
+    summary['channels'] = per_channel
+    return summary
+
+
+def image_metrics(images, sample=None, seed=0):
+    """Correlation, entropy and chi-square for a list of (C, H, W) plane arrays."""
+    per_channel = [[None] * len(planes) for planes in images]
+    for stack, owners in _group_planes(images).values():
+        corr = correlation(stack, sample, seed)
+        counts = histograms(stack)
+        ent, chi = entropy(counts), chi_square(counts)
+        for k, (i, c) in enumerate(owners):
+            per_channel[i][c] = {**{d: float(corr[d][k]) for d in DIRECTIONS},
+                                 'entropy': float(ent[k]), 'chi_square': float(chi[k])}
+    return [_summarize(channels) for channels in per_channel]
+
+
+def differential_metrics(pairs):
+    """NPCR and UACI for a list of ((C, H, W), (C, H, W)) plane arrays.
+
+    Images are compared over their common area and channels, since padded
+    ciphertext can be larger than the original.
+    """
+    cropped = []
+    for a, b in pairs:
+        c, h, w = (min(sa, sb) for sa, sb in zip(a.shape, b.shape))
+        cropped.append((a[:c, :h, :w], b[:c, :h, :w]))
+    per_channel = [[None] * len(a) for a, _ in cropped]
+    groups = _group_planes([a for a, _ in cropped])
+    others = _group_planes([b for _, b in cropped])
+    for shape, (stack, owners) in groups.items():
+        npcr, uaci = npcr_uaci(stack, others[shape][0])
+        for k, (i, c) in enumerate(owners):
+            per_channel[i][c] = {'NPCR': float(npcr[k]), 'UACI': float(uaci[k])}
+    return [_summarize(channels) for channels in per_channel]
+
+
+def _analyze_paths(task):
+    paths, sample, seed = task
+    return image_metrics([load_planes(path) for path in paths], sample, seed)
+
+
+def _original_stem(name):
+    # Containers keep the original file names; the PNG export appends _processed.
+    stem = os.path.splitext(os.path.basename(name))[0]
+    return stem[:-len('_processed')] if stem.endswith('_processed') else stem
+
+
+def _compare_paths(pairs):
+    return differential_metrics([(load_planes(a), load_planes(b)) for a, b in pairs])
+
+
+class SecurityAnalyzer:
+    """Security metrics over single images, folders and ciphertext containers.
+
+    `sample` switches correlation to that many random pairs per direction
+    (None uses every pair). Folders of at least MIN_PARALLEL_IMAGES images
+    are split across `workers` processes.
+    """
+
+    def __init__(self, sample=None, workers=1, seed=0):
+        self.sample, self.workers, self.seed = sample, workers, seed
+
+    def _map(self, func, items, make_task):
+        if self.workers <= 1 or len(items) < MIN_PARALLEL_IMAGES:
+            return func(make_task(items))
+        bounds = np.linspace(0, len(items), min(len(items), self.workers * 4) + 1).astype(int)
+        tasks = [make_task(items[start:stop]) for start, stop in zip(bounds[:-1], bounds[1:])]
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            return [result for chunk in pool.map(func, tasks) for result in chunk]
+
+    def analyze_images(self, paths):
+        """{file name: metrics} for correlation, entropy and chi-square of each image."""
+        paths = list(paths)
+        results = self._map(_analyze_paths, paths, lambda chunk: (chunk, self.sample, self.seed))
+        return {os.path.basename(path): result for path, result in zip(paths, results)}
+
+    def analyze_folder(self, folder_path):
+        """Metrics for every image in a folder, or in the ciphertext container it holds.
+
+        Container images keep their padding, as in the PNG export.
+        """
+        container_path = container.find_container(folder_path)
+        if container_path is None:
+            return self.analyze_images(image_handler.list_images(folder_path))
+        P_end, original_shapes, channel_map, names = container.read_container(container_path)
+        images = [np.moveaxis(np.atleast_3d(img), -1, 0)
+                  for img in image_handler.split_images(P_end, original_shapes, channel_map, crop=False)]
+        results = image_metrics(images, self.sample, self.seed)
+        return {name: result for name, result in zip(names, results)}
+
+    def analyze_pairs(self, original_paths, encrypted_paths):
+        """{original file name: {'NPCR', 'UACI', 'channels'}} for matched image pairs."""
+        pairs = list(zip(original_paths, encrypted_paths))
+        results = self._map(_compare_paths, pairs, lambda chunk: chunk)
+        return {os.path.basename(a): result for (a, _), result in zip(pairs, results)}
+
+    def analyze_ciphertext_pairs(self, original_folder, encrypted_folder):
+        """{original file name: {'NPCR', 'UACI', 'channels'}} against an encrypted folder.
+
+        The ciphertext is read from the folder's container or its
+        _processed.png files and matched to the originals by name.
+        """
+        P_end, original_shapes, channel_map, names = image_handler.load_ciphertext(encrypted_folder)
+        encrypted = {_original_stem(name): np.moveaxis(np.atleast_3d(img), -1, 0)
+                     for name, img in zip(names, image_handler.split_images(P_end, original_shapes, channel_map,
+                                                                             crop=False))}
+        pairs = {}
+        for path in image_handler.list_images(original_folder):
+            planes = encrypted.get(_original_stem(path))
+            if planes is not None:
+                pairs[os.path.basename(path)] = (load_planes(path), planes)
+        return dict(zip(pairs, differential_metrics(list(pairs.values()))))
+
+    @staticmethod
+    def analyze_correlation(image_path):
+        result = image_metrics([load_planes(image_path)])[0]
+        return {direction: result[direction] for direction in DIRECTIONS}
+
+    @staticmethod
+    def analyze_differential_attack(original_path, encrypted_path):
+        result = differential_metrics([(load_planes(original_path), load_planes(encrypted_path))])[0]
+        return {'NPCR': result['NPCR'], 'UACI': result['UACI']}
@@ -0,0 +1,118 @@
+"""Vectorized and packed DNA diffusion against the original per-element loops."""
+import numpy as np
+import pytest
+
+from dna_operations import core, diffusion
+
+SHAPES = [(1, 1, 1), (2, 2, 1), (5, 3, 1), (3, 7, 2), (6, 4, 3), (7, 5, 4)]
+
+
+# The loops from encrypt.py / decrypt.py before diffusion was vectorized.
+
+def reference_lateral_diffusion(P_dna2, E_dna):
+    M, N, z_len = P_dna2.shape
+    P_dna3 = P_dna2.copy()
+    for i in range(M):
+        for j in range(N):
+            for z in range(z_len):
+                if i == 0:
+                    P_dna3[i, j, z] = core.ADD_TABLE[P_dna2[i, j, z], E_dna[i, j, z]]
+                else:
+                    add_val = core.ADD_TABLE[P_dna2[i, j, z], P_dna3[i-1, j, z]]
+                    P_dna3[i, j, z] = core.ADD_TABLE[add_val, E_dna[i, j, z]]
+    return P_dna3
+
+def reference_strand_diffusion(P_dna3):
+    M, N, _ = P_dna3.shape
+    P_dna4 = P_dna3.copy()
+    for i in range(M):
+        for j in range(N):
+            P_dna4[i, j, 0] = core.XOR_TABLE[P_dna3[i, j, 0], P_dna3[i, j, -1]]
+            for z in range(1, P_dna3.shape[2]):
+                P_dna4[i, j, z] = core.XOR_TABLE[P_dna3[i, j, z], P_dna4[i, j, z-1]]
+    return P_dna4
+
+def reference_inverse_strand_diffusion(P_dna4):
+    M, N, z_len = P_dna4.shape
+    P_dna3 = P_dna4.copy()
+    for i in range(M):
+        for j in range(N):
+            for z in range(z_len - 1, 0, -1):
+                P_dna3[i, j, z] = core.XOR_TABLE[P_dna4[i, j, z], P_dna4[i, j, z - 1]]
+            P_dna3[i, j, 0] = core.XOR_TABLE[P_dna4[i, j, 0], P_dna3[i, j, -1]]
+    return P_dna3
+
+def reference_inverse_lateral_diffusion(P_dna3, E_dna):
+    M, N, z_len = P_dna3.shape
+    P_dna2 = P_dna3.copy()
+    for i in range(M - 1, -1, -1):
+        for j in range(N - 1, -1, -1):
+            for z in range(z_len - 1, -1, -1):
+                if i == 0:
+                    P_dna2[i, j, z] = core.SUB_TABLE[P_dna3[i, j, z], E_dna[i, j, z]]
+                else:
+                    sub_val_1 = core.SUB_TABLE[P_dna3[i, j, z], E_dna[i, j, z]]
+                    P_dna2[i, j, z] = core.SUB_TABLE[sub_val_1, P_dna2[i-1, j, z]]
+    return P_dna2
+
+
+def random_case(shape, seed):
+    # A DNA tensor of base codes and the key stream E with its rule-0 encoding.
+    rng = np.random.default_rng(seed)
+    M, N, n = shape
+    P_dna = rng.integers(0, 4, (M, N, 4 * n), dtype=np.uint8)
+    E = rng.integers(0, 256, shape, dtype=np.uint8)
+    return P_dna, E, core.encode_with_rule(E)
+
+
+@pytest.mark.parametrize('shape', SHAPES)
+def test_lateral_diffusion_matches_loops(shape):
+    P_dna, _, E_dna = random_case(shape, 0)
+    expected = reference_lateral_diffusion(P_dna, E_dna)
+    assert np.array_equal(diffusion.lateral_diffusion(P_dna, E_dna), expected)
+    assert np.array_equal(reference_inverse_lateral_diffusion(expected, E_dna), P_dna)
+    assert np.array_equal(diffusion.inverse_lateral_diffusion(expected, E_dna), P_dna)
+
+
+@pytest.mark.parametrize('shape', SHAPES)
+def test_lateral_diffusion_in_row_blocks(shape):
+    P_dna, _, E_dna = random_case(shape, 1)
+    expected = reference_lateral_diffusion(P_dna, E_dna)
+    blocks, previous_row = [], None
+    for r0 in range(0, shape[0], 2):
+        blocks.append(diffusion.lateral_diffusion(P_dna[r0:r0 + 2], E_dna[r0:r0 + 2], previous_row))
+        previous_row = blocks[-1][-1]
+    assert np.array_equal(np.concatenate(blocks), expected)
+    restored, previous_row = [], None
+    for r0 in range(0, shape[0], 2):
+        restored.append(diffusion.inverse_lateral_diffusion(expected[r0:r0 + 2], E_dna[r0:r0 + 2], previous_row))
+        previous_row = expected[r0:r0 + 2][-1]
+    assert np.array_equal(np.concatenate(restored), P_dna)
+
+
+@pytest.mark.parametrize('shape', SHAPES)
+def test_strand_diffusion_matches_loops(shape):
+    P_dna, _, _ = random_case(shape, 2)
+    expected = reference_strand_diffusion(P_dna)
+    assert np.array_equal(diffusion.strand_diffusion(P_dna), expected)
+    assert np.array_equal(reference_inverse_strand_diffusion(expected), P_dna)
+    assert np.array_equal(diffusion.inverse_strand_diffusion(expected), P_dna)
+
+
+@pytest.mark.parametrize('shape', SHAPES)
+def test_packed_diffusion_matches_loops(shape):
+    P_dna, E, E_dna = random_case(shape, 3)
+    lateral = reference_lateral_diffusion(P_dna, E_dna)
+    strand = reference_strand_diffusion(lateral)
+
+    packed = core.pack_bases(P_dna)
+    diffusion.packed_lateral_diffusion(packed, E)
+    assert np.array_equal(packed, core.pack_bases(lateral))
+    diffusion.packed_strand_diffusion(packed)
+    assert np.array_equal(packed, core.pack_bases(strand))
+
+    diffusion.packed_inverse_strand_diffusion(packed)
+    assert np.array_equal(packed, core.pack_bases(lateral))
+    out = np.empty_like(packed)
+    diffusion.packed_inverse_lateral_diffusion(packed, E, out)
+    assert np.array_equal(out, core.pack_bases(P_dna))
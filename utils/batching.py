@@ -0,0 +1,167 @@
+"""Size-bucketed batching.
+
+A batch is padded to its largest height and width, so mixing one large photo
+with thumbnails makes every thumbnail as expensive as the photo. The planner
+groups images into buckets whose padding stays under a waste ratio; each
+bucket is then encrypted as its own unit with its own key, and a manifest
+records the units so decryption can find them again. Frame sequences use
+the same units, cut into consecutive fixed-size groups instead.
+"""
+import json
+import os
+
+from utils import container, journal
+
+MANIFEST_FORMAT = 'mie-manifest'
+MANIFEST_VERSION = 1
+DEFAULT_MAX_WASTE = 0.25
+DEFAULT_GROUP_SIZE = 16
+
+
+def padded_shape(shapes, channel_map):
+    return (max(h for h, _ in shapes), max(w for _, w in shapes), sum(channel_map))
+
+def padding_waste(shapes, channel_map):
+    """Fraction of the padded (M, N, n) tensor that is padding."""
+    M, N, n = padded_shape(shapes, channel_map)
+    used = sum(h * w * c for (h, w), c in zip(shapes, channel_map))
+    return 1 - used / (M * N * n)
+
+def valid_unit(shapes, channel_map):
+    # The chaotic sequences are laid out in two halves and argsorted per
+    # pixel over n values, so a unit needs an even M*N*n and n >= 2.
+    M, N, n = padded_shape(shapes, channel_map)
+    return n >= 2 and (M * N * n) % 2 == 0
+
+def _check_valid(unit, shapes, channel_map, names):
+    # Raised here rather than from deep inside the encryption stages.
+    if not valid_unit([shapes[i] for i in unit], [channel_map[i] for i in unit]):
+        images = ', '.join(str(names[i]) if names is not None else f"#{i}" for i in unit)
+        raise ValueError(f"Images {images} cannot form a unit: a unit needs at least two channels "
+                         f"and an even number of values (M*N*n).")
+
+
+def plan_buckets(shapes, channel_map, max_waste=DEFAULT_MAX_WASTE, names=None):
+    """Group image indices into buckets with at most `max_waste` padding.
+
+    The bound holds for every image on its own, not just the bucket total,
+    so a thumbnail never joins a bucket of large photos. Images are placed
+    largest first into the bucket they add the least padding to, or open a
+    new bucket. Buckets that cannot form a valid unit on their own are then
+    merged into the bucket that absorbs them most cheaply, even past
+    `max_waste`. Indices within a bucket keep the input order. Raises
+    ValueError, naming the images by `names` if given, when the last bucket
+    left still is not a valid unit.
+    """
+    def stats(bucket):
+        return [shapes[i] for i in bucket], [channel_map[i] for i in bucket]
+
+    def padded_size(bucket):
+        M, N, n = padded_shape(*stats(bucket))
+        return M * N * n
+
+    def fits(bucket):
+        M, N, _ = padded_shape(*stats(bucket))
+        return all(shapes[i][0] * shapes[i][1] >= (1 - max_waste) * M * N for i in bucket)
+
+    buckets = []
+    for i in sorted(range(len(shapes)), key=lambda i: (-shapes[i][0] * shapes[i][1], i)):
+        candidates = [bucket for bucket in buckets if fits(bucket + [i])]
+        if candidates:
+            min(candidates, key=lambda bucket: padded_size(bucket + [i]) - padded_size(bucket)).append(i)
+        else:
+            buckets.append([i])
+
+    while len(buckets) > 1:
+        invalid = next((bucket for bucket in buckets if not valid_unit(*stats(bucket))), None)
+        if invalid is None:
+            break
+        buckets.remove(invalid)
+        target = min(buckets, key=lambda bucket: padded_size(bucket + invalid) - padded_size(bucket))
+        target.extend(invalid)
+    if len(buckets) == 1:
+        _check_valid(buckets[0], shapes, channel_map, names)
+    return sorted(sorted(bucket) for bucket in buckets)
+
+
+def plan_groups(shapes, channel_map, group_size=DEFAULT_GROUP_SIZE, names=None):
+    """Cut image indices into consecutive groups of `group_size`.
+
+    A group that would not form a valid unit takes in the following images
+    until it does; a last group that still does not joins the one before,
+    and ValueError is raised if there is none.
+    """
+    groups, current = [], []
+    for i in range(len(shapes)):
+        current.append(i)
+        if len(current) >= group_size and valid_unit([shapes[j] for j in current], [channel_map[j] for j in current]):
+            groups.append(current)
+            current = []
+    if current:
+        if groups and not valid_unit([shapes[j] for j in current], [channel_map[j] for j in current]):
+            groups[-1].extend(current)
+        else:
+            _check_valid(current, shapes, channel_map, names)
+            groups.append(current)
+    return groups
+
+
+def default_manifest_path(output_folder):
+    # Outside the ciphertext folder: the manifest holds the unit keys.
+    return os.path.normpath(output_folder) + '.manifest.json'
+
+def unit_container_name(index):
+    return f"unit_{index:03d}{container.CONTAINER_EXTENSION}"
+
+def make_unit(index, K, shape, names, original_shapes, channel_map):
+    return {
+        'container': unit_container_name(index),
+        'key': K,
+        'shape': [int(v) for v in shape],
+        'names': [os.path.basename(name) for name in names],
+        'original_shapes': [[int(v) for v in original_shapes[i]] for i in range(len(channel_map))],
+        'channel_map': [int(c) for c in channel_map],
+        'padding_waste': padding_waste([original_shapes[i] for i in range(len(channel_map))], channel_map),
+    }
+
+def manifest_journal_path(path):
+    return f"{path}.journal"
+
+def manifest_header(**fields):
+    return {
+        'format': MANIFEST_FORMAT, 'version': MANIFEST_VERSION, 'algorithm_version': container.ALGORITHM_VERSION,
+        **fields,
+    }
+
+def write_manifest(path, units, **fields):
+    # Replaced atomically, so a reader never sees half a manifest.
+    manifest = {**manifest_header(**fields), 'units': units}
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, path)
+    return manifest
+
+def read_manifest(path):
+    """The manifest at `path`, or what an interrupted run left in its journal."""
+    # The journal is removed once the manifest is written, so one left
+    # behind is newer than any manifest: it holds the header and every unit
+    # the interrupted run saved.
+    records = journal.read_records(manifest_journal_path(path))
+    if records:
+        manifest = {**records[0], 'units': records[1:]}
+    else:
+        with open(path) as f:
+            manifest = json.load(f)
+    if manifest.get('format') != MANIFEST_FORMAT:
+        raise ValueError(f"'{path}' is not a batching manifest.")
+    if manifest['version'] != MANIFEST_VERSION:
+        raise ValueError(f"Unsupported manifest version {manifest['version']}.")
+    if manifest['algorithm_version'] != container.ALGORITHM_VERSION:
+        raise ValueError(f"Manifest was written by algorithm '{manifest['algorithm_version']}', "
+                         f"expected '{container.ALGORITHM_VERSION}'.")
+    for unit in manifest['units']:
+        unit['original_shapes'] = {i: tuple(hw) for i, hw in enumerate(unit['original_shapes'])}
+    return manifest
@@ -0,0 +1,81 @@
+"""Single-file ciphertext container.
+
+Layout: a 12-byte preamble (magic, format version, header length), a UTF-8
+JSON header, space padding up to a 64-byte boundary, then the raw uint8
+(M, N, n) tensor in C order. The payload can be memory-mapped directly, so
+reading a container costs no image decoding at all.
+"""
+import json
+import os
+import struct
+
+import numpy as np
+
+MAGIC = b'MIEC'
+FORMAT_VERSION = 1
+ALGORITHM_VERSION = 'tdlcic-dna-1'
+CONTAINER_EXTENSION = '.miec'
+DEFAULT_CONTAINER_NAME = f"ciphertext{CONTAINER_EXTENSION}"
+_PREAMBLE = struct.Struct('<4sII')
+_ALIGNMENT = 64
+
+
+def write_container(path, image_matrix, original_shapes, channel_map, names, block_rows=256):
+    header = {
+        'algorithm_version': ALGORITHM_VERSION,
+        'shape': [int(v) for v in image_matrix.shape],
+        'dtype': 'uint8',
+        'channel_map': [int(c) for c in channel_map],
+        'original_shapes': [[int(v) for v in original_shapes[i]] for i in range(len(channel_map))],
+        'names': [os.path.basename(name) for name in names],
+    }
+    header_bytes = json.dumps(header).encode('utf-8')
+    header_bytes += b' ' * (-(_PREAMBLE.size + len(header_bytes)) % _ALIGNMENT)
+    with open(path, 'wb') as f:
+        f.write(_PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header_bytes)))
+        f.write(header_bytes)
+        for r0 in range(0, image_matrix.shape[0], block_rows):
+            f.write(np.ascontiguousarray(image_matrix[r0:r0 + block_rows], dtype=np.uint8).data)
+    return path
+
+def read_header(path):
+    with open(path, 'rb') as f:
+        magic, version, header_length = _PREAMBLE.unpack(f.read(_PREAMBLE.size))
+        if magic != MAGIC:
+            raise ValueError(f"'{path}' is not a ciphertext container.")
+        if version != FORMAT_VERSION:
+            raise ValueError(f"Unsupported container format version {version}.")
+        header = json.loads(f.read(header_length).decode('utf-8'))
+    header['offset'] = _PREAMBLE.size + header_length
+    return header
+
+def read_container(path, mmap_mode='r'):
+    """Return (image_matrix, original_shapes, channel_map, names).
+
+    With `mmap_mode` the payload is memory-mapped; pass None to read it
+    into memory.
+    """
+    header = read_header(path)
+    if header['algorithm_version'] != ALGORITHM_VERSION:
+        raise ValueError(f"Container was written by algorithm '{header['algorithm_version']}', "
+                         f"expected '{ALGORITHM_VERSION}'.")
+    shape = tuple(header['shape'])
+    if mmap_mode is None:
+        with open(path, 'rb') as f:
+            f.seek(header['offset'])
+            image_matrix = np.fromfile(f, dtype=np.uint8, count=int(np.prod(shape))).reshape(shape)
+    else:
+        image_matrix = np.memmap(path, dtype=np.uint8, mode=mmap_mode, offset=header['offset'], shape=shape)
+    original_shapes = {i: tuple(hw) for i, hw in enumerate(header['original_shapes'])}
+    return image_matrix, original_shapes, header['channel_map'], header['names']
+
+def find_container(path):
+    # `path` may be the container itself or a folder holding exactly one.
+    if os.path.isfile(path):
+        return path if path.endswith(CONTAINER_EXTENSION) else None
+    if not os.path.isdir(path):
+        return None
+    containers = sorted(f for f in os.listdir(path) if f.endswith(CONTAINER_EXTENSION))
+    if len(containers) > 1:
+        raise ValueError(f"Found {len(containers)} ciphertext containers in '{path}'; expected one.")
+    return os.path.join(path, containers[0]) if containers else None
@@ -1,55 +1,152 @@
+import io
 import numpy as np
 from PIL import Image
 import os
+from concurrent.futures import ThreadPoolExecutor
+from utils import container
 
-def load_images(folder_path):
-    images, paths = [], []
-    sorted_paths = sorted([os.path.join(folder_path, f) for f in os.listdir(folder_path) if f.lower().endswith(('png', 'jpg', 'jpeg'))])
+# Default PNG zlib level (Pillow's default). 0 stores the data uncompressed,
+# which is the fast path for noise-like ciphertext that does not compress.
+DEFAULT_COMPRESS_LEVEL = 6
+# Ciphertext is written as a single container by default; PNG is an export.
+OUTPUT_FORMATS = ('container', 'png', 'both')
+IMAGE_EXTENSIONS = ('png', 'jpg', 'jpeg')
+
+
+def _map_threads(func, items, workers=None):
+    # Pillow releases the GIL while decoding and encoding, so a thread pool
+    # overlaps the per-file work. workers=1 keeps everything on this thread.
+    items = list(items)
+    if workers == 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(func, items))
+
+def channel_offsets(channel_map):
+    return np.concatenate(([0], np.cumsum(channel_map)[:-1])).astype(int).tolist()
+
+def is_image_file(filename):
+    return filename.lower().endswith(IMAGE_EXTENSIONS)
+
+def list_images(folder_path):
+    sorted_paths = sorted([os.path.join(folder_path, f) for f in os.listdir(folder_path) if is_image_file(f)])
     if not sorted_paths: raise ValueError("No images found in the directory.")
-    for path in sorted_paths:
-        images.append(np.array(Image.open(path), dtype=np.uint8))
-        paths.append(path)
+    return sorted_paths
+
+def load_images(folder_path, workers=None):
+    paths = list_images(folder_path)
+    images = _map_threads(lambda path: np.array(Image.open(path), dtype=np.uint8), paths, workers)
     return images, paths
 
-def preprocess_images(images):
+def decode_image(data):
+    # Encoded image bytes (PNG, JPEG, ...) or an array, as a uint8 array.
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return np.array(Image.open(io.BytesIO(data)), dtype=np.uint8)
+    return np.asarray(data, dtype=np.uint8)
+
+def make_layout(shape, original_shapes, channel_map, names=None):
+    return {'shape': tuple(shape), 'original_shapes': dict(original_shapes), 'channel_map': list(channel_map),
+            'names': [os.path.basename(name) for name in names] if names is not None else None}
+
+def split_images(image_matrix, original_shapes, channel_map, crop=True):
+    # Per-image views of an (M, N, n) tensor, cropped to the original sizes.
+    images = []
+    for i, (channel_idx, num_channels) in enumerate(zip(channel_offsets(channel_map), channel_map)):
+        h, w = original_shapes[i] if crop else image_matrix.shape[:2]
+        if num_channels == 3:
+            images.append(image_matrix[:h, :w, channel_idx:channel_idx + 3])
+        else:
+            images.append(image_matrix[:h, :w, channel_idx])
+    return images
+
+def _write_image(out, img, channel_idx, num_channels):
+    h, w = img.shape[:2]
+    if num_channels == 3:
+        out[:h, :w, channel_idx:channel_idx + 3] = img[:, :, :3]
+    else:
+        out[:h, :w, channel_idx] = img
+
+def preprocess_images(images, out=None):
+    # Every image is written straight into its channel slots of one
+    # zero-padded (M, N, n) tensor.
     max_h = max(img.shape[0] for img in images)
     max_w = max(img.shape[1] for img in images)
-    channels, original_shapes, channel_map = [], {}, []
-    for i, img in enumerate(images):
-        h, w = img.shape[:2]
-        original_shapes[i] = (h, w)
-        pad_h, pad_w = max_h - h, max_w - w
-        padded_img = np.pad(img, ((0, pad_h), (0, pad_w), (0, 0)) if img.ndim == 3 else ((0, pad_h), (0, pad_w)), 'constant')
-        if padded_img.ndim == 3:
-            channels.extend([padded_img[:, :, j] for j in range(3)])
-            channel_map.append(3)
-        else:
-            channels.append(padded_img)
-            channel_map.append(1)
-    return np.stack(channels, axis=-1), original_shapes, channel_map
+    original_shapes = {i: img.shape[:2] for i, img in enumerate(images)}
+    channel_map = [3 if img.ndim == 3 else 1 for img in images]
+    shape = (max_h, max_w, sum(channel_map))
+    if out is None:
+        out = np.zeros(shape, dtype=np.uint8)
+    else:
+        out[...] = 0
+    for img, channel_idx, num_channels in zip(images, channel_offsets(channel_map), channel_map):
+        _write_image(out, img, channel_idx, num_channels)
+    return out, original_shapes, channel_map
+
+def read_layout(paths):
+    # Same layout preprocess_images produces, read from the file headers only.
+    original_shapes, channel_map = {}, []
+    for i, path in enumerate(paths):
+        with Image.open(path) as img:
+            original_shapes[i] = (img.height, img.width)
+            channel_map.append(1 if len(img.getbands()) == 1 else 3)
+    max_h = max(h for h, _ in original_shapes.values())
+    max_w = max(w for _, w in original_shapes.values())
+    return (max_h, max_w, sum(channel_map)), original_shapes, channel_map
+
+def load_into(paths, out, channel_map, workers=None):
+    # Decode every file on the thread pool straight into its channel slots
+    # of `out`, which must already be zero-filled for the padding.
+    def load_one(task):
+        path, channel_idx, num_channels = task
+        _write_image(out, np.array(Image.open(path), dtype=np.uint8), channel_idx, num_channels)
+    _map_threads(load_one, zip(paths, channel_offsets(channel_map), channel_map), workers)
+    return out
+
+def load_tensor(paths, workers=None):
+    # load_images + preprocess_images without the per-image list, np.pad or
+    # np.stack copies.
+    shape, original_shapes, channel_map = read_layout(paths)
+    return load_into(paths, np.zeros(shape, dtype=np.uint8), channel_map, workers), original_shapes, channel_map
 
 def stitch_images_for_key(processed_images_matrix):
     return np.concatenate([processed_images_matrix[:,:,i] for i in range(processed_images_matrix.shape[2])], axis=1)
 
-def save_images(image_matrix, base_path, original_paths, original_shapes, channel_map, preserve_padding=False):
+def save_images(image_matrix, base_path, original_paths, original_shapes, channel_map, preserve_padding=False,
+                workers=None, compress_level=DEFAULT_COMPRESS_LEVEL):
     os.makedirs(base_path, exist_ok=True)
-    current_channel_idx = 0
-    for i, num_channels in enumerate(channel_map):
-        if preserve_padding:
-            # Save full padded images (for encrypted images)
-            original_h, original_w = image_matrix.shape[0], image_matrix.shape[1]
-        else:
-            # Crop to original size (for final decrypted images)
-            original_h, original_w = original_shapes[i]
+    images = split_images(image_matrix, original_shapes, channel_map, crop=not preserve_padding)
 
-        if num_channels == 3:
-            img_array = np.stack(
-                [image_matrix[:original_h, :original_w, current_channel_idx + j] for j in range(3)],
-                axis=-1
-            )
-        else:
-            img_array = image_matrix[:original_h, :original_w, current_channel_idx]
-        current_channel_idx += num_channels
+    def save_one(i):
         filename = os.path.basename(original_paths[i])
         new_filename = f"{os.path.splitext(filename)[0]}_processed.png"
-        Image.fromarray(img_array.astype(np.uint8)).save(os.path.join(base_path, new_filename))
+        Image.fromarray(np.asarray(images[i], dtype=np.uint8)).save(os.path.join(base_path, new_filename),
+                                                                    compress_level=compress_level)
+
+    _map_threads(save_one, range(len(images)), workers)
+
+def save_container(image_matrix, base_path, original_paths, original_shapes, channel_map,
+                   name=container.DEFAULT_CONTAINER_NAME):
+    os.makedirs(base_path, exist_ok=True)
+    return container.write_container(os.path.join(base_path, name), image_matrix, original_shapes, channel_map,
+                                     original_paths)
+
+def save_ciphertext(image_matrix, base_path, original_paths, original_shapes, channel_map, output_format='container',
+                    compress_level=DEFAULT_COMPRESS_LEVEL, workers=None, container_name=container.DEFAULT_CONTAINER_NAME):
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format '{output_format}'. Choose from: {', '.join(OUTPUT_FORMATS)}")
+    if output_format in ('container', 'both'):
+        save_container(image_matrix, base_path, original_paths, original_shapes, channel_map, container_name)
+    if output_format in ('png', 'both'):
+        save_images(image_matrix, base_path, original_paths, original_shapes, channel_map, preserve_padding=True,
+                    workers=workers, compress_level=compress_level)
+
+def load_ciphertext(input_path, workers=None):
+    # Prefer a ciphertext container (memory-mapped, true original sizes);
+    # otherwise fall back to the padded _processed.png files.
+    container_path = container.find_container(input_path)
+    if container_path is not None:
+        P_end, original_shapes, channel_map, names = container.read_container(container_path)
+        return P_end, original_shapes, channel_map, names
+    paths = list_images(input_path)
+    P_end, original_shapes, channel_map = load_tensor(paths, workers)
+    return P_end, original_shapes, channel_map, paths
@@ -0,0 +1,164 @@
+"""Per-stage instrumentation of encryption and decryption runs.
+
+`Instrumentation.stage(name)` wraps one pipeline step and records its wall
+time, CPU time, bytes processed and peak memory (sampled RSS, and the
+tracemalloc peak when enabled; NumPy reports its buffers to tracemalloc).
+Every record goes to pluggable sinks: PrintSink is the human-readable
+"Step N" output, JSONLogSink writes one JSON line per stage and
+CallbackSink hands records to in-process code. Optionally every stage is
+also run under cProfile and its stats dumped to `<profile_dir>/<stage>.prof`.
+"""
+import cProfile
+import json
+import os
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from utils.memory import RSSMonitor
+
+
+class Sink:
+    """Base sink; override the events you care about."""
+
+    def on_start(self, name, message):
+        pass
+
+    def on_message(self, message):
+        pass
+
+    def on_stage(self, record):
+        pass
+
+    def on_finish(self, records):
+        pass
+
+
+class PrintSink(Sink):
+    """Prints stage messages and, with `report`, a stage table at the end."""
+
+    def __init__(self, report=False, stream=None):
+        self.report = report
+        self.stream = stream
+
+    def _print(self, message):
+        print(message, file=self.stream or sys.stdout)
+
+    def on_start(self, name, message):
+        if message:
+            self._print(message)
+
+    def on_message(self, message):
+        self._print(message)
+
+    def on_finish(self, records):
+        if self.report and records:
+            self._print(format_report(records))
+
+
+class JSONLogSink(Sink):
+    """Appends every stage record to `path` as a JSON line."""
+
+    def __init__(self, path, **fields):
+        self.path = path
+        self.fields = fields
+
+    def on_stage(self, record):
+        with open(self.path, 'a') as log:
+            log.write(json.dumps({**self.fields, **record}) + "\n")
+
+
+class CallbackSink(Sink):
+    """Calls `callback(record)` when a stage ends."""
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def on_stage(self, record):
+        self.callback(record)
+
+
+def format_report(records):
+    traced = any('peak_traced' in record for record in records)
+    header = (f"{'Stage':<12} {'Time (s)':>9} {'CPU (s)':>8} {'MB':>9} {'MB/s':>9} "
+              f"{'Peak RSS (MB)':>14} {'Peak anon (MB)':>15}")
+    lines = [header + (f" {'Peak traced (MB)':>17}" if traced else "")]
+    for record in records:
+        rate = f"{record['mb_per_s']:>9.1f}" if record['mb_per_s'] is not None else f"{'-':>9}"
+        line = (f"{record['stage']:<12} {record['seconds']:>9.2f} {record['cpu_seconds']:>8.2f} "
+                f"{record['bytes'] / 2**20:>9.1f} {rate} {record['peak_rss'] / 2**20:>14.1f} "
+                f"{record['peak_anon_rss'] / 2**20:>15.1f}")
+        if traced:
+            line += f" {record.get('peak_traced', 0) / 2**20:>17.1f}"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+class Instrumentation:
+    """Times and measures pipeline stages and reports them to `sinks`.
+
+    With no sinks nothing is printed, but `records` still fills up.
+    `trace_memory` adds the tracemalloc peak per stage and `profile_dir`
+    a cProfile dump per stage; both slow the run down.
+    """
+
+    def __init__(self, sinks=None, profile_dir=None, trace_memory=False, rss_interval=0.01):
+        self.sinks = list(sinks or [])
+        self.profile_dir = profile_dir
+        self.trace_memory = trace_memory
+        self.records = []
+        self._rss = RSSMonitor(rss_interval)
+
+    def _emit(self, event, *args):
+        for sink in self.sinks:
+            getattr(sink, event)(*args)
+
+    def note(self, message):
+        self._emit('on_message', message)
+
+    @contextmanager
+    def stage(self, name, message=None, nbytes=0):
+        # Yields the record, so the body can set record['bytes'] once known.
+        record = {'stage': name, 'bytes': int(nbytes)}
+        self._emit('on_start', name, message)
+        started_tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            traced_base = tracemalloc.get_traced_memory()[0]
+        profiler = cProfile.Profile() if self.profile_dir else None
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            with self._rss.stage(name):
+                if profiler:
+                    profiler.enable()
+                try:
+                    yield record
+                finally:
+                    if profiler:
+                        profiler.disable()
+            record['seconds'] = time.perf_counter() - wall
+            record['cpu_seconds'] = time.process_time() - cpu
+            record['mb_per_s'] = (record['bytes'] / 2**20 / record['seconds']
+                                  if record['bytes'] and record['seconds'] > 0 else None)
+            record['peak_rss'] = self._rss.stages[name]['peak_rss']
+            record['peak_anon_rss'] = self._rss.stages[name]['peak_anon_rss']
+            if self.trace_memory:
+                record['peak_traced'] = tracemalloc.get_traced_memory()[1] - traced_base
+        finally:
+            if started_tracing:
+                tracemalloc.stop()
+        if profiler:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            record['profile'] = os.path.join(self.profile_dir, f"{name}.prof")
+            profiler.dump_stats(record['profile'])
+        self.records.append(record)
+        self._emit('on_stage', record)
+
+    def finish(self):
+        self._emit('on_finish', self.records)
+
+    def format_report(self):
+        return format_report(self.records)
@@ -0,0 +1,56 @@
+"""Append-only JSON-lines journals for resumable runs.
+
+Every record is one line, flushed and fsynced as it is written, so a run
+that dies keeps everything it finished. A line cut short by the crash is
+dropped when the journal is read or reopened.
+"""
+import json
+import os
+
+
+def read_records(path):
+    """Every complete record in the journal, oldest first; [] if it does not exist."""
+    records = []
+    if not os.path.exists(path):
+        return records
+    with open(path) as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return records
+
+
+def _trim_partial_line(path):
+    # Drop a record cut short by an interruption, so new records start on
+    # a fresh line.
+    with open(path, 'rb+') as f:
+        data = f.read()
+        if data and not data.endswith(b"\n"):
+            f.truncate(data.rfind(b"\n") + 1)
+
+
+class Journal:
+    """Appends records to `path`; use as a context manager or call close()."""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        if os.path.exists(path):
+            _trim_partial_line(path)
+        self.path = path
+        self._file = open(path, 'a')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def append(self, record):
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
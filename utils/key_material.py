@@ -0,0 +1,253 @@
+import hashlib
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from chaotic_maps.tdlcic import tdlcic_map
+from dna_operations.scramble import ScramblePlan
+
+TRANSIENT_ITERATIONS = 1000
+# Bytes hashed per block by plaintext_key.
+KEY_BLOCK_BYTES = 8 * 2**20
+
+
+def plaintext_key(P, block_bytes=KEY_BLOCK_BYTES):
+    """Plaintext-related 128-character hex key of an (M, N, n) tensor.
+
+    Hashes the same bytes as stitch_images_for_key(P).tobytes(), where each
+    row holds that row of every channel in turn, without building them: row
+    blocks are transposed into two reused buffers, and a thread hashes one
+    block while the next is filled (hashlib releases the GIL).
+    """
+    M, N, n = P.shape
+    rows = max(1, block_bytes // max(1, N * n))
+    digest = hashlib.sha512()
+    if M <= rows:
+        digest.update(np.ascontiguousarray(P.transpose(0, 2, 1)))
+        return digest.hexdigest()
+    buffers = [np.empty((rows, n, N), dtype=np.uint8) for _ in range(2)]
+    with ThreadPoolExecutor(1) as hasher:
+        pending = None
+        for i, r0 in enumerate(range(0, M, rows)):
+            block = buffers[i % 2][:min(rows, M - r0)]
+            np.copyto(block, P[r0:r0 + len(block)].transpose(0, 2, 1))
+            # The block before this one used the other buffer; the one before
+            # that, this buffer, finished before that was submitted.
+            if pending is not None:
+                pending.result()
+            pending = hasher.submit(digest.update, block)
+        pending.result()
+    return digest.hexdigest()
+
+
+def key_parameters(K):
+    k = np.array([int(K[i:i+8], 16) for i in range(0, 128, 8)]) / 256.0
+    return 2 + np.sum(k[0:4]), 2 + np.sum(k[4:8]), np.sum(k[8:12]) % 1, np.sum(k[12:16]) % 1
+
+
+def smallest_index_dtype(limit):
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if limit <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+
+class KeyMaterial:
+    """Everything encryption and decryption derive from a key for one (M, N, n).
+
+    `C_matrix` and `E` come from one pass over the chaotic sequence, `S` and
+    `G` are the scrambling argsorts, and `scramble_index` is the composed
+    ScramblePlan. All arrays are read-only so cached instances can be shared.
+    """
+    ARRAYS = ('C_matrix', 'E', 'S', 'G', 'scramble_index')
+
+    def __init__(self, K, shape, C_matrix, E, S, G, scramble_index):
+        self.K, self.shape = K, tuple(shape)
+        self.C_matrix, self.E, self.S, self.G = C_matrix, E, S, G
+        self.scramble_index = scramble_index
+        for name in self.ARRAYS:
+            getattr(self, name).flags.writeable = False
+
+    @classmethod
+    def derive(cls, K, shape, backend=None):
+        M, N, n = shape
+        sum_pixels = M * N
+        a, b, x0, y0 = key_parameters(K)
+        x, y = tdlcic_map(x0, y0, a, b, (sum_pixels * n // 2) + TRANSIENT_ITERATIONS, backend)
+        x, y = x[TRANSIENT_ITERATIONS:], y[TRANSIENT_ITERATIONS:]
+        xy = np.concatenate((x, y))[:sum_pixels * n]
+        E = (np.floor(np.abs(xy) * 1e14).astype(np.uint64) % 256).astype(np.uint8).reshape(M, N, n)
+        C_matrix = E % 8
+        S = np.argsort(x[:sum_pixels])
+        G = np.argsort(xy.reshape(sum_pixels, n), axis=1)
+        plan = ScramblePlan.from_sequences(S, G)
+        return cls(K, shape, C_matrix, E, S.astype(smallest_index_dtype(sum_pixels)),
+                   G.astype(smallest_index_dtype(n)), plan.index)
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in self.ARRAYS)
+
+    @property
+    def plan(self):
+        return ScramblePlan(self.scramble_index)
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        for name in self.ARRAYS:
+            np.save(os.path.join(directory, f"{name}.npy"), getattr(self, name))
+
+    @classmethod
+    def load(cls, directory, K, shape, mmap_mode='r'):
+        arrays = [np.load(os.path.join(directory, f"{name}.npy"), mmap_mode=mmap_mode) for name in cls.ARRAYS]
+        return cls(K, shape, *arrays)
+
+
+class KeyMaterialCache:
+    """LRU of KeyMaterial keyed by (K, M, N, n) with an optional disk tier.
+
+    Entries beyond `max_bytes` are evicted least-recently-used first; when
+    `cache_dir` is set they are spilled there as .npy files and memory-mapped
+    back on the next hit. The disk tier is itself bounded by `max_disk_bytes`.
+    It holds key-derived material, so keep `cache_dir` on trusted storage.
+    """
+
+    def __init__(self, max_bytes=512 * 2**20, cache_dir=None, max_disk_bytes=4 * 2**30):
+        self.max_bytes, self.cache_dir, self.max_disk_bytes = max_bytes, cache_dir, max_disk_bytes
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.disk_hits = self.misses = self.evictions = self.spills = 0
+
+    @staticmethod
+    def _entry_key(K, shape):
+        return (K,) + tuple(int(v) for v in shape)
+
+    def _entry_dir(self, entry_key):
+        digest = hashlib.sha256(repr(entry_key).encode()).hexdigest()
+        return os.path.join(self.cache_dir, digest)
+
+    def get(self, K, shape, backend=None):
+        entry_key = self._entry_key(K, shape)
+        with self._lock:
+            material = self._entries.get(entry_key)
+            if material is not None:
+                self._entries.move_to_end(entry_key)
+                self.hits += 1
+                return material
+        # Disk reads, derivation and spills run outside the lock, so memory
+        # hits from other threads never wait on them.
+        material = self._load_from_disk(entry_key)
+        with self._lock:
+            if material is not None:
+                self.disk_hits += 1
+            else:
+                self.misses += 1
+        if material is None:
+            material = KeyMaterial.derive(K, shape, backend)
+        with self._lock:
+            self._entries[entry_key] = material
+            self._entries.move_to_end(entry_key)
+            evicted = self._evict()
+        for evicted_key, evicted_material in evicted:
+            self._spill(evicted_key, evicted_material)
+        return material
+
+    def _load_from_disk(self, entry_key):
+        if self.cache_dir is None:
+            return None
+        directory = self._entry_dir(entry_key)
+        if not os.path.isdir(directory):
+            return None
+        try:
+            material = KeyMaterial.load(directory, entry_key[0], entry_key[1:])
+            os.utime(directory)
+        except (OSError, ValueError):
+            shutil.rmtree(directory, ignore_errors=True)
+            return None
+        return material
+
+    def _evict(self):
+        # Called with the lock held; returns the evicted entries to spill
+        # once it is released.
+        evicted = []
+        used = sum(material.nbytes for material in self._entries.values())
+        while self._entries and used > self.max_bytes:
+            entry_key, material = self._entries.popitem(last=False)
+            used -= material.nbytes
+            self.evictions += 1
+            evicted.append((entry_key, material))
+        return evicted
+
+    def _spill(self, entry_key, material):
+        if self.cache_dir is None or isinstance(material.E, np.memmap):
+            return
+        directory = self._entry_dir(entry_key)
+        # Each spill writes its own temporary directory, so threads spilling
+        # at once never share one.
+        tmp_directory = f"{directory}.tmp{os.getpid()}.{threading.get_ident()}"
+        material.save(tmp_directory)
+        shutil.rmtree(directory, ignore_errors=True)
+        try:
+            os.replace(tmp_directory, directory)
+        except OSError:
+            # Another thread spilled the same entry first.
+            shutil.rmtree(tmp_directory, ignore_errors=True)
+            return
+        with self._lock:
+            self.spills += 1
+        self._trim_disk()
+
+    def _trim_disk(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            directory = os.path.join(self.cache_dir, name)
+            if '.tmp' in name:
+                continue
+            try:
+                if os.path.isdir(directory):
+                    size = sum(entry.stat().st_size for entry in os.scandir(directory))
+                    entries.append((os.stat(directory).st_mtime, size, directory))
+            except FileNotFoundError:
+                # Trimmed or replaced by another thread meanwhile.
+                continue
+        total = sum(size for _, size, _ in entries)
+        for _, size, directory in sorted(entries):
+            if total <= self.max_disk_bytes:
+                break
+            shutil.rmtree(directory, ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                'evictions': self.evictions, 'spills': self.spills, 'entries': len(self._entries),
+                'bytes': sum(material.nbytes for material in self._entries.values()),
+            }
+
+
+default_cache = KeyMaterialCache()
+
+def configure_cache(max_bytes=512 * 2**20, cache_dir=None, max_disk_bytes=4 * 2**30):
+    global default_cache
+    default_cache = KeyMaterialCache(max_bytes, cache_dir, max_disk_bytes)
+    return default_cache
+
+def get_key_material(K, shape, backend=None, cache=True):
+    # cache=False derives without storing. Use it for keys that are used only
+    # once, such as batch units, bulk jobs and trial keys: their material is
+    # never hit again, so caching it would only grow memory with the number
+    # of keys.
+    if not cache:
+        return KeyMaterial.derive(K, shape, backend)
+    return default_cache.get(K, shape, backend)
@@ -0,0 +1,70 @@
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+
+def current_rss():
+    """Return (rss, anonymous_rss) of this process in bytes.
+
+    Anonymous RSS excludes file-backed pages such as memory-mapped scratch
+    files, which the kernel can write back and reclaim. Where /proc is not
+    available both values fall back to the lifetime peak from getrusage.
+    """
+    try:
+        with open('/proc/self/status') as status:
+            fields = dict(line.split(':', 1) for line in status if ':' in line)
+        rss = int(fields['VmRSS'].split()[0]) * 1024
+        return rss, int(fields.get('RssAnon', fields['VmRSS']).split()[0]) * 1024
+    except (OSError, KeyError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak *= 1 if sys.platform == 'darwin' else 1024
+        return peak, peak
+
+
+class RSSMonitor:
+    """Samples RSS on a background thread and records the peak per stage."""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.stages = {}
+        self._peak = (0, 0)
+        self._lock = threading.Lock()
+
+    def _sample(self):
+        rss, anon = current_rss()
+        with self._lock:
+            self._peak = (max(self._peak[0], rss), max(self._peak[1], anon))
+
+    def _run(self, stop):
+        while not stop.wait(self.interval):
+            self._sample()
+
+    @contextmanager
+    def stage(self, name):
+        with self._lock:
+            self._peak = (0, 0)
+        self._sample()
+        stop = threading.Event()
+        sampler = threading.Thread(target=self._run, args=(stop,), daemon=True)
+        start = time.perf_counter()
+        sampler.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            sampler.join()
+            self._sample()
+            self.stages[name] = {
+                'seconds': time.perf_counter() - start,
+                'peak_rss': self._peak[0],
+                'peak_anon_rss': self._peak[1],
+            }
+
+    def format_report(self):
+        lines = [f"{'Stage':<12} {'Time (s)':>9} {'Peak RSS (MB)':>14} {'Peak anon (MB)':>15}"]
+        for name, stats in self.stages.items():
+            lines.append(f"{name:<12} {stats['seconds']:>9.2f} {stats['peak_rss'] / 2**20:>14.1f} "
+                         f"{stats['peak_anon_rss'] / 2**20:>15.1f}")
+        return "\n".join(lines)